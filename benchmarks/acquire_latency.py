@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+
+from common import setup_backend, summarize, timed
+
+
+def fill_backlog(controller, size, profiles=4):
+    specs = ({'job_id': controller.create_job_id(),
+              'reqs': {'cpu': random.randint(1, 4), 'ram': random.randint(1, profiles)},
+              'priority': random.randint(0, 9)} for _ in range(size))
+    controller.create_jobs(specs)
+
+
+def measure_acquire(controller, samples, profiles=4):
+    latencies = []
+    for _ in range(samples):
+        elapsed, job = timed(controller.acquire_job, {'cpu': 4, 'ram': profiles}, 'bench-worker')
+        latencies.append(elapsed)
+        # keep the backlog size constant
+        controller.requeue_job(job.id, job.version)
+    return summarize(latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures acquire_job latency as the backlog grows')
+    parser.add_argument('--db-uri', help='MongoDB to run against, in-memory controller is used if omitted')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    controller = setup_backend(args.db_uri)
+    backlog = 0
+    for size in sorted(args.sizes):
+        fill_backlog(controller, size - backlog)
+        backlog = size
+        stats = measure_acquire(controller, args.samples)
+        print('backlog={:<10d} p50={:.3f}ms p99={:.3f}ms'.format(size, stats['p50_ms'], stats['p99_ms']))
@@ -0,0 +1,38 @@
+import time
+
+from terry.controller import Controller
+from terry.memory import MemoryController
+
+
+def setup_backend(db_uri, **kwargs):
+    # in-memory controller is used if db_uri is omitted, it ignores options specific to MongoDB
+    if db_uri is None:
+        return MemoryController(policy=kwargs.get('policy'))
+
+    import pymongo
+    client = pymongo.MongoClient(db_uri)
+    client.drop_database(client.get_default_database().name)
+    controller = Controller(db_uri, **kwargs)
+    # other controllers of the process may have seen the indexes before they were dropped
+    controller.ensure_indexes()
+    return controller
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(latencies, elapsed=None):
+    latencies = sorted(latencies)
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    return {'count': len(latencies),
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'ops_per_sec': len(latencies) / elapsed}
+
+
+def timed(func, *args, **kwargs):
+    started = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - started, result
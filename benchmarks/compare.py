@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two reports produced by suite.py')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = dict(flatten(json.load(f)['results']))
+    with open(args.candidate) as f:
+        candidate = dict(flatten(json.load(f)['results']))
+
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        change = '{:+.1f}%'.format((new - old) / old * 100) if old else 'n/a'
+        print('{:<60s} {:>14.3f} {:>14.3f} {:>10s}'.format(key, old, new, change))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from datetime import datetime
+
+from acquire_latency import fill_backlog, measure_acquire
+from common import setup_backend, summarize, timed
+from utilization import POLICIES, simulate
+
+from terry.worker import BasicResourceManager, Worker
+
+
+def bench_create_job(db_uri, scale):
+    controller = setup_backend(db_uri)
+    latencies = [timed(controller.create_job, controller.create_job_id(), reqs={'cpu': 1})[0]
+                 for _ in range(1000 * scale)]
+    return summarize(latencies)
+
+
+def bench_create_jobs(db_uri, scale):
+    controller = setup_backend(db_uri)
+    count = 10000 * scale
+    specs = ({'job_id': controller.create_job_id(), 'reqs': {'cpu': 1}} for _ in range(count))
+    elapsed, _ = timed(controller.create_jobs, specs)
+    return {'count': count, 'ops_per_sec': count / elapsed}
+
+
+def bench_acquire_job(db_uri, scale):
+    results = {}
+    for backlog in [1000 * scale, 10000 * scale]:
+        for profiles in [1, 16]:
+            controller = setup_backend(db_uri)
+            fill_backlog(controller, backlog, profiles)
+            key = 'backlog={},profiles={}'.format(backlog, profiles)
+            results[key] = measure_acquire(controller, 200 * scale, profiles)
+    return results
+
+
+def bench_heartbeat_job(db_uri, scale):
+    controller = setup_backend(db_uri)
+    controller.create_jobs({'job_id': controller.create_job_id(), 'reqs': {'cpu': 1}} for _ in range(100))
+    jobs = controller.acquire_jobs({'cpu': 100}, 'bench-worker', 100)
+
+    latencies = []
+    for _ in range(10 * scale):
+        for i, job in enumerate(jobs):
+            elapsed, jobs[i] = timed(controller.heartbeat_job, job.id, job.version)
+            latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def bench_end_to_end(db_uri, scale):
+    results = {}
+    for n_workers, n_threads in [(1, 1), (1, 8), (4, 8)]:
+        controller = setup_backend(db_uri)
+        count = 200 * scale
+        controller.create_jobs({'job_id': controller.create_job_id(), 'reqs': {'cpu': 1}} for _ in range(count))
+
+        done = threading.Semaphore(0)
+        workers = [Worker('bench-worker-{}'.format(i), BasicResourceManager({'cpu': n_threads}),
+                          lambda channel: done.release(), controller, max_jobs=n_threads)
+                   for i in range(n_workers)]
+
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for _ in range(count):
+            done.acquire()
+        for worker in workers:
+            worker.stop()  # waits for the last jobs to be finalized
+        elapsed = time.time() - started
+
+        key = 'workers={},threads={}'.format(n_workers, n_threads)
+        results[key] = {'count': count, 'ops_per_sec': count / elapsed}
+    return results
+
+
+def bench_pickup(db_uri, scale):
+    controller = setup_backend(db_uri, signals=True)
+    picked_up = []
+    job_started = threading.Event()
+
+    def work_func(channel):
+        picked_up.append(time.time())
+        job_started.set()
+
+    worker = Worker('bench-worker', BasicResourceManager({'cpu': 1}), work_func, controller)
+    worker.start()
+    time.sleep(1)  # let the worker become idle
+
+    latencies = []
+    for _ in range(20 * scale):
+        job_started.clear()
+        created = time.time()
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+        job_started.wait()
+        latencies.append(picked_up[-1] - created)
+        time.sleep(0.1)  # let the worker finalize the job and become idle again
+
+    worker.stop()
+    stats = summarize(latencies)
+    del stats['ops_per_sec']  # meaningless here, the benchmark waits between jobs
+    return stats
+
+
+COLD_START = '''
+import sys, time
+from terry.controller import Controller
+started = time.time()
+job = Controller(sys.argv[1]).acquire_job({'cpu': 1}, 'bench-worker')
+assert job is not None
+print(time.time() - started)
+'''
+
+
+def bench_cold_start(db_uri, scale):
+    # time from constructing a controller in a fresh process (like a new worker pod) to its first acquired job
+    controller = setup_backend(db_uri)
+    latencies = []
+    for _ in range(5 * scale):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+        if db_uri is None:
+            latencies.append(timed(controller.acquire_job, {'cpu': 1}, 'bench-worker')[0])
+        else:
+            latencies.append(float(subprocess.check_output([sys.executable, '-c', COLD_START, db_uri])))
+    stats = summarize(latencies)
+    del stats['ops_per_sec']  # meaningless here, processes are started one after another
+    return stats
+
+
+def bench_utilization(db_uri, scale):
+    return {name: simulate(setup_backend(db_uri, policy=policy()), 50 * scale) for name, policy in POLICIES.items()}
+
+
+BENCHMARKS = {
+    'create_job': bench_create_job,
+    'create_jobs': bench_create_jobs,
+    'acquire_job': bench_acquire_job,
+    'heartbeat_job': bench_heartbeat_job,
+    'end_to_end': bench_end_to_end,
+    'pickup': bench_pickup,
+    'cold_start': bench_cold_start,
+    'utilization': bench_utilization,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs Controller and Worker benchmarks, prints results as JSON')
+    parser.add_argument('--db-uri', help='MongoDB to run against, in-memory controller is used if omitted')
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the amount of work in every benchmark')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    parser.add_argument('--output', help='file to write results to, stdout is used if omitted')
+    args = parser.parse_args()
+
+    report = {'started_at': datetime.utcnow().isoformat(),
+              'backend': 'mongo' if args.db_uri else 'memory',
+              'python': platform.python_version(),
+              'scale': args.scale,
+              'results': {}}
+    for name in args.only:
+        print('Running {}...'.format(name), file=sys.stderr)
+        report['results'][name] = BENCHMARKS[name](args.db_uri, args.scale)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
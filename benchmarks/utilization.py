@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+
+from common import setup_backend
+
+from terry.policy import BestFit, FirstFit, LargestFirst
+
+
+POLICIES = {'first_fit': FirstFit, 'best_fit': BestFit, 'largest_first': LargestFirst}
+
+# hosts of the simulated cluster and the mix of submitted jobs
+HOSTS = [{'cpu': 16, 'ram': 64}] * 4 + [{'cpu': 4, 'ram': 16}] * 8 + [{'cpu': 32, 'ram': 32}] * 2
+JOBS = [{'cpu': 1, 'ram': 60}, {'cpu': 8, 'ram': 4}, {'cpu': 2, 'ram': 8}, {'cpu': 1, 'ram': 2},
+        {'cpu': 4, 'ram': 16}, {'cpu': 16, 'ram': 8}]
+
+
+def simulate(controller, ticks, backlog=200, seed=0):
+    # every tick hosts acquire whatever fits into their free resources, jobs run for a random number of ticks;
+    # returns the average share of cluster resources used by running jobs
+    rnd = random.Random(seed)
+    total = {k: sum(host[k] for host in HOSTS) for k in HOSTS[0]}
+    free = [dict(host) for host in HOSTS]
+    running = []  # (finishes_at, host, job)
+    queued = 0
+    used_sum = dict.fromkeys(total, 0)
+
+    for tick in range(ticks):
+        specs = [{'job_id': controller.create_job_id(), 'reqs': rnd.choice(JOBS)} for _ in range(backlog - queued)]
+        controller.create_jobs(specs)
+        queued += len(specs)
+
+        for host in rnd.sample(range(len(HOSTS)), len(HOSTS)):
+            for job in controller.acquire_jobs(free[host], 'host-{}'.format(host), 100):
+                for k, v in job.reqs.items():
+                    free[host][k] -= v
+                running.append((tick + rnd.randint(1, 10), host, job))
+                queued -= 1
+
+        for k in total:
+            used_sum[k] += total[k] - sum(f[k] for f in free)
+
+        for _, host, job in [r for r in running if r[0] == tick]:
+            controller.finalize_job(job.id, job.version)
+            for k, v in job.reqs.items():
+                free[host][k] += v
+        running = [r for r in running if r[0] > tick]
+
+    return {k: used_sum[k] / (total[k] * ticks) for k in total}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures cluster utilization under each selection policy')
+    parser.add_argument('--db-uri', help='MongoDB to run against, in-memory controller is used if omitted')
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for name, policy in sorted(POLICIES.items()):
+        utilization = simulate(setup_backend(args.db_uri, policy=policy()), args.ticks, seed=args.seed)
+        print('{:<14} {}'.format(name, ' '.join('{}={:.1%}'.format(k, v) for k, v in sorted(utilization.items()))))
@@ -1,2 +1,3 @@
-from .api import Job, IJobController, IWorkerController  # noqa
+from .api import Job, BulkCreateResult, IJobController, IWorkerController  # noqa
 from .controller import Controller  # noqa
+from .memory import MemoryController  # noqa
@@ -0,0 +1,55 @@
+import argparse
+
+from datetime import timedelta
+
+from .controller import Controller
+
+
+def ensure_indexes(args):
+    controller = Controller(args.db_uri, args.col_name, ensure_indexes=False)
+    try:
+        for queue in [controller] + [controller.queue(name) for name in args.queues]:
+            queue.ensure_indexes()
+            # the TTL of finished jobs is only changed when asked for
+            if args.no_retention:
+                queue.set_retention(None)
+            elif args.retention is not None:
+                queue.set_retention(timedelta(seconds=args.retention))
+    finally:
+        controller.close()
+
+
+def migrate(args):
+    controller = Controller(args.db_uri, args.col_name, ensure_indexes=False)
+    try:
+        for name in [None] + args.queues:
+            queue = controller.queue(name)
+            queue.ensure_indexes()
+            print('{}: {} jobs updated'.format(name or 'default queue', queue.migrate()))
+    finally:
+        controller.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m terry', description='Administrative commands')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('ensure-indexes', help='creates indexes once, so controllers may skip it '
+                                                         '(see Controller(ensure_indexes=False))')
+    command.add_argument('db_uri')
+    command.add_argument('--col-name', default='jobs')
+    command.add_argument('--queues', nargs='*', default=[], help='named queues to create indexes for')
+    retention = command.add_mutually_exclusive_group()
+    retention.add_argument('--retention', type=float, help='seconds finished jobs are kept for')
+    retention.add_argument('--no-retention', action='store_true', help='keep finished jobs until archive_jobs')
+    command.set_defaults(func=ensure_indexes)
+
+    command = commands.add_parser('migrate', help='updates jobs created by older versions, run it after upgrading')
+    command.add_argument('db_uri')
+    command.add_argument('--col-name', default='jobs')
+    command.add_argument('--queues', nargs='*', default=[], help='named queues to migrate')
+    command.set_defaults(func=migrate)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,496 @@
+import asyncio
+import functools
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+from datetime import datetime
+from itertools import islice
+
+from .api import ConcurrencyError, Job, RetriableError
+from .worker import (
+    InterruptJob, JobChannel, JobContext, QueueScheduler, _RequeueRequested,
+    fits_resources, format_worker_exception, substract_resources
+)
+
+
+__all__ = ['AsyncController', 'AsyncWorker']
+
+
+class _AsyncJobIterator:
+    # iterates over jobs yielded by controller.iter_jobs, each batch of them is fetched in the executor;
+    # it's a class rather than an async generator, which needs Python 3.6
+    def __init__(self, async_controller, batch_size, kwargs):
+        self._async_controller = async_controller
+        self._batch_size = batch_size
+        self._kwargs = kwargs
+        self._jobs = None
+        self._batch = []
+        self._exhausted = False
+
+    def _next_batch(self):
+        if self._jobs is None:
+            self._jobs = self._async_controller._controller.iter_jobs(batch_size=self._batch_size, **self._kwargs)
+        return list(islice(self._jobs, self._batch_size))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch and not self._exhausted:
+            self._batch = await self._async_controller._call(self._next_batch)
+            self._batch.reverse()
+            self._exhausted = len(self._batch) < self._batch_size
+        if not self._batch:
+            raise StopAsyncIteration
+        return self._batch.pop()
+
+
+class AsyncController:
+    # runs blocking controller operations in an executor, so they can be awaited
+    def __init__(self, controller, *, executor=None):
+        self._controller = controller
+        self._executor = executor
+
+    def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def create_job_id(self):
+        return self._controller.create_job_id()
+
+    def queue(self, name):
+        return AsyncController(self._controller.queue(name), executor=self._executor)
+
+    async def close(self):
+        await self._call(self._controller.close)
+
+    async def get_job(self, job_id, **kwargs):
+        return await self._call(self._controller.get_job, job_id, **kwargs)
+
+    async def refresh_job(self, job_id, **kwargs):
+        return await self._call(self._controller.refresh_job, job_id, **kwargs)
+
+    async def refresh_jobs(self, job_ids, **kwargs):
+        return await self._call(self._controller.refresh_jobs, list(job_ids), **kwargs)
+
+    def iter_jobs(self, *, batch_size=1000, **kwargs):
+        # used with `async for`, like controller.iter_jobs
+        return _AsyncJobIterator(self, batch_size, kwargs)
+
+    async def create_job(self, job_id, **kwargs):
+        return await self._call(self._controller.create_job, job_id, **kwargs)
+
+    async def create_jobs(self, specs, **kwargs):
+        return await self._call(self._controller.create_jobs, specs, **kwargs)
+
+    async def cancel_job(self, job_id, version):
+        return await self._call(self._controller.cancel_job, job_id, version)
+
+    async def cancel_jobs(self, **kwargs):
+        return await self._call(self._controller.cancel_jobs, **kwargs)
+
+    async def delete_job(self, job_id, version):
+        return await self._call(self._controller.delete_job, job_id, version)
+
+    async def set_group_limit(self, group, **kwargs):
+        return await self._call(self._controller.set_group_limit, group, **kwargs)
+
+    async def archive_jobs(self, older_than, **kwargs):
+        return await self._call(self._controller.archive_jobs, older_than, **kwargs)
+
+    async def reap_expired_leases(self):
+        return await self._call(self._controller.reap_expired_leases)
+
+    async def acquire_job(self, resources, worker_id):
+        return await self._call(self._controller.acquire_job, resources, worker_id)
+
+    async def acquire_jobs(self, resources, worker_id, max_jobs):
+        return await self._call(self._controller.acquire_jobs, resources, worker_id, max_jobs)
+
+    async def heartbeat_job(self, job_id, version, lease=None):
+        return await self._call(self._controller.heartbeat_job, job_id, version, lease=lease)
+
+    async def heartbeat_jobs(self, jobs):
+        return await self._call(self._controller.heartbeat_jobs, list(jobs))
+
+    async def finalize_job(self, job_id, version, worker_exception=None):
+        return await self._call(self._controller.finalize_job, job_id, version, worker_exception=worker_exception)
+
+    async def finalize_and_acquire(self, job_id, version, worker_exception=None, **kwargs):
+        return await self._call(self._controller.finalize_and_acquire, job_id, version,
+                                worker_exception=worker_exception, **kwargs)
+
+    async def requeue_job(self, job_id, version, run_at=None):
+        return await self._call(self._controller.requeue_job, job_id, version, run_at=run_at)
+
+    async def unlock_job(self, job_id, version):
+        return await self._call(self._controller.unlock_job, job_id, version)
+
+    def add_job_listener(self, listener):
+        # listener is called from the controller's thread
+        return self._controller.add_job_listener(listener)
+
+    def remove_job_listener(self, listener):
+        self._controller.remove_job_listener(listener)
+
+    def add_cancel_listener(self, listener):
+        # listener is called from the controller's thread
+        return self._controller.add_cancel_listener(listener)
+
+    def remove_cancel_listener(self, listener):
+        self._controller.remove_cancel_listener(listener)
+
+
+class AsyncJobChannel(JobChannel):
+    # JobChannel of coroutine jobs, wait_cancelled is awaited instead of blocking the event loop
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        # replaces the threading.Event of the context, JobContext.update only sets it
+        ctx.cancel_event = self._cancel_event = asyncio.Event()
+
+    async def wait_cancelled(self, timeout=None):
+        # the job's task is cancelled soon after the event is set, so this may raise CancelledError instead
+        try:
+            await asyncio.wait_for(self._cancel_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AsyncJobExecution:
+    def __init__(self, func, channel, on_done=None):
+        self._on_done = on_done
+        self.interrupt_requested = False
+        self.interrupted = False
+        self.exc_info = None
+        self._task = asyncio.ensure_future(self._run(func, channel))
+
+    @property
+    def has_failed(self):
+        return self.exc_info is not None
+
+    @property
+    def worker_exception(self):
+        return format_worker_exception(self.exc_info) if self.has_failed else None
+
+    def is_alive(self):
+        return not self._task.done()
+
+    def interrupt(self):
+        if self.interrupt_requested:
+            return False
+        self.interrupt_requested = True
+        return self._task.cancel()
+
+    async def _run(self, func, channel):
+        try:
+            await func(channel)
+        except (InterruptJob, asyncio.CancelledError):
+            self.interrupted = True
+        except _RequeueRequested:
+            pass
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            if self._on_done is not None:
+                self._on_done()
+
+
+class AsyncWorker:
+    # fallback polling interval for controllers which push job notifications, it bounds the delay of jobs
+    # created or requeued by controllers without signals
+    IDLE_POLL_INTERVAL = 5
+    # max number of jobs locked by a single acquire_jobs call
+    ACQUIRE_BATCH = 100
+
+    def __init__(self, id_, resources, worker_func, controller, *, max_jobs=1000, queues=None):
+        self._id = id_
+        self._resources = resources
+        self._worker_func = worker_func
+        # queues of the AsyncController the worker acquires jobs from, see QueueScheduler
+        self._queues = QueueScheduler(controller, queues)
+        self._max_jobs = max_jobs
+        self._loop = None
+
+        # current jobs, job_id -> JobContext
+        self._jobs = {}
+
+        # asyncio events are bound to the loop which is current when they are created (before Python 3.10),
+        # so the wakeup event is created by run()
+        self._stop = threading.Event()
+        self._wakeup = None
+
+        self._acquire_at = 0
+        self._job_available = False
+        self._push_notifications = False
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def is_busy(self):
+        return bool(self._jobs)
+
+    def request_stop(self):
+        self.logger.info('[%s] Got request to stop...', self._id)
+        self._stop.set()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _on_job_available(self, reqs, run_at):
+        # called from the controller's thread
+        self._loop.call_soon_threadsafe(self._notify_job_available, reqs, run_at)
+
+    def _notify_job_available(self, reqs, run_at):
+        if len(self._jobs) >= self._max_jobs:
+            return
+        if not fits_resources(reqs, self._resources.get_current_resources()):
+            return
+
+        delay = 0 if run_at is None else (run_at - datetime.utcnow()).total_seconds()
+        if delay > 0:
+            self._acquire_at = min(self._acquire_at, time.time() + delay)
+        else:
+            self._job_available = True
+            self._wakeup.set()
+
+    def _on_jobs_cancelled(self, worker_id):
+        # called from the controller's thread
+        if worker_id == self._id:
+            self._loop.call_soon_threadsafe(self._notify_jobs_cancelled)
+
+    def _notify_jobs_cancelled(self):
+        # a cheap read tells which of the jobs have been cancelled, their tasks are cancelled then
+        for ctx in self._jobs.values():
+            ctx.check_at = 0
+        self._wakeup.set()
+
+    def _reclaim_resources(self, resources):
+        self._resources.reclaim(resources)
+        self.logger.debug('[%s] Reclaimed resources: %r', self._id, resources)
+
+    def _reset_job(self, ctx):
+        assert not ctx.execution.is_alive()
+
+        self._reclaim_resources(ctx.job.reqs)
+        del self._jobs[ctx.job.id]
+        self._acquire_at = 0
+
+    async def run(self):
+        self.logger.info('[%s] Available resources %r', self._id, self._resources.get_current_resources())
+        self.logger.info('[%s] Starting worker...', self._id)
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._push_notifications = all([controller.add_job_listener(self._on_job_available)
+                                        for controller in self._queues.controllers])
+        for controller in self._queues.controllers:
+            controller.add_cancel_listener(self._on_jobs_cancelled)
+        #
+        retry_delay = 0
+        #
+        try:
+            while True:
+                if self._stop.is_set() and not self._jobs:
+                    break
+
+                if retry_delay:
+                    # aka exponential backoff for retriable errors
+                    await asyncio.sleep(retry_delay)
+
+                self._wakeup.clear()
+                try:
+                    timeout = await self._step()
+                except RetriableError:
+                    retry_delay = 1 if retry_delay == 0 else min(10, retry_delay * 2)
+                else:
+                    retry_delay = 0
+                    if timeout:
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            pass
+        finally:
+            for controller in self._queues.controllers:
+                controller.remove_job_listener(self._on_job_available)
+                controller.remove_cancel_listener(self._on_jobs_cancelled)
+
+    async def _step(self):
+        # heartbeats and checks of all jobs are written and read in batches, then the jobs are requeued
+        # and finalized concurrently
+        await self._try_heartbeat_jobs()
+        results = await asyncio.gather(*[self._process_job(ctx) for ctx in list(self._jobs.values())],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        timeouts = list(results)
+
+        if not self._stop.is_set():
+            timeouts.append(await self._try_acquire_jobs())
+
+        return min((t for t in timeouts if t is not None), default=None)
+
+    async def _process_job(self, ctx):
+        if ctx.outdated:
+            await self._try_update_job(ctx)
+            return 0
+
+        elif ctx.cancelled or ctx.revoked:
+            if ctx.execution.is_alive():
+                if ctx.execution.interrupt():
+                    self.logger.info('[%s] Execution of job %s was interrupted', self._id, ctx.job.id)
+                return math.pi - random.random()
+            self.logger.info('[%s] Processing of job %s was terminated', self._id, ctx.job.id)
+            self._reset_job(ctx)
+            return 0
+
+        elif ctx.execution.is_alive():
+            # see _try_heartbeat_jobs
+            return max(0, ctx.check_at - time.time())
+
+        elif ctx.requeue_requested or ctx.execution.has_failed and ctx.requeue_on_error:
+            await self._try_requeue_job(ctx)
+            return 0
+
+        else:  # coroutine has finished processing the job
+            await self._try_finalize_job(ctx)
+            return 0
+
+    async def _try_acquire_jobs(self):
+        now = time.time()
+        if now < self._acquire_at and not self._job_available:
+            return self._acquire_at - now
+
+        if len(self._jobs) >= self._max_jobs:
+            return None
+
+        self._job_available = False
+        if await self._try_acquire_job_batch(min(self.ACQUIRE_BATCH, self._max_jobs - len(self._jobs))):
+            return 0
+
+        if self._job_available:
+            return 0
+
+        if self._push_notifications:
+            self._acquire_at = now + self.IDLE_POLL_INTERVAL - random.random()
+        else:
+            self._acquire_at = now + math.e - random.random()
+        return self._acquire_at - now
+
+    async def _try_acquire_job_batch(self, max_jobs):
+        resources = self._resources.acquire()
+        acquired = 0
+        for controller in self._queues.order():
+            if acquired == max_jobs:
+                break
+            try:
+                jobs = await controller.acquire_jobs(resources, self._id, max_jobs - acquired)
+            except ConcurrencyError:
+                jobs = []
+            except RetriableError:
+                self._reclaim_resources(resources)
+                raise
+
+            self._queues.acquired(controller, len(jobs))
+            for job in jobs:
+                ctx = JobContext(self.id, job, controller)
+                ctx.schedule_heartbeat(time.time())
+                ctx.execution = AsyncJobExecution(self._worker_func, AsyncJobChannel(ctx), on_done=self._wakeup.set)
+                self._jobs[job.id] = ctx
+                self.logger.info('[%s] Acquired job %s', self._id, job.id)
+                resources = substract_resources(resources, job.reqs)
+            acquired += len(jobs)
+
+        self._reclaim_resources(resources)
+        return acquired
+
+    async def _try_update_job(self, ctx):
+        job = await ctx.controller.refresh_job(ctx.job.id)
+
+        ctx.update(job)
+
+        if ctx.cancelled:
+            self.logger.info('[%s] It seems job %s was cancelled', self._id, ctx.job.id)
+
+        if ctx.revoked:
+            self.logger.info('[%s] It seems job %s was taken from us', self._id, ctx.job.id)
+
+    async def _try_heartbeat_jobs(self):
+        # running jobs due for a heartbeat or a check take one heartbeat_jobs and one refresh_jobs call per queue,
+        # so thousands of jobs don't take thousands of executor threads
+        now = time.time()
+        running = [ctx for ctx in self._jobs.values()
+                   if not (ctx.outdated or ctx.cancelled or ctx.revoked) and ctx.execution.is_alive()]
+        heartbeats = {}  # controller -> [jobs to heartbeat]
+        for ctx in running:
+            if now >= ctx.heartbeat_at:
+                heartbeats.setdefault(ctx.controller, []).append(ctx)
+
+        checks = {}  # controller -> [jobs to check]
+        for ctx in running:
+            if now >= ctx.heartbeat_at:
+                continue
+            if ctx.controller in heartbeats and ctx.heartbeat_at - now <= self._heartbeat_slack(ctx):
+                # heartbeats are jittered, jobs which are almost due join the batch instead of taking their own
+                heartbeats[ctx.controller].append(ctx)
+            elif now >= ctx.check_at:
+                checks.setdefault(ctx.controller, []).append(ctx)
+
+        calls = [self._try_heartbeat_batch(controller, ctxs, now) for controller, ctxs in heartbeats.items()]
+        calls += [self._try_check_batch(controller, ctxs, now) for controller, ctxs in checks.items()]
+        await asyncio.gather(*calls)
+
+    @staticmethod
+    def _heartbeat_slack(ctx):
+        # the jitter of JobContext.schedule_heartbeat
+        return math.pi if ctx.job.lease is None else ctx.job.lease / 12
+
+    async def _try_heartbeat_batch(self, controller, ctxs, now):
+        jobs = await controller.heartbeat_jobs([(ctx.job.id, ctx.job.version, ctx.job.lease) for ctx in ctxs])
+        for ctx, job in zip(ctxs, jobs):
+            if job:
+                ctx.update(job)
+                ctx.schedule_heartbeat(now)
+            else:
+                ctx.outdated = True
+                self.logger.info('[%s] Failed to heartbeat job %s due to version mismatch', self._id, ctx.job.id)
+
+    async def _try_check_batch(self, controller, ctxs, now):
+        jobs = await controller.refresh_jobs([ctx.job.id for ctx in ctxs], fields=Job.STATE_FIELDS)
+        for ctx, job in zip(ctxs, jobs):
+            if job is None or job.version != ctx.job.version:
+                ctx.outdated = True
+            else:
+                ctx.check_at = min(ctx.heartbeat_at, now + math.pi - random.random())
+
+    async def _try_requeue_job(self, ctx):
+        try:
+            await ctx.controller.requeue_job(ctx.job.id, ctx.job.version, run_at=ctx.requeue_run_at)
+        except ConcurrencyError:
+            ctx.outdated = True
+            self.logger.info('[%s] Failed to requeue job %s due to version mismatch', self._id, ctx.job.id)
+        else:
+            self.logger.info('[%s] Job %s has been requeued', self._id, ctx.job.id)
+            self._reset_job(ctx)
+
+    async def _try_finalize_job(self, ctx):
+        try:
+            job = await ctx.controller.finalize_job(ctx.job.id, ctx.job.version,
+                                                    worker_exception=ctx.execution.worker_exception)
+        except ConcurrencyError:
+            job = None
+
+        if job:
+            self.logger.info('[%s] Job %s has been processed', self._id, ctx.job.id)
+            self._reset_job(ctx)
+        else:
+            ctx.outdated = True
+            self.logger.info('[%s] Failed to mark job %s as completed due to version mismatch',
+                             self._id, ctx.job.id)
@@ -1,36 +1,123 @@
 class Job:
+    BLOCKED = 'blocked'  # waits for its dependencies
     IDLE = 'idle'
     LOCKED = 'locked'
     CANCELLED = 'cancelled'
     COMPLETED = 'completed'
 
+    # what happens to a blocked job when one of its dependencies fails or is cancelled
+    ON_FAILURE_CANCEL = 'cancel'
+    ON_FAILURE_RUN = 'run'
+
+    FIELDS = ('reqs', 'args', 'version', 'priority', 'status', 'created_at', 'locked_at', 'completed_at',
+              'run_at', 'lease', 'lease_expires_at', 'depends_on', 'pending_deps', 'group',
+              'worker_id', 'worker_heartbeat', 'worker_exception')
+    # fields returned by state transitions (heartbeat, finalize, requeue, cancel)
+    STATE_FIELDS = ('version', 'status', 'worker_id')
+
+    # millions of jobs may be scanned by iter_jobs, slots keep them compact
+    __slots__ = ('id', '_loader') + FIELDS
+
     def __init__(self, id_, reqs, args, version, *,
+                 priority=0,
                  status=None,
                  created_at=None,
                  locked_at=None,
                  completed_at=None,
                  run_at=None,
+                 lease=None,
+                 lease_expires_at=None,
+                 depends_on=None,
+                 pending_deps=0,
+                 group=None,
                  worker_id=None,
                  worker_heartbeat=None,
                  worker_exception=None):
         self.id = id_
+        self._loader = None
         self.reqs = reqs
         self.args = args
         self.version = version
+        self.priority = priority
         self.status = status or Job.IDLE
         self.created_at = created_at
         self.locked_at = locked_at
         self.completed_at = completed_at
         self.run_at = run_at
+        self.lease = lease  # seconds
+        self.lease_expires_at = lease_expires_at
+        self.depends_on = depends_on or []
+        self.pending_deps = pending_deps
+        self.group = group
         self.worker_id = worker_id
         self.worker_heartbeat = worker_heartbeat
         self.worker_exception = worker_exception
 
+    @classmethod
+    def partial(cls, id_, loader=None, **fields):
+        # job with only some of the fields, the rest are fetched by loader(job_id) on first access
+        job = cls.__new__(cls)
+        job.id = id_
+        job._loader = loader
+        for name, value in fields.items():
+            setattr(job, name, value)
+        return job
+
+    def __getattr__(self, name):
+        # only called for fields missing in partial jobs
+        if name not in Job.FIELDS or self._loader is None:
+            raise AttributeError(name)
+
+        job = self._loader(self.id)
+        if job is None:
+            raise AttributeError('job {} does not exist anymore'.format(self.id))
+        for field in self.missing_fields:
+            setattr(self, field, getattr(job, field))
+        self._loader = None
+        return getattr(self, name)
+
+    def _present_fields(self):
+        # name -> value of the fields which are set, without loading the missing ones
+        result = {}
+        for name in Job.FIELDS:
+            try:
+                result[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return result
+
+    def __getstate__(self):
+        # loader is bound to the controller, which can't be sent to other processes
+        return dict(self._present_fields(), id=self.id)
+
+    def __setstate__(self, state):
+        self._loader = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def missing_fields(self):
+        present = self._present_fields()
+        return [name for name in Job.FIELDS if name not in present]
+
+    def merged(self, job):
+        # copy of this job updated with the fields present in (possibly partial) job
+        fields = self._present_fields()
+        fields.update(job._present_fields())
+        return Job.partial(self.id, self._loader, **fields)
+
     @property
     def failed(self):
         return self.worker_exception is not None
 
 
+class BulkCreateResult:
+    def __init__(self):
+        self.created = []
+        self.existing = []
+        self.failed = {}  # job_id -> error message
+
+
 class RetriableError(Exception):
     pass
 
@@ -40,28 +127,127 @@ class ConcurrencyError(Exception):
 
 
 class IJobController:
-    def get_job(self, job_id):
+    def create_job_id(self):
+        pass
+
+    def close(self):
+        pass
+
+    def queue(self, name):
+        # controller of the named queue, jobs of different queues don't share anything but the connection;
+        # None is the default queue
+        pass
+
+    def get_job(self, job_id, *, include_archived=False, fields=None):
+        # with fields returns a partial job
         pass
 
-    def create_job(self, job_id, *, reqs=None, args=None, run_at=None):
+    def iter_jobs(self, *, status=None, worker_id=None, created_before=None, fields=None, batch_size=1000):
+        # yields jobs matching all given filters, status may also be a list of statuses,
+        # with fields only these fields are fetched and the others are missing in yielded jobs
+        pass
+
+    def create_job(self, job_id, *, reqs=None, args=None, run_at=None, priority=0, lease=None,
+                   depends_on=None, on_dependency_failure=Job.ON_FAILURE_CANCEL, group=None):
+        # lease is how many seconds a lock lasts without heartbeats, HEARTBEAT_TIMEOUT of the controller by default;
+        # a job with depends_on (ids of jobs created before it) stays BLOCKED until all of them are finished,
+        # a failed or cancelled dependency cancels it (and its dependents) or is treated as done (ON_FAILURE_RUN);
+        # jobs of a group (e.g. a tenant) share the limits set by set_group_limit
+        pass
+
+    def create_jobs(self, specs, *, batch_size=1000):
         pass
 
     def cancel_job(self, job_id, version):
         pass
 
+    def cancel_jobs(self, *, job_ids=None, status=None, worker_id=None, group=None, created_before=None):
+        # cancels unfinished jobs matching all given filters (like iter_jobs) whatever their versions are,
+        # returns the number of cancelled jobs; workers holding them are notified (see add_cancel_listener)
+        pass
+
     def delete_job(self, job_id, version):
         pass
 
+    def set_group_limit(self, group, *, max_locked=None, weight=1):
+        # at most max_locked jobs of the group are LOCKED at once (None is unlimited), groups with available jobs
+        # are served in proportion to their weights; the limit applies to jobs locked after it has been set
+        pass
+
+    def reap_expired_leases(self):
+        # returns the number of LOCKED jobs with expired lease_expires_at which were put back to IDLE,
+        # also repairs bookkeeping (e.g. group slots, dependents left BLOCKED) left inconsistent by clients
+        # which have failed midway
+        pass
+
+    def archive_jobs(self, older_than, *, batch_size=1000):
+        # moves COMPLETED and CANCELLED jobs finished more than older_than (timedelta) ago to the archive,
+        # returns the number of archived jobs
+        pass
+
 
 class IWorkerController:
     def acquire_job(self, resources, worker_id):
         pass
 
-    def heartbeat_job(self, job_id, version):
+    def acquire_jobs(self, resources, worker_id, max_jobs):
+        # locks up to max_jobs jobs which fit into resources all together, resources may also be a list
+        # (e.g. of several workers) and then every job fits into one of them; max_jobs may then be a list
+        # too, of how many jobs may be fitted into each of them
+        pass
+
+    def refresh_job(self, job_id, *, fields=None):
+        # get_job for the worker holding the job, it always sees the latest state of the job
+        # (unlike get_job of a controller reading from secondaries)
+        return self.get_job(job_id, fields=fields)
+
+    def refresh_jobs(self, job_ids, *, fields=None):
+        # returns what refresh_job would for each of the jobs in the same order
+        return [self.refresh_job(job_id, fields=fields) for job_id in job_ids]
+
+    def heartbeat_job(self, job_id, version, lease=None):
+        # extends the lock for lease seconds (which become the job's lease) or for HEARTBEAT_TIMEOUT if not given
         pass
 
+    def heartbeat_jobs(self, jobs):
+        # jobs is a list of (job_id, version, lease), returns what heartbeat_job would for each of them
+        # in the same order, None instead of raising ConcurrencyError
+        result = []
+        for job_id, version, lease in jobs:
+            try:
+                result.append(self.heartbeat_job(job_id, version, lease=lease))
+            except ConcurrencyError:
+                result.append(None)
+        return result
+
     def finalize_job(self, job_id, version, worker_exception=None):
         pass
 
+    def finalize_and_acquire(self, job_id, version, worker_exception=None, *, resources, worker_id, max_jobs=1):
+        # finalize_job followed by acquire_jobs in one call, returns (finalized job, acquired jobs);
+        # nothing is acquired if the job can't be finalized
+        job = self.finalize_job(job_id, version, worker_exception=worker_exception)
+        return job, self.acquire_jobs(resources, worker_id, max_jobs)
+
     def requeue_job(self, job_id, version, run_at=None):
         pass
+
+    def unlock_job(self, job_id, version):
+        # puts back a job which has been acquired but hasn't run, unlike requeue_job it keeps its place in the queue
+        return self.requeue_job(job_id, version)
+
+    def add_job_listener(self, listener):
+        # listener(reqs, run_at) is called when a job with given requirements may become available,
+        # returns False if the controller can't push such notifications
+        return False
+
+    def remove_job_listener(self, listener):
+        pass
+
+    def add_cancel_listener(self, listener):
+        # listener(worker_id) is called when some jobs locked by the worker may have been cancelled,
+        # returns False if the controller can't push such notifications
+        return False
+
+    def remove_cancel_listener(self, listener):
+        pass
@@ -1,27 +1,253 @@
+import json
+import os
+import random
 import sys
+import threading
+import time
 
 from datetime import datetime, timedelta
+from itertools import islice
 from uuid import uuid4
 
 import pymongo
 
 from .api import (
-    Job, IJobController, IWorkerController,
+    Job, BulkCreateResult, IJobController, IWorkerController,
     RetriableError, ConcurrencyError
 )
+from .metrics import instrumented
+from .policy import FirstFit
 
 
 __all__ = ['Controller']
 
 
+DUPLICATE_KEY_ERROR = 11000
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def _req_class(reqs):
+    # canonical representation of job requirements, jobs are indexed by it
+    return json.dumps(sorted(reqs.items()), separators=(',', ':'))
+
+
+def _first_fit(reqs, bins):
+    # index of the first resources the requirements fit into, None if there is no such one;
+    # None bins are skipped, they have got as many jobs as they may take
+    for i, resources in enumerate(bins):
+        if resources is not None and all(k in resources and v <= resources[k] for k, v in reqs.items()):
+            return i
+    return None
+
+
+def _job_limits(bins, max_jobs):
+    # max_jobs limits the number of jobs in total, or of jobs fitted into each of the bins if it's a list
+    if isinstance(max_jobs, list):
+        return list(max_jobs), sum(max_jobs)
+    return [max_jobs] * len(bins), max_jobs
+
+
+def _fit(reqs, left, limits):
+    # puts the job into the first of the bins it fits into, returns the index of the bin or None
+    i = _first_fit(reqs, left)
+    if i is not None:
+        for k, v in reqs.items():
+            left[i][k] -= v
+        limits[i] -= 1
+        if limits[i] <= 0:
+            left[i] = None
+    return i
+
+
+def _reqs_from_class(req_class):
+    return dict(json.loads(req_class))
+
+
+class _SharedClient:
+    # one connection pool per database URI per process, shared by all controllers and their queues
+    def __init__(self, client):
+        self.client = client
+        self.refs = 0
+        self.lock = threading.Lock()
+        self.indexed = set()  # collections whose indexes have been ensured through this client
+
+
+_clients = {}  # (pid, db_uri) -> _SharedClient
+_clients_lock = threading.Lock()
+
+
+def _acquire_client(db_uri, create_client):
+    # forked processes get clients of their own, pymongo clients are not fork-safe
+    key = (os.getpid(), db_uri)
+    with _clients_lock:
+        shared = _clients.get(key)
+        if shared is None:
+            shared = _clients[key] = _SharedClient(create_client(db_uri))
+        shared.refs += 1
+    return shared
+
+
+def _release_client(db_uri, shared):
+    with _clients_lock:
+        shared.refs -= 1
+        if shared.refs > 0:
+            return
+        _clients.pop((os.getpid(), db_uri), None)
+    shared.client.close()
+
+
+class _SignalWatcher(threading.Thread):
+    # how long the server waits for new signals before answering a getMore of the tailable cursor, so idle
+    # watchers don't poll it every second; same as the fallback polling of workers, see Worker.IDLE_POLL_INTERVAL
+    MAX_AWAIT_TIME = 5  # seconds
+
+    def __init__(self, signals, on_signal, ensure_signals):
+        super(_SignalWatcher, self).__init__()
+        self.daemon = True
+        self._signals = signals
+        self._ensure_signals = ensure_signals  # creates the capped collection if it hasn't been yet
+        self._on_signal = on_signal  # receives raw signal documents
+        self._listeners = []
+        self._cancel_listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def add_cancel_listener(self, listener):
+        with self._lock:
+            self._cancel_listeners.append(listener)
+
+    def remove_cancel_listener(self, listener):
+        with self._lock:
+            self._cancel_listeners.remove(listener)
+
+    def stop(self):
+        self._stop.set()
+
+    def _notify(self, doc):
+        self._on_signal(doc)
+        with self._lock:
+            listeners = list(self._listeners)
+            cancel_listeners = list(self._cancel_listeners)
+        for reqs in doc.get('reqs', []):
+            for listener in listeners:
+                listener(reqs, doc.get('run_at'))
+        for worker_id in doc.get('cancelled', []):
+            for listener in cancel_listeners:
+                listener(worker_id)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self._ensure_signals()
+                # signals which are already in the collection are delivered again after a restart,
+                # this only causes a spurious wakeup
+                cursor = self._signals.find(cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+                cursor.max_await_time_ms(int(self.MAX_AWAIT_TIME * 1000))
+                while cursor.alive and not self._stop.is_set():
+                    for doc in cursor:
+                        self._notify(doc)
+            except pymongo.errors.PyMongoError:
+                pass
+            self._stop.wait(1)
+
+
 class Controller(IJobController, IWorkerController):
+    # classes of writes which may get a write concern of their own, see write_concerns
+    WRITE_OPERATIONS = ('create', 'lock', 'heartbeat', 'finalize', 'requeue', 'cancel')
+
     HEARTBEAT_TIMEOUT = timedelta(minutes=10)
+    SIGNALS_SIZE = 1024 * 1024
+    SIGNALS_MAX = 10000
+    REQ_CLASSES_TTL = 2  # seconds
+    # classes are refreshed by loading the ones used since the last refresh, and reloaded entirely this often
+    # to forget dropped ones; CLOCK_SKEW covers differences between clocks of clients writing used_at
+    REQ_CLASSES_RELOAD_TTL = 600  # seconds
+    CLOCK_SKEW = timedelta(minutes=1)
+    # classes no job has been created with for this long are dropped by the reaper once they have no unfinished jobs
+    REQ_CLASS_EXPIRY = timedelta(days=1)
+    # how long an acquisition may hold reserved group slots before the reaper takes them back
+    RESERVATION_TIMEOUT = timedelta(minutes=1)
+    # how many candidates acquire_jobs considers for each requested job
+    CANDIDATES_PER_JOB = 4
 
-    def __init__(self, db_uri, col_name='jobs'):
+    def __init__(self, db_uri, col_name='jobs', *, queue=None, signals=False, reacquire_locked=True, metrics=None,
+                 policy=None, write_concerns=None, read_preference=None, ensure_indexes=True):
         self._validate_db_uri(db_uri)
-        self._client = self._create_mongo_client(db_uri)
+        unknown = set(write_concerns or {}) - set(self.WRITE_OPERATIONS)
+        if unknown:
+            raise ValueError('unknown write operations: {}'.format(', '.join(sorted(unknown))))
+        self._db_uri = db_uri
+        self._base_col_name = col_name
+        self._options = {'signals': signals, 'reacquire_locked': reacquire_locked, 'metrics': metrics,
+                         'policy': policy, 'write_concerns': write_concerns,
+                         'read_preference': read_preference, 'ensure_indexes': ensure_indexes}
+        # named queues live in collections of their own, so they can be sharded and indexed independently
+        self._queue = queue
+        self._queues = {}  # name -> Controller, see queue()
+        self._queues_lock = threading.Lock()
+        if queue is not None:
+            col_name = '{}.q.{}'.format(col_name, queue)
+
+        self._shared = _acquire_client(db_uri, self._create_mongo_client)
+        self._client = self._shared.client
         self._jobs = self._client.get_default_database()[col_name]
-        self._ensure_indexes()
+        self._archive = self._client.get_default_database()[col_name + '.archive']
+        self._groups = self._client.get_default_database()[col_name + '.groups']
+        # requirement classes of recently created or unfinished jobs, it stays small while the backlog grows
+        self._classes = self._client.get_default_database()[col_name + '.classes']
+        # indexes are created by the first call which needs them, once per process and collection, or never
+        # if they are managed separately (see ensure_indexes and `python -m terry ensure-indexes`)
+        self._indexes_ensured = not ensure_indexes
+
+        # writes of the given classes (operation -> pymongo.WriteConcern) are acknowledged differently than
+        # majority-journaled, get_job and iter_jobs (but not refresh_job) may read with another pymongo.ReadPreference
+        self._writes = {op: self._jobs.with_options(write_concern=wc) for op, wc in (write_concerns or {}).items()}
+        self._reads, self._archive_reads = self._jobs, self._archive
+        if read_preference is not None:
+            self._reads = self._jobs.with_options(read_preference=read_preference)
+            self._archive_reads = self._archive.with_options(read_preference=read_preference)
+
+        # without it expired jobs are only put back to IDLE by reap_expired_leases (see LeaseReaper)
+        self._reacquire_locked = reacquire_locked
+        # optional IMetrics receiving latency and errors of the public methods
+        self._metrics = metrics
+        # which of the fitting jobs are acquired first, see terry.policy
+        self._policy = policy or FirstFit()
+
+        # known requirement classes, when they have been loaded and when they have to be refreshed or reloaded,
+        # and classes which are known to be in the classes collection
+        self._req_classes = {}  # class -> reqs
+        self._req_classes_loaded_at = None
+        self._req_classes_expire_at = 0
+        self._req_classes_reload_at = 0
+        self._ensured_classes = {}  # class -> time when its used_at has to be bumped again
+
+        # known job groups (group -> document with weight, max_locked and free slots) refreshed like classes,
+        # and groups which had no fitting jobs for given classes since the last refresh
+        self._group_docs = {}
+        self._group_docs_expire_at = 0
+        self._empty_groups = {}  # group -> set of classes
+        self._ensured_groups = set()
+
+        # the capped collection of signals is created by the first signal or listener, not here,
+        # so constructing a controller takes no round trips
+        self._signals = None
+        self._signals_ensured = False
+        self._signal_watcher = None
+        self._signal_watcher_lock = threading.Lock()
+        if signals:
+            # signals are only hints for idle workers, polling covers the lost ones
+            self._signals = self._client.get_default_database()[col_name + '.signals'].with_options(
+                write_concern=pymongo.WriteConcern(w=1))
+        self._closed = False
 
     def _create_mongo_client(self, db_uri):
         kwargs = {'socketTimeoutMS': 10000,
@@ -39,20 +265,332 @@ class Controller(IJobController, IWorkerController):
         if res['database'] is None:
             raise Exception('You should explicitly specify database')
 
-    def _ensure_indexes(self):
+    def _ensure_indexes_once(self):
+        if self._indexes_ensured:
+            return
+        with self._shared.lock:
+            if self._jobs.full_name not in self._shared.indexed:
+                try:
+                    self.ensure_indexes()
+                except pymongo.errors.PyMongoError:
+                    self._raise_retriable_error('create_indexes')
+                self._shared.indexed.add(self._jobs.full_name)
+        self._indexes_ensured = True
+
+    def ensure_indexes(self):
+        # creates or updates indexes of the collections, it's safe to call it any number of times
         def idx(*args, **kwargs):
-            keys = [(field, pymongo.ASCENDING) for field in args]
+            keys = [field if isinstance(field, tuple) else (field, pymongo.ASCENDING) for field in args]
             return pymongo.IndexModel(keys, **kwargs)
 
         self._jobs.create_indexes([idx('job_id', unique=True),
                                    idx('job_id', 'version'),
-                                   idx('status', 'run_at'),
-                                   idx('status', 'worker_heartbeat')])
+                                   idx('status', 'meta.rclass', 'group', ('priority', pymongo.DESCENDING),
+                                       'meta.ready_at'),
+                                   idx('status', 'lease_expires_at'),
+                                   # the reaper's repairs of dependencies, see _repair_dependencies; the indexes only
+                                   # hold jobs with unresolved dependents and BLOCKED jobs
+                                   idx('status', 'meta.unresolved', partialFilterExpression={'meta.unresolved': True}),
+                                   idx('status', 'pending_deps', partialFilterExpression={'status': Job.BLOCKED})])
+        self._archive.create_indexes([idx('job_id', unique=True)])
+        # refreshes of requirement classes, see _fitting_req_classes
+        self._classes.create_indexes([idx('used_at')])
+        try:
+            # only finished jobs have completed_at, so the same index serves both archive_jobs and TTL expiration
+            self._jobs.create_index('completed_at')
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # ok, it has a TTL, see set_retention
+
+    def set_retention(self, retention):
+        # finished jobs are removed by MongoDB `retention` (timedelta) after completion, or kept if it's None;
+        # it's a setting of the collection made by an administrator (see `python -m terry ensure-indexes`)
+        # rather than by every controller, so controllers can't overwrite each other's TTL
+        if retention is None:
+            self._jobs.drop_index([('completed_at', pymongo.ASCENDING)])
+            self._jobs.create_index('completed_at')
+            return
+
+        ttl = int(retention.total_seconds())
+        try:
+            self._jobs.create_index('completed_at', expireAfterSeconds=ttl)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # index exists with another (or without) TTL
+            self._jobs.database.command('collMod', self._jobs.name,
+                                        index={'keyPattern': {'completed_at': 1}, 'expireAfterSeconds': ttl})
+
+    def migrate(self, *, batch_size=1000):
+        # brings jobs created by older versions up to date, so they are acquired like new ones; it's run by an
+        # administrator (see `python -m terry migrate`) any number of times, returns the number of updated jobs
+        query = {'$or': [{field: {'$exists': False}} for field in ('priority', 'group', 'meta.rclass',
+                                                                   'meta.ready_at')]}
+        projection = {'reqs': True, 'run_at': True, 'created_at': True, 'priority': True, 'group': True,
+                      'meta': True}
+        migrated = 0
+        try:
+            cursor = self._jobs.find(query, projection=projection, batch_size=batch_size)
+            while True:
+                requests = []
+                for doc in islice(cursor, batch_size):
+                    meta = doc.get('meta') or {}
+                    fields = {}
+                    if 'priority' not in doc:
+                        fields['priority'] = 0
+                    if 'group' not in doc:
+                        fields['group'] = None
+                    if 'rclass' not in meta:
+                        fields['meta.rclass'] = _req_class(doc.get('reqs') or {})
+                    if 'ready_at' not in meta:
+                        fields['meta.ready_at'] = doc.get('run_at') or doc.get('created_at') or datetime.utcnow()
+                    requests.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+                if not requests:
+                    break
+                migrated += self._jobs.bulk_write(requests, ordered=False).modified_count
+
+            # jobs locked by older workers have no lease and would never be reaped, they expire HEARTBEAT_TIMEOUT
+            # after their last heartbeat (so older workers should be stopped by now, or their jobs are reaped)
+            cursor = self._jobs.find({'status': Job.LOCKED, 'lease_expires_at': None},
+                                     projection={'worker_heartbeat': True, 'locked_at': True}, batch_size=batch_size)
+            while True:
+                requests = []
+                for doc in islice(cursor, batch_size):
+                    heartbeat = doc.get('worker_heartbeat') or doc.get('locked_at') or datetime.utcnow()
+                    update = {'$set': {'lease_expires_at': heartbeat + self.HEARTBEAT_TIMEOUT}}
+                    requests.append(pymongo.UpdateOne({'_id': doc['_id'], 'status': Job.LOCKED,
+                                                       'lease_expires_at': None}, update))
+                if not requests:
+                    break
+                migrated += self._jobs.bulk_write(requests, ordered=False).modified_count
+
+            # dependents of unfinished jobs are resolved by the reaper if their client fails midway
+            migrated += self._jobs.update_many({'status': {'$nin': [Job.COMPLETED, Job.CANCELLED]},
+                                                'meta.dependents.0': {'$exists': True},
+                                                'meta.unresolved': {'$exists': False}},
+                                               {'$set': {'meta.unresolved': True}}).modified_count
+
+            # classes of jobs which were created before the classes collection
+            classes = self._jobs.distinct('meta.rclass', {'status': {'$in': [Job.IDLE, Job.LOCKED, Job.BLOCKED]}})
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('bulk_write')
+
+        self._ensure_req_classes(classes)
+        return migrated
+
+    def _ensure_signals_once(self):
+        # raises pymongo errors, an insert into a missing collection would create one which isn't capped
+        if self._signals_ensured:
+            return
+        db = self._client.get_default_database()
+        try:
+            db.create_collection(self._signals.name, capped=True, size=self.SIGNALS_SIZE, max=self.SIGNALS_MAX)
+        except pymongo.errors.CollectionInvalid:
+            pass  # ok, collection already exists
+        else:
+            # tailable cursors die immediately on empty collections
+            self._signals.insert_one({'reqs': []})
+        self._signals_ensured = True
+
+    def _signal(self, reqs, run_at=None, groups=(), cancelled=()):
+        # cancelled are ids of workers whose jobs have been cancelled
+        if self._signals is None:
+            return
+        try:
+            self._ensure_signals_once()
+            self._signals.insert_one({'reqs': reqs, 'run_at': run_at, 'groups': [g for g in groups if g is not None],
+                                      'cancelled': list(cancelled)})
+        except pymongo.errors.PyMongoError:
+            pass
+
+    def _fitting_req_classes(self, bins):
+        if time.time() >= self._req_classes_expire_at:
+            now = datetime.utcnow()
+            reload = time.time() >= self._req_classes_reload_at
+            # follows the used_at index, classes used before the last load are known already
+            query = {} if reload else {'used_at': {'$gte': self._req_classes_loaded_at - self.CLOCK_SKEW}}
+            try:
+                classes = [doc['_id'] for doc in self._classes.find(query, projection={'_id': True})]
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('find')
+            if reload:
+                self._req_classes = {}
+                self._req_classes_reload_at = time.time() + self.REQ_CLASSES_RELOAD_TTL
+            self._req_classes.update((c, _reqs_from_class(c)) for c in classes)
+            self._req_classes_loaded_at = now
+            self._req_classes_expire_at = time.time() + self.REQ_CLASSES_TTL
+
+        return [c for c, reqs in list(self._req_classes.items()) if _first_fit(reqs, bins) is not None]
+
+    def _add_req_class(self, reqs, group=None):
+        self._req_classes[_req_class(reqs)] = reqs
+        self._add_group(group)
+
+    def _add_group(self, group):
+        self._empty_groups.pop(group, None)
+        if group is not None and group not in self._group_docs:
+            # limits of the new group have to be known before its jobs are acquired
+            self._group_docs_expire_at = 0
+
+    def _on_signal(self, doc):
+        for reqs in doc.get('reqs', []):
+            self._add_req_class(reqs)
+        for group in doc.get('groups', []):
+            self._add_group(group)
+
+    def _group_order(self):
+        # weighted lottery: each group comes first with probability proportional to its weight,
+        # groups without jobs are probed at most once per refresh (see _mark_empty_group)
+        if time.time() >= self._group_docs_expire_at:
+            try:
+                docs = list(self._groups.find())
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('find')
+            self._group_docs = {doc.pop('_id'): doc for doc in docs}
+            self._empty_groups = {}
+            self._group_docs_expire_at = time.time() + self.REQ_CLASSES_TTL
+
+        docs = dict(self._group_docs)
+        docs.setdefault(None, {})  # jobs without a group
+        keys = []
+        for group, doc in docs.items():
+            weight = doc.get('weight', 1)
+            if weight > 0 and (doc.get('free') is None or doc['free'] > 0):
+                keys.append((random.random() ** (1.0 / weight), group))
+        keys.sort(key=lambda key: key[0], reverse=True)
+        return [group for _, group in keys]
+
+    def _is_empty_group(self, group, classes):
+        return set(classes) <= self._empty_groups.get(group, set())
+
+    def _mark_empty_group(self, group, classes):
+        self._empty_groups.setdefault(group, set()).update(classes)
+
+    def _reserve_slots(self, group, n, token):
+        # returns how many of up to n slots were reserved in the group, None if the group is unlimited;
+        # the reservation stays in the group document until _finish_reservation, see _reconcile_slots
+        doc = self._group_docs.get(group)
+        if doc is None or doc.get('free') is None:
+            return None
+
+        r = None
+        for k in sorted({max(1, min(n, doc['free'])), 1}, reverse=True):
+            reservation = {'token': token, 'slots': k, 'at': datetime.utcnow()}
+            try:
+                r = self._groups.find_one_and_update({'_id': group, 'free': {'$gte': k}},
+                                                     {'$inc': {'free': -k}, '$push': {'reservations': reservation}},
+                                                     return_document=pymongo.collection.ReturnDocument.AFTER)
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('find_one_and_update')
+            if r is not None:
+                doc['free'] = r['free']
+                return k
+
+        doc['free'] = 0  # skipped until the next refresh
+        return 0
+
+    def _finish_reservation(self, group, token, unused):
+        # slots of locked jobs are held by the jobs from now on, unused ones are given back
+        try:
+            self._groups.update_one({'_id': group, 'reservations.token': token},
+                                    {'$inc': {'free': unused}, '$pull': {'reservations': {'token': token}}})
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('update_one')
+
+    def _release_slots(self, group, n):
+        if n <= 0:
+            return
+        try:
+            # the limit may have been removed in the meantime
+            self._groups.update_one({'_id': group, 'free': {'$type': 'number'}}, {'$inc': {'free': n}})
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('update_one')
+
+    def _release_held_slots(self, group, n):
+        # slots of jobs whose state change has already been applied, the caller must not see it as failed
+        try:
+            self._release_slots(group, n)
+        except RetriableError:
+            pass  # recounted by _reconcile_slots
+
+    def _reconcile_slots(self):
+        # free counters drift if a client dies or fails to reach the database between reserving a slot and
+        # locking a job (or between unlocking a job and giving its slot back), so they are recounted from jobs
+        # holding slots and reservations of acquisitions in progress. Reservations older than RESERVATION_TIMEOUT
+        # are of clients which have failed and are dropped. Groups whose counter or reservations change in the
+        # meantime are left for the next time; a job locked under a reservation which is still there is counted
+        # twice, which only keeps a slot unused until then
+        limits = list(self._groups.find({'max_locked': {'$type': 'number'}}))
+        if not limits:
+            return
+        locked = {r['_id']: r['locked'] for r in self._jobs.aggregate([
+            {'$match': {'status': Job.LOCKED, 'meta.slot': True}},
+            {'$group': {'_id': '$group', 'locked': {'$sum': 1}}}])}
+        expired = datetime.utcnow() - self.RESERVATION_TIMEOUT
+        for doc in limits:
+            reservations = doc.get('reservations', [])
+            active = [reservation for reservation in reservations if reservation['at'] >= expired]
+            free = doc['max_locked'] - locked.get(doc['_id'], 0) - sum(r['slots'] for r in active)
+            if free != doc['free'] or len(active) != len(reservations):
+                query = {'_id': doc['_id'], 'max_locked': doc['max_locked'], 'free': doc['free'],
+                         'reservations': reservations if 'reservations' in doc else {'$exists': False}}
+                self._groups.update_one(query, {'$set': {'free': free, 'reservations': active}})
+
+    def _ensure_req_classes(self, classes):
+        # jobs are found by acquisition through the documents of their classes, so they are written first;
+        # used_at is bumped well before REQ_CLASS_EXPIRY, so the reaper doesn't drop classes being used
+        for rclass in classes:
+            if time.time() < self._ensured_classes.get(rclass, 0):
+                continue
+            now = datetime.utcnow()
+            try:
+                self._classes.update_one({'_id': rclass},
+                                         {'$set': {'used_at': now}, '$setOnInsert': {'created_at': now}},
+                                         upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                pass  # ok, created concurrently
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('update_one')
+            self._ensured_classes[rclass] = time.time() + self.REQ_CLASS_EXPIRY.total_seconds() / 2
+
+    def _drop_unused_req_classes(self):
+        # raises pymongo errors; classes stay while they have unfinished jobs, and a class used concurrently
+        # has a new used_at, so it isn't deleted
+        expired = datetime.utcnow() - self.REQ_CLASS_EXPIRY
+        query = {'$or': [{'used_at': {'$lt': expired}},
+                         {'used_at': {'$exists': False}, 'created_at': {'$lt': expired}}]}
+        for doc in list(self._classes.find(query, projection={'used_at': True})):
+            if self._jobs.find_one({'status': {'$in': [Job.IDLE, Job.LOCKED, Job.BLOCKED]},
+                                    'meta.rclass': doc['_id']}, projection={'_id': True}) is None:
+                self._classes.delete_one({'_id': doc['_id'], 'used_at': doc.get('used_at')})
+
+    def _ensure_groups(self, groups):
+        # groups are found by acquisition through their documents
+        for group in groups:
+            if group is None or group in self._group_docs or group in self._ensured_groups:
+                continue
+            try:
+                self._groups.update_one({'_id': group},
+                                        {'$setOnInsert': {'weight': 1, 'max_locked': None, 'free': None}},
+                                        upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                pass  # ok, created concurrently
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('update_one')
+            self._ensured_groups.add(group)
 
     def _job_from_doc(self, doc):
-        doc.pop('meta')
+        doc.pop('meta', None)
         return Job(doc.pop('job_id'), **doc)
 
+    def _scanned_job_from_doc(self, doc):
+        # no loader, otherwise accessing a field which was not asked for would cost a query per job
+        return Job.partial(doc.pop('job_id'), **doc)
+
+    def _partial_job_from_doc(self, doc):
+        return Job.partial(doc.pop('job_id'), self._load_job, **doc)
+
     def _raise_retriable_error(self, method):
         exc_type, _, _ = sys.exc_info()
         assert exc_type is not None  # should be called from the exception handler
@@ -66,130 +604,875 @@ class Controller(IJobController, IWorkerController):
     def create_job_id(self):
         return uuid4().hex
 
+    def queue(self, name):
+        if name == self._queue:
+            return self
+        with self._queues_lock:
+            controller = self._queues.get(name)
+            if controller is None:
+                controller = self._queues[name] = Controller(self._db_uri, self._base_col_name, queue=name,
+                                                             **self._options)
+        return controller
+
+    def close(self):
+        # closing twice is a no-op, the client is shared with other controllers
+        with self._queues_lock:
+            if self._closed:
+                return
+            self._closed = True
+            for controller in self._queues.values():
+                controller.close()
+            self._queues = {}
+        if self._signal_watcher is not None:
+            self._signal_watcher.stop()
+        _release_client(self._db_uri, self._shared)
+
     ########################
     #    IJobController    #
     ########################
 
-    def _update_job(self, job_id, version, **kwargs):
+    def _load_job(self, job_id):
+        # loader of partial jobs, they may have been archived in the meantime
+        return self._get_job(job_id, include_archived=True)
+
+    def _writes_of(self, operation):
+        return self._writes.get(operation, self._jobs)
+
+    def _update_job(self, job_id, version, fields=(), operation=None, **kwargs):
+        # returns a partial job, args and other large fields are not sent back unless asked for
         query = {'job_id': job_id, 'version': version}
+        if kwargs.get('status', Job.LOCKED) != Job.LOCKED:
+            kwargs['meta.slot'] = False  # the job gives its group slot back
 
         update = {'$inc': {'version': 1},
                   '$set': kwargs}
+        # the document before the update tells whether the job has held a group slot
+        names = ('job_id', 'group', 'meta.dependents', 'meta.slot') + Job.STATE_FIELDS + tuple(fields)
+        projection = dict.fromkeys(names, True)
+        projection['_id'] = False
         try:
-            r = self._jobs.find_one_and_update(query, update, projection={'_id': False},
-                                               return_document=pymongo.collection.ReturnDocument.AFTER)
+            r = self._writes_of(operation).find_one_and_update(
+                query, update, projection=projection, return_document=pymongo.collection.ReturnDocument.BEFORE)
         except pymongo.errors.PyMongoError:
             self._raise_retriable_error('find_one_and_update')
 
         if r is None:
             raise ConcurrencyError('invalid version: {}'.format(version))
 
-        return self._job_from_doc(r)
+        meta = r.pop('meta', {})
+        group = r.pop('group', None) if 'group' not in fields else r.get('group')
+        r.update((k, v) for k, v in kwargs.items() if k in projection and not k.startswith('meta.'))
+        r['version'] = version + 1
+        if meta.get('slot') and not kwargs.get('meta.slot', True):
+            self._release_held_slots(group, 1)
+
+        dependents = meta.get('dependents', [])
+        if dependents and r['status'] in (Job.COMPLETED, Job.CANCELLED):
+            failed = r['status'] == Job.CANCELLED or kwargs.get('worker_exception') is not None
+            self._try_resolve_dependents(job_id, dependents, failed)
+
+        return self._partial_job_from_doc(r)
+
+    def _register_dependencies(self, docs):
+        # a dependency either finds its dependent in meta.dependents when it finishes
+        # or is already finished here, so every dependency is resolved exactly once.
+        # Dependencies are stamped with meta.unresolved until their dependents have been resolved, so the reaper
+        # can finish the job of a client which has failed midway
+        dependents = {}  # job_id -> ids of new jobs depending on it
+        for doc in docs:
+            for dependency in doc['depends_on']:
+                dependents.setdefault(dependency, []).append(doc['job_id'])
+
+        finished, missing = [], []
+        for dependency, job_ids in dependents.items():
+            update = {'$addToSet': {'meta.dependents': {'$each': job_ids}}, '$set': {'meta.unresolved': True}}
+            try:
+                r = self._jobs.update_one({'job_id': dependency, 'status': {'$nin': [Job.COMPLETED, Job.CANCELLED]}},
+                                          update)
+                if r.matched_count == 0:
+                    # the dependency has finished already, it's stamped like an unfinished one
+                    r = self._jobs.find_one_and_update(
+                        {'job_id': dependency}, update,
+                        projection={'_id': False, 'status': True, 'worker_exception': True, 'meta.dependents': True},
+                        return_document=pymongo.collection.ReturnDocument.AFTER)
+                    if r is not None:
+                        finished.append((dependency, r))
+                    else:
+                        missing.append((dependency, job_ids))
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('update_one')
+
+        for dependency, r in finished:
+            failed = r['status'] == Job.CANCELLED or r.get('worker_exception') is not None
+            self._resolve_dependents(dependency, r['meta']['dependents'], failed)
+
+        for dependency, job_ids in missing:
+            job = self._get_job(dependency, include_archived=True)
+            # archived dependencies can't be stamped, missing ones are considered failed
+            failed = job is None or job.status == Job.CANCELLED or job.failed
+            self._resolve_dependents(dependency, job_ids, failed)
+
+    def _try_resolve_dependents(self, job_id, dependents, failed):
+        # dependents of a job whose state change has already been applied, the caller must not see it as failed
+        try:
+            self._resolve_dependents(job_id, dependents, failed)
+        except RetriableError:
+            pass  # the job is still stamped, see _repair_dependencies
+
+    def _repair_dependencies(self):
+        # dependents are resolved after their dependency has finished, a client which dies or fails to reach
+        # the database in between leaves the dependency stamped; resolving a dependency twice is a no-op
+        finished = {'status': {'$in': [Job.COMPLETED, Job.CANCELLED]}, 'meta.unresolved': True}
+        projection = {'_id': False, 'job_id': True, 'status': True, 'worker_exception': True, 'meta.dependents': True}
+        for doc in self._jobs.find(finished, projection=projection):
+            failed = doc['status'] == Job.CANCELLED or doc.get('worker_exception') is not None
+            self._resolve_dependents(doc['job_id'], doc['meta'].get('dependents', []), failed)
+
+        # unblocking takes two writes, a client which fails between them leaves a job BLOCKED
+        # without anything to wait for
+        query = {'status': Job.BLOCKED, 'pending_deps': 0}
+        classes = self._jobs.distinct('meta.rclass', query) if self._signals is not None else []
+        groups = self._jobs.distinct('group', query)
+        r = self._jobs.update_many(query, {'$inc': {'version': 1}, '$set': {'status': Job.IDLE}})
+        if r.modified_count:
+            for group in groups:
+                self._add_group(group)
+            self._signal([_reqs_from_class(c) for c in classes], groups=groups)
+
+    def _resolve_dependents(self, job_id, dependents, failed):
+        # each dependent costs one or two indexed updates, dependents cancelled because of the job are resolved
+        # in turn; the stamp of a job is cleared once all of its dependents have been resolved
+        stack = [(job_id, list(dependents), len(dependents), failed)]
+        while stack:
+            job_id, left, count, failed = stack[-1]
+            if left:
+                dependent = left.pop()
+                cancelled = self._resolve_dependency(dependent, job_id, failed)
+                if cancelled is not None:
+                    stack.append((dependent, list(cancelled), len(cancelled), True))
+                continue
+
+            stack.pop()
+            try:
+                # dependents registered in the meantime keep the stamp, the reaper resolves them
+                self._jobs.update_one({'job_id': job_id, 'meta.dependents': {'$size': count}},
+                                      {'$unset': {'meta.unresolved': ''}})
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('update_one')
+
+    def _resolve_dependency(self, job_id, dependency, failed):
+        # meta.waiting_for makes resolving the same dependency twice a no-op,
+        # returns dependents of the job if it has been cancelled
+        query = {'job_id': job_id, 'status': Job.BLOCKED, 'meta.waiting_for': dependency}
+        try:
+            if failed:
+                r = self._jobs.find_one_and_update(
+                    dict(query, **{'meta.on_failure': Job.ON_FAILURE_CANCEL}),
+                    {'$inc': {'version': 1},
+                     '$set': {'status': Job.CANCELLED, 'completed_at': datetime.utcnow()}},
+                    projection={'_id': False, 'meta.dependents': True},
+                    return_document=pymongo.collection.ReturnDocument.AFTER)
+                if r is not None:
+                    # cancellation propagates down the graph
+                    return r['meta'].get('dependents', [])
+
+            r = self._jobs.find_one_and_update(
+                query,
+                {'$inc': {'version': 1, 'pending_deps': -1},
+                 '$pull': {'meta.waiting_for': dependency}},
+                projection={'_id': False, 'reqs': True, 'group': True, 'run_at': True, 'pending_deps': True},
+                return_document=pymongo.collection.ReturnDocument.AFTER)
+            if r is None or r['pending_deps'] > 0:
+                return None
+
+            # meta.ready_at has been set at creation, so the job keeps its place in the queue
+            u = self._jobs.update_one({'job_id': job_id, 'status': Job.BLOCKED, 'pending_deps': 0},
+                                      {'$inc': {'version': 1}, '$set': {'status': Job.IDLE}})
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('resolve_dependencies')
+
+        if u.modified_count:
+            self._add_req_class(r['reqs'], r.get('group'))
+            self._signal([r['reqs']], r['run_at'], groups=[r.get('group')])
+        return None
+
+    @instrumented
+    def get_job(self, job_id, *, include_archived=False, fields=None):
+        return self._get_job(job_id, include_archived, fields, self._reads, self._archive_reads)
 
-    def get_job(self, job_id):
+    @instrumented
+    def refresh_job(self, job_id, *, fields=None):
+        # a lagging secondary would show the job as not ours anymore, it would be abandoned while still locked
+        return self._get_job(job_id, fields=fields)
+
+    @instrumented
+    def refresh_jobs(self, job_ids, *, fields=None):
+        job_ids = list(job_ids)
+        if fields is None:
+            projection = {'_id': False, 'meta': False}
+        else:
+            projection = dict.fromkeys(('job_id',) + tuple(fields), True)
+            projection['_id'] = False
         try:
-            r = self._jobs.find_one({'job_id': job_id}, projection={'_id': False})
+            docs = {doc['job_id']: doc for doc in self._jobs.find({'job_id': {'$in': job_ids}}, projection=projection)}
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('find')
+
+        make_job = self._job_from_doc if fields is None else self._partial_job_from_doc
+        return [make_job(docs[job_id]) if job_id in docs else None for job_id in job_ids]
+
+    def _get_job(self, job_id, include_archived=False, fields=None, jobs=None, archive=None):
+        # reads from the primary unless other collections are given
+        if fields is None:
+            projection = {'_id': False, 'meta': False}
+        else:
+            projection = dict.fromkeys(('job_id',) + tuple(fields), True)
+            projection['_id'] = False
+        try:
+            r = (jobs or self._jobs).find_one({'job_id': job_id}, projection=projection)
+            if r is None and include_archived:
+                r = (archive or self._archive).find_one({'job_id': job_id}, projection=projection)
         except pymongo.errors.PyMongoError:
             self._raise_retriable_error('find_one')
 
         if r:
-            return self._job_from_doc(r)
+            return self._job_from_doc(r) if fields is None else self._partial_job_from_doc(r)
 
         return None
 
-    def create_job(self, job_id, *, reqs=None, args=None, run_at=None):
+    def _jobs_query(self, *, job_ids=None, status=None, worker_id=None, group=None, created_before=None):
+        query = {}
+        if job_ids is not None:
+            query['job_id'] = {'$in': list(job_ids)}
+        if status is not None:
+            query['status'] = {'$in': list(status)} if isinstance(status, (list, tuple, set)) else status
+        if worker_id is not None:
+            query['worker_id'] = worker_id
+        if group is not None:
+            query['group'] = group
+        if created_before is not None:
+            query['created_at'] = {'$lt': created_before}
+        return query
+
+    def iter_jobs(self, *, status=None, worker_id=None, created_before=None, fields=None, batch_size=1000):
+        query = self._jobs_query(status=status, worker_id=worker_id, created_before=created_before)
+
+        if fields is None:
+            projection, make_job = {'_id': False, 'meta': False}, self._job_from_doc
+        else:
+            projection = dict.fromkeys(('job_id',) + tuple(fields), True)
+            projection['_id'] = False
+            make_job = self._scanned_job_from_doc
+
+        # documents are fetched by batch_size per round trip and decoded one at a time
+        cursor = self._reads.find(query, projection=projection, batch_size=batch_size)
+        try:
+            while True:
+                try:
+                    doc = next(cursor)
+                except StopIteration:
+                    break
+                except pymongo.errors.PyMongoError:
+                    self._raise_retriable_error('find')
+                yield make_job(doc)
+        finally:
+            cursor.close()
+
+    def _make_job_doc(self, job_id, *, reqs=None, args=None, run_at=None, priority=0, lease=None,
+                      depends_on=None, on_dependency_failure=Job.ON_FAILURE_CANCEL, group=None):
+        if on_dependency_failure not in (Job.ON_FAILURE_CANCEL, Job.ON_FAILURE_RUN):
+            raise ValueError('unknown on_dependency_failure: {}'.format(on_dependency_failure))
+
+        created_at = datetime.utcnow()
+        depends_on = sorted(set(depends_on or []))
         doc = {'job_id': job_id, 'reqs': reqs or {}, 'args': args or {}, 'run_at': run_at,
-               'version': 0, 'status': Job.IDLE, 'created_at': datetime.utcnow(),
-               'meta': {'reqs': list(reqs.keys()) if reqs else []}}
+               'priority': priority, 'version': 0, 'status': Job.BLOCKED if depends_on else Job.IDLE,
+               'created_at': created_at,
+               'lease': lease if lease is not None else self.HEARTBEAT_TIMEOUT.total_seconds(),
+               'depends_on': depends_on, 'pending_deps': len(depends_on), 'group': group,
+               'meta': {'rclass': _req_class(reqs or {}), 'ready_at': run_at or created_at}}
+        if depends_on:
+            doc['meta'].update(waiting_for=depends_on, on_failure=on_dependency_failure)
+        return doc
+
+    @instrumented
+    def create_job(self, job_id, *, reqs=None, args=None, run_at=None, priority=0, lease=None,
+                   depends_on=None, on_dependency_failure=Job.ON_FAILURE_CANCEL, group=None):
+        doc = self._make_job_doc(job_id, reqs=reqs, args=args, run_at=run_at, priority=priority, lease=lease,
+                                 depends_on=depends_on, on_dependency_failure=on_dependency_failure, group=group)
+        self._ensure_indexes_once()
+        self._ensure_req_classes([doc['meta']['rclass']])
+        self._ensure_groups([group])
+        self._add_req_class(doc['reqs'], group)
 
         try:
-            self._jobs.insert_one(doc)
+            self._writes_of('create').insert_one(doc)
         except pymongo.errors.DuplicateKeyError:
             pass  # ok, job already exists
         except pymongo.errors.PyMongoError:
             self._raise_retriable_error('insert_one')
+        else:
+            if doc['status'] == Job.BLOCKED:
+                self._register_dependencies([doc])
+            else:
+                self._signal([doc['reqs']], run_at, groups=[group])
+
+    def _insert_batch(self, docs, result):
+        self._ensure_indexes_once()
+        self._ensure_req_classes({doc['meta']['rclass'] for doc in docs})
+        self._ensure_groups({doc['group'] for doc in docs})
+        try:
+            self._writes_of('create').insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = {err['index']: err for err in e.details['writeErrors']}
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('insert_many')
+        else:
+            errors = {}
+
+        for index, doc in enumerate(docs):
+            err = errors.get(index)
+            if err is None:
+                result.created.append(doc['job_id'])
+            elif err['code'] == DUPLICATE_KEY_ERROR:
+                result.existing.append(doc['job_id'])  # ok, job already exists
+            else:
+                result.failed[doc['job_id']] = err['errmsg']
 
+        created = [doc for index, doc in enumerate(docs) if index not in errors]
+        self._register_dependencies([doc for doc in created if doc['status'] == Job.BLOCKED])
+        created = [doc for doc in created if doc['status'] == Job.IDLE]
+        if created:
+            reqs = {tuple(sorted(doc['reqs'].items())): doc['reqs'] for doc in created}
+            run_at = None if any(doc['run_at'] is None for doc in created) else min(doc['run_at'] for doc in created)
+            self._signal(list(reqs.values()), run_at, groups={doc['group'] for doc in created})
+
+    @instrumented
+    def create_jobs(self, specs, *, batch_size=1000):
+        # each spec is a dict with `job_id` and optional arguments of create_job
+        result = BulkCreateResult()
+        specs = iter(specs)
+
+        while True:
+            batch = [self._make_job_doc(**spec) for spec in islice(specs, batch_size)]
+            if not batch:
+                break
+            for doc in batch:
+                self._add_req_class(doc['reqs'], doc['group'])
+            self._insert_batch(batch, result)
+
+        return result
+
+    @instrumented
     def cancel_job(self, job_id, version):
-        return self._update_job(job_id, version, status=Job.CANCELLED)
+        job = self._update_job(job_id, version, operation='cancel', status=Job.CANCELLED,
+                               completed_at=datetime.utcnow())
+        if job.worker_id is not None:
+            self._signal([], cancelled=[job.worker_id])
+        return job
+
+    @instrumented
+    def cancel_jobs(self, *, job_ids=None, status=None, worker_id=None, group=None, created_before=None):
+        query = self._jobs_query(job_ids=job_ids, status=status, worker_id=worker_id, group=group,
+                                 created_before=created_before)
 
+        def matching(extra):
+            return {'$and': [query, {'status': {'$nin': [Job.COMPLETED, Job.CANCELLED]}}, extra]}
+
+        now = datetime.utcnow()
+        update = {'$inc': {'version': 1},
+                  '$set': {'status': Job.CANCELLED, 'completed_at': now, 'meta.slot': False}}
+        no_dependents = {'meta.dependents': {'$exists': False}}
+        cancelled = 0
+        try:
+            workers = []
+            if self._signals is not None:
+                workers = self._jobs.distinct('worker_id', matching({'status': Job.LOCKED}))
+            # jobs holding group slots give them back per group like in reap_expired_leases,
+            # jobs which get locked with a slot in the meantime are left alone
+            groups = self._jobs.distinct('group', matching({'meta.slot': True}))
+            for g in groups:
+                r = self._writes_of('cancel').update_many(
+                    matching(dict(no_dependents, group=g, **{'meta.slot': True})), update)
+                self._release_held_slots(g, r.modified_count)
+                cancelled += r.modified_count
+            r = self._writes_of('cancel').update_many(matching(dict(no_dependents, **{'meta.slot': {'$ne': True}})),
+                                                      update)
+            cancelled += r.modified_count
+
+            # jobs with dependents are cancelled one by one to resolve the dependents, a dependent registered
+            # after the updates above finds its dependency here or already cancelled
+            others = list(self._jobs.find(matching({'meta.dependents': {'$exists': True}}),
+                                          projection={'_id': False, 'job_id': True, 'version': True}))
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('update_many')
+
+        for doc in others:
+            try:
+                self._update_job(doc['job_id'], doc['version'], operation='cancel', status=Job.CANCELLED,
+                                 completed_at=now)
+            except ConcurrencyError:
+                continue  # the job has been changed in the meantime, it may be finished already
+            cancelled += 1
+
+        if workers:
+            self._signal([], cancelled=[w for w in workers if w is not None])
+        return cancelled
+
+    @instrumented
     def delete_job(self, job_id, version):
+        # jobs without dependents, or whose dependents have been resolved, are simply deleted
+        query = {'job_id': job_id, 'version': version, 'meta.unresolved': {'$exists': False},
+                 '$or': [{'meta.dependents': {'$exists': False}}, {'status': {'$in': [Job.COMPLETED, Job.CANCELLED]}}]}
         try:
-            r = self._jobs.delete_one({'job_id': job_id, 'version': version})
+            r = self._jobs.find_one_and_delete(query, projection={'_id': False, 'group': True, 'meta.slot': True})
+            exists = r is not None or self._jobs.find_one({'job_id': job_id, 'version': version}, {'_id': True})
         except pymongo.errors.PyMongoError:
-            self._raise_retriable_error('delete_one')
+            self._raise_retriable_error('find_one_and_delete')
 
-        if r.deleted_count == 0:
+        if not exists:
             raise ConcurrencyError('job_id={}, version={} not found'.format(job_id, version))
 
-        assert r.deleted_count == 1
+        if r is None:
+            # jobs waiting for a deleted job would be blocked forever, so it's cancelled first and deleted once
+            # its dependents have been resolved; if that fails it stays cancelled and the reaper resolves them
+            self._update_job(job_id, version, operation='cancel', status=Job.CANCELLED,
+                             completed_at=datetime.utcnow())
+            try:
+                self._jobs.delete_one(dict(query, version=version + 1))
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('delete_one')
+            return
+
+        if r['meta'].get('slot'):
+            self._release_held_slots(r.get('group'), 1)
+
+    @instrumented
+    def reap_expired_leases(self):
+        now = datetime.utcnow()
+        query = {'status': Job.LOCKED,
+                 'lease_expires_at': {'$lt': now}}
+        update = {'$inc': {'version': 1},
+                  '$set': {'status': Job.IDLE, 'locked_at': None, 'worker_id': None, 'worker_heartbeat': None,
+                           'lease_expires_at': None, 'meta.ready_at': now, 'meta.slot': False}}
+        reaped = 0
+        try:
+            classes = self._jobs.distinct('meta.rclass', query) if self._signals is not None else []
+            # slots are given back per group, by the number of jobs which have actually been reaped
+            groups = self._jobs.distinct('group', dict(query, **{'meta.slot': True}))
+            for group in groups:
+                r = self._jobs.update_many(dict(query, group=group, **{'meta.slot': True}), update)
+                self._release_held_slots(group, r.modified_count)
+                reaped += r.modified_count
+            reaped += self._jobs.update_many(query, update).modified_count
+            self._reconcile_slots()
+            self._repair_dependencies()
+            self._drop_unused_req_classes()
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('update_many')
+
+        if reaped:
+            self._signal([_reqs_from_class(c) for c in classes], groups=groups)
+
+        return reaped
+
+    @instrumented
+    def set_group_limit(self, group, *, max_locked=None, weight=1):
+        while True:
+            try:
+                doc = self._groups.find_one({'_id': group}) or {'max_locked': None}
+                update = {'weight': weight, 'max_locked': max_locked}
+                if max_locked is None:
+                    # reservations of acquisitions in progress don't hold slots anymore, see _finish_reservation
+                    update.update(free=None, reservations=[])
+                elif doc['max_locked'] is None:
+                    update.update(free=max_locked, reservations=[])  # jobs locked without a limit don't hold slots
+                # the limit is changed only if nobody has changed it since we've read it
+                update = {'$set': update}
+                if max_locked is not None and doc['max_locked'] is not None:
+                    update['$inc'] = {'free': max_locked - doc['max_locked']}
+                r = self._groups.update_one({'_id': group, 'max_locked': doc['max_locked']}, update, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                continue  # the limit has been changed concurrently
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('update_one')
+            if r.matched_count or r.upserted_id is not None:
+                break
+
+        self._group_docs_expire_at = 0
+
+    @instrumented
+    def archive_jobs(self, older_than, *, batch_size=1000):
+        # jobs with unresolved dependents stay until the reaper has resolved them
+        query = {'status': {'$in': [Job.COMPLETED, Job.CANCELLED]},
+                 'completed_at': {'$lt': datetime.utcnow() - older_than},
+                 'meta.unresolved': {'$exists': False}}
+        archived = 0
+
+        while True:
+            try:
+                docs = list(self._jobs.find(query, limit=batch_size))
+                if not docs:
+                    break
+                # replaces make retries of a partially archived batch idempotent
+                self._archive.bulk_write([pymongo.ReplaceOne({'job_id': doc['job_id']},
+                                                             {k: v for k, v in doc.items() if k != '_id'},
+                                                             upsert=True)
+                                          for doc in docs], ordered=False)
+                # jobs requeued in the meantime don't match the query anymore and stay in place
+                r = self._jobs.delete_many(dict(query, _id={'$in': [doc['_id'] for doc in docs]}))
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('archive')
+
+            archived += r.deleted_count
+            if len(docs) < batch_size:
+                break
+
+        return archived
 
     ###########################
     #    IWorkerController    #
     ###########################
 
-    def _try_find_and_lock_job(self, query, resources, worker_id):
-        query.setdefault('$and', []).extend(
-            {
-                '$or': [
-                    {'reqs.' + t: None},
-                    {'reqs.' + t: {'$lte': v}}
-                ]
-            }
-            for t, v in resources.items()
-        )
-        query['$and'].append(
-            # check that job requirements are a subset of worker resources
-            {'meta.reqs': {'$not': {'$elemMatch': {'$nin': list(resources.keys())}}}}
-        )
+    def _lock_update(self, worker_id, token, lease, **kwargs):
+        # the token tells which jobs have been locked by an acquisition, see _unlock_jobs.
+        # Updates can't compute expiration from the job's own lease on MongoDB 3.4, so the lease
+        # is read beforehand and the update applies only to jobs with that lease
+        now = datetime.utcnow()
+        fields = {'meta.lease_token': token,
+                  'status': Job.LOCKED,
+                  'locked_at': now,
+                  'worker_id': worker_id,
+                  'worker_heartbeat': now,
+                  'lease_expires_at': now + (timedelta(seconds=lease) if lease is not None
+                                             else self.HEARTBEAT_TIMEOUT)}
+        fields.update(kwargs)
+        return {'$inc': {'version': 1}, '$set': fields}
 
-        update = {'$inc': {'version': 1},
-                  '$set': {'status': Job.LOCKED,
-                           'locked_at': datetime.utcnow(),
-                           'worker_id': worker_id,
-                           'worker_heartbeat': datetime.utcnow()}}
+    def _lock_next_job(self, query, sort, worker_id, token, **kwargs):
+        # locks the first job matching the query with its own lease
+        while True:
+            try:
+                doc = self._jobs.find_one(query, projection={'lease': True}, sort=sort)
+                if doc is None:
+                    return None
+                lease = doc.get('lease')
+                r = self._writes_of('lock').find_one_and_update(
+                    dict(query, _id=doc['_id'], lease=lease), self._lock_update(worker_id, token, lease, **kwargs),
+                    projection={'_id': False, 'meta': False}, return_document=pymongo.collection.ReturnDocument.AFTER)
+            except pymongo.errors.PyMongoError:
+                self._raise_retriable_error('find_one_and_update')
+
+            if r:
+                return r
+            # the job has been locked by another worker in the meantime
+
+    def _idle_query(self, classes, group):
+        # follows the (status, meta.rclass, group, priority, meta.ready_at) index
+        return {'status': Job.IDLE,
+                'meta.rclass': {'$in': classes},
+                'group': group,
+                'meta.ready_at': {'$lt': datetime.utcnow()}}
+
+    def _try_reacquire_locked_job(self, bins, worker_id, token):
+        # jobs with the same requirements share a class, so we only need to
+        # probe the index for classes which fit into worker resources
+        classes = self._fitting_req_classes(bins)
+        if not classes:
+            return None
+
+        query = {'status': Job.LOCKED,
+                 'lease_expires_at': {'$lt': datetime.utcnow()},
+                 'meta.rclass': {'$in': classes}}
+        # follows the (status, lease_expires_at) index, the job keeps its group slot
+        sort = [('lease_expires_at', pymongo.ASCENDING)]
+        r = self._lock_next_job(query, sort, worker_id, token)
+        return self._job_from_doc(r) if r else None
+
+    def _tiers(self, classes, bins):
+        bins = [resources for resources in bins if resources is not None]
+        tiers = self._policy.tiers([_reqs_from_class(c) for c in classes], bins)
+        return [[classes[i] for i in tier] for tier in tiers]
+
+    def _pick_jobs(self, candidates, bins, limits, max_jobs):
+        picked = []
+        left = [resources and resources.copy() for resources in bins]
+        limits = list(limits)
+        for doc in candidates:
+            if len(picked) == max_jobs:
+                break
+            if _fit(doc['reqs'], left, limits) is not None:
+                picked.append(doc['_id'])
+        return picked
+
+    def _lock_job_batch(self, classes, group, bins, limits, worker_id, max_jobs, slot, token):
+        sort = [('priority', pymongo.DESCENDING), ('meta.ready_at', pymongo.ASCENDING)]
+        query = self._idle_query(classes, group)
         try:
-            r = self._jobs.find_one_and_update(query, update, projection={'_id': False},
-                                               return_document=pymongo.collection.ReturnDocument.AFTER)
+            candidates = list(self._jobs.find(query, projection={'reqs': True, 'lease': True}, sort=sort,
+                                              limit=max_jobs * self.CANDIDATES_PER_JOB))
         except pymongo.errors.PyMongoError:
-            self._raise_retriable_error('find_one_and_update')
+            self._raise_retriable_error('find')
 
-        if r:
-            return self._job_from_doc(r)
+        picked = self._pick_jobs(candidates, bins, limits, max_jobs)
+        if not picked:
+            return []
 
-        return None
+        # jobs are locked with one update per lease, see _lock_update
+        by_lease = {}
+        leases = {doc['_id']: doc.get('lease') for doc in candidates}
+        for _id in picked:
+            by_lease.setdefault(leases[_id], []).append(_id)
 
-    def _try_acquire_idle_job(self, resources, worker_id):
-        query = {'status': Job.IDLE,
-                 '$or': [{'run_at': None}, {'run_at': {'$lt': datetime.utcnow()}}]}
+        # some candidates may be locked by other workers in the meantime,
+        # the token tells us which jobs were locked by this call
+        try:
+            for lease, ids in by_lease.items():
+                self._writes_of('lock').update_many(
+                    {'_id': {'$in': ids}, 'status': Job.IDLE, 'meta.ready_at': query['meta.ready_at'], 'lease': lease},
+                    self._lock_update(worker_id, token, lease, **{'meta.slot': slot}))
+            docs = list(self._jobs.find({'_id': {'$in': picked}, 'meta.lease_token': token},
+                                        projection={'meta': False}))
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('update_many')
 
-        return self._try_find_and_lock_job(query, resources, worker_id)
+        order = {_id: i for i, _id in enumerate(picked)}
+        docs.sort(key=lambda doc: order[doc.pop('_id')])
+        return [self._job_from_doc(doc) for doc in docs]
 
-    def _try_reacquire_locked_job(self, resources, worker_id):
-        query = {'status': Job.LOCKED,
-                 'worker_heartbeat': {'$lt': datetime.utcnow() - self.HEARTBEAT_TIMEOUT}}
+    @instrumented
+    def acquire_jobs(self, resources, worker_id, max_jobs):
+        return self._acquire_jobs(resources, worker_id, max_jobs)
+
+    def _acquire_jobs(self, resources, worker_id, max_jobs):
+        token = uuid4().hex
+        try:
+            return self._try_acquire_jobs(resources, worker_id, max_jobs, token)
+        except RetriableError:
+            self._unlock_jobs(token)
+            raise
+
+    def _try_acquire_jobs(self, resources, worker_id, max_jobs, token):
+        self._ensure_indexes_once()
+        bins = resources if isinstance(resources, list) else [resources]
+        limits, max_jobs = _job_limits(bins, max_jobs)
+        jobs = []
+        left = [resources.copy() if limit > 0 else None for resources, limit in zip(bins, limits)]
+        for group in self._group_order():
+            classes = self._fitting_req_classes(left)
+            if not classes or len(jobs) == max_jobs:
+                break
+            if self._is_empty_group(group, classes):
+                continue
+
+            slots = self._reserve_slots(group, max_jobs - len(jobs), token)
+            if slots == 0:
+                continue  # group is full
+
+            n = max_jobs - len(jobs) if slots is None else slots
+            locked = []
+            try:
+                for tier in self._tiers(classes, left):
+                    if len(locked) == n:
+                        break
+                    if self._is_empty_group(group, tier):
+                        continue
+                    batch = self._lock_job_batch(tier, group, left, limits, worker_id, n - len(locked),
+                                                 slot=slots is not None, token=token)
+                    if not batch:
+                        self._mark_empty_group(group, tier)
 
-        return self._try_find_and_lock_job(query, resources, worker_id)
+                    for job in batch:
+                        # shouldn't fail, the job has been picked to fit
+                        _fit(job.reqs, left, limits)
+                    locked.extend(batch)
+            finally:
+                if slots is not None:
+                    self._finish_reservation(group, token, slots - len(locked))
+            jobs.extend(locked)
 
+        if not jobs and self._reacquire_locked:
+            job = self._try_reacquire_locked_job(left, worker_id, token)
+            return [job] if job else []
+
+        return jobs
+
+    def _unlock_jobs(self, token):
+        # jobs locked by an acquisition which has failed midway (e.g. the reply of a lock has been lost) are
+        # unknown to the worker, so they are put back with their places in the queue instead of waiting for
+        # their leases to expire. Slots they hold are left for _reconcile_slots, as the failed acquisition
+        # may have given them back already
+        try:
+            self._jobs.update_many({'status': Job.LOCKED, 'meta.lease_token': token},
+                                   {'$inc': {'version': 1},
+                                    '$set': {'status': Job.IDLE, 'locked_at': None, 'worker_id': None,
+                                             'worker_heartbeat': None, 'lease_expires_at': None,
+                                             'meta.slot': False}})
+        except pymongo.errors.PyMongoError:
+            pass  # reaped once their leases expire
+
+    @instrumented
     def acquire_job(self, resources, worker_id):
-        job = self._try_acquire_idle_job(resources, worker_id)
+        return self._acquire_job(resources, worker_id)
+
+    def _acquire_job(self, resources, worker_id):
+        token = uuid4().hex
+        try:
+            return self._try_acquire_job(resources, worker_id, token)
+        except RetriableError:
+            self._unlock_jobs(token)
+            raise
 
-        if job is None:
-            job = self._try_reacquire_locked_job(resources, worker_id)
+    def _try_acquire_job(self, resources, worker_id, token):
+        self._ensure_indexes_once()
+        classes = self._fitting_req_classes([resources])
+        for group in self._group_order() if classes else []:
+            if self._is_empty_group(group, classes):
+                continue
 
-        if job is None:
-            # there are no available jobs
-            return None
+            slots = self._reserve_slots(group, 1, token)
+            if slots == 0:
+                continue  # group is full
 
-        return job
+            sort = [('priority', pymongo.DESCENDING), ('meta.ready_at', pymongo.ASCENDING)]
+            r = None
+            try:
+                for tier in self._tiers(classes, [resources]):
+                    if self._is_empty_group(group, tier):
+                        continue
+                    r = self._lock_next_job(self._idle_query(tier, group), sort, worker_id, token,
+                                            **{'meta.slot': slots is not None})
+                    if r:
+                        return self._job_from_doc(r)
+                    self._mark_empty_group(group, tier)
+            finally:
+                if slots is not None:
+                    self._finish_reservation(group, token, 0 if r else slots)
+
+        if self._reacquire_locked:
+            return self._try_reacquire_locked_job([resources], worker_id, token)
+
+        # there are no available jobs
+        return None
+
+    @instrumented
+    def heartbeat_job(self, job_id, version, lease=None):
+        now = datetime.utcnow()
+        kwargs = {'lease': lease} if lease is not None else {}
+        expires_at = now + (timedelta(seconds=lease) if lease is not None else self.HEARTBEAT_TIMEOUT)
+        return self._update_job(job_id, version, fields=('lease_expires_at',), operation='heartbeat',
+                                worker_heartbeat=now, lease_expires_at=expires_at, **kwargs)
 
-    def heartbeat_job(self, job_id, version):
-        return self._update_job(job_id, version, worker_heartbeat=datetime.utcnow())
+    @instrumented
+    def heartbeat_jobs(self, jobs):
+        # one bulk write and one read for all of the jobs
+        jobs = list(jobs)
+        if not jobs:
+            return []
 
+        now = datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # as stored by MongoDB
+        updates = []
+        for job_id, version, lease in jobs:
+            fields = {'worker_heartbeat': now,
+                      'lease_expires_at': now + (timedelta(seconds=lease) if lease is not None
+                                                 else self.HEARTBEAT_TIMEOUT)}
+            if lease is not None:
+                fields['lease'] = lease
+            updates.append(pymongo.UpdateOne({'job_id': job_id, 'version': version},
+                                             {'$inc': {'version': 1}, '$set': fields}))
+
+        projection = dict.fromkeys(('job_id', 'worker_heartbeat', 'lease_expires_at') + Job.STATE_FIELDS, True)
+        projection['_id'] = False
+        try:
+            self._writes_of('heartbeat').bulk_write(updates, ordered=False)
+            docs = {doc['job_id']: doc for doc in self._jobs.find({'job_id': {'$in': [job[0] for job in jobs]}},
+                                                                  projection=projection)}
+        except pymongo.errors.PyMongoError:
+            self._raise_retriable_error('heartbeat_jobs')
+
+        result = []
+        for job_id, version, _ in jobs:
+            doc = docs.get(job_id)
+            # the bulk result has only counts, so our writes are recognized by the version and the timestamp
+            if doc is None or doc['version'] != version + 1 or doc.pop('worker_heartbeat') != now:
+                result.append(None)
+            else:
+                result.append(self._partial_job_from_doc(doc))
+        return result
+
+    @instrumented
     def finalize_job(self, job_id, version, worker_exception=None):
-        return self._update_job(job_id, version, status=Job.COMPLETED, worker_exception=worker_exception,
-                                completed_at=datetime.utcnow())
+        return self._finalize_job(job_id, version, worker_exception)
+
+    def _finalize_job(self, job_id, version, worker_exception):
+        return self._update_job(job_id, version, operation='finalize', status=Job.COMPLETED,
+                                worker_exception=worker_exception, completed_at=datetime.utcnow())
 
+    @instrumented
+    def finalize_and_acquire(self, job_id, version, worker_exception=None, *, resources, worker_id, max_jobs=1):
+        # MongoDB 3.4 can't change two documents at once, so the job is durably finalized first
+        # and the next ones are acquired right after that without another call of the worker
+        job = self._finalize_job(job_id, version, worker_exception)
+        try:
+            if max_jobs == 1:
+                acquired = self._acquire_job(resources, worker_id)
+                jobs = [acquired] if acquired else []
+            else:
+                jobs = self._acquire_jobs(resources, worker_id, max_jobs)
+        except RetriableError:
+            # the job is finalized anyway, the worker acquires the next ones as usual;
+            # jobs locked before the error have been unlocked by _acquire_jobs
+            jobs = []
+        return job, jobs
+
+    @instrumented
     def requeue_job(self, job_id, version, run_at=None):
-        return self._update_job(job_id, version, status=Job.IDLE, run_at=run_at,
-                                locked_at=None, completed_at=None,
-                                worker_id=None, worker_heartbeat=None, worker_exception=None)
+        job = self._update_job(job_id, version, fields=('reqs', 'group'), operation='requeue',
+                               status=Job.IDLE, run_at=run_at,
+                               locked_at=None, completed_at=None, lease_expires_at=None,
+                               worker_id=None, worker_heartbeat=None, worker_exception=None,
+                               **{'meta.ready_at': run_at or datetime.utcnow()})
+        # a finished job may come back after the reaper has dropped its class
+        self._ensure_req_classes([_req_class(job.reqs)])
+        self._signal([job.reqs], run_at, groups=[job.group])
+        return job
+
+    @instrumented
+    def unlock_job(self, job_id, version):
+        # like _unlock_jobs, meta.ready_at stays as it was
+        job = self._update_job(job_id, version, fields=('reqs', 'group', 'run_at'), operation='requeue',
+                               status=Job.IDLE, locked_at=None, lease_expires_at=None,
+                               worker_id=None, worker_heartbeat=None)
+        self._signal([job.reqs], job.run_at, groups=[job.group])
+        return job
+
+    def _start_signal_watcher(self):
+        with self._signal_watcher_lock:
+            if self._signal_watcher is None:
+                self._signal_watcher = _SignalWatcher(self._signals, self._on_signal, self._ensure_signals_once)
+                self._signal_watcher.start()
+
+    def add_job_listener(self, listener):
+        if self._signals is None:
+            return False
+
+        self._start_signal_watcher()
+        self._signal_watcher.add_listener(listener)
+        return True
+
+    def remove_job_listener(self, listener):
+        if self._signal_watcher is not None:
+            self._signal_watcher.remove_listener(listener)
+
+    def add_cancel_listener(self, listener):
+        if self._signals is None:
+            return False
+
+        self._start_signal_watcher()
+        self._signal_watcher.add_cancel_listener(listener)
+        return True
+
+    def remove_cancel_listener(self, listener):
+        if self._signal_watcher is not None:
+            self._signal_watcher.remove_cancel_listener(listener)
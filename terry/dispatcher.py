@@ -0,0 +1,277 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from .api import ConcurrencyError, RetriableError
+from .worker import QueueScheduler, fits_resources, substract_resources
+
+
+__all__ = ['Dispatcher']
+
+
+class _HeartbeatBatch:
+    def __init__(self, write_at):
+        self.jobs = []  # (job_id, version, lease)
+        self.write_at = write_at
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Dispatcher:
+    # polls the controller on behalf of all Workers of a process (see Worker(dispatcher=...)):
+    # resources of idle workers are put into one acquire_jobs call per round and their heartbeats
+    # are written in batches, so the load on the database doesn't grow with the number of workers.
+    # Jobs are locked under the dispatcher's id.
+
+    # fallback polling interval for controllers which push job notifications, see Worker.IDLE_POLL_INTERVAL
+    IDLE_POLL_INTERVAL = 5
+    # how long the first heartbeat of a batch waits for others to join it
+    HEARTBEAT_WINDOW = 0.2
+
+    def __init__(self, id_, controller, *, queues=None):
+        self._id = id_
+        self._queues = QueueScheduler(controller, queues)
+
+        self._lock = threading.Lock()
+        self._workers = []
+        self._inboxes = {}  # worker -> [(job, controller)] acquired for it but not taken yet
+        self._heartbeats = {}  # controller -> _HeartbeatBatch being collected
+        # whether the loop writes batches of heartbeats, heartbeats are written right away otherwise
+        self._batching = False
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._acquire_at = 0
+        self._job_available = False
+        self._push_notifications = False
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self.logger.info('[%s] Starting dispatcher...', self._id)
+        self._batching = True
+        self._push_notifications = all([controller.add_job_listener(self._on_job_available)
+                                        for controller in self._queues.controllers])
+        for controller in self._queues.controllers:
+            controller.add_cancel_listener(self._on_jobs_cancelled)
+        self._thread.start()
+
+    def request_stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def stop(self):
+        self.request_stop()
+        self.join()
+        for controller in self._queues.controllers:
+            controller.remove_job_listener(self._on_job_available)
+            controller.remove_cancel_listener(self._on_jobs_cancelled)
+
+    def attach(self, worker):
+        with self._lock:
+            self._workers.append(worker)
+            self._inboxes[worker] = []
+        self.notify()
+
+    def detach(self, worker):
+        with self._lock:
+            self._workers.remove(worker)
+            leftovers = self._inboxes.pop(worker)
+
+        # the worker has stopped before taking them
+        for job, controller in leftovers:
+            try:
+                self._unlock_job(controller, job)
+            except RetriableError:
+                pass  # the lease will expire
+            worker.reclaim_resources(job.reqs)
+
+    def take(self, worker):
+        # returns [(job, controller)] acquired for the worker, resources of the jobs are already reserved
+        with self._lock:
+            jobs, self._inboxes[worker] = self._inboxes[worker], []
+        return jobs
+
+    def notify(self):
+        # some worker has got free capacity
+        self._acquire_at = 0
+        self._wakeup.set()
+
+    def _on_job_available(self, reqs, run_at):
+        # called from the controller's thread, workers check run_at themselves once they get the job
+        self._job_available = True
+        self._wakeup.set()
+
+    def _on_jobs_cancelled(self, worker_id):
+        # jobs are locked under our id, so every worker checks its own
+        if worker_id == self._id:
+            with self._lock:
+                workers = list(self._workers)
+            for worker in workers:
+                worker.notify_jobs_cancelled()
+
+    def heartbeat_job(self, controller, job_id, version, lease=None):
+        # same as controller.heartbeat_job, but heartbeats of all workers are collected for HEARTBEAT_WINDOW
+        # and written with one heartbeat_jobs call by the dispatcher's thread
+        with self._lock:
+            batch = None
+            if self._batching:
+                batch = self._heartbeats.get(controller)
+                if batch is None:
+                    batch = self._heartbeats[controller] = _HeartbeatBatch(time.time() + self.HEARTBEAT_WINDOW)
+                    self._wakeup.set()
+                index = len(batch.jobs)
+                batch.jobs.append((job_id, version, lease))
+
+        if batch is None:
+            # the dispatcher isn't running
+            job = controller.heartbeat_jobs([(job_id, version, lease)])[0]
+        else:
+            batch.done.wait()
+            if isinstance(batch.error, RetriableError):
+                raise RetriableError(str(batch.error))
+            elif batch.error is not None:
+                raise batch.error
+            job = batch.result[index]
+
+        if job is None:
+            raise ConcurrencyError('invalid version: {}'.format(version))
+        return job
+
+    def _write_heartbeats(self, stopping=False):
+        # writes batches which have been collected for HEARTBEAT_WINDOW (all of them when stopping),
+        # returns how long until the next one is due, None if there are no batches
+        now = time.time()
+        with self._lock:
+            if stopping:
+                self._batching = False
+            due = [(controller, batch) for controller, batch in self._heartbeats.items()
+                   if stopping or batch.write_at <= now]
+            for controller, _ in due:
+                del self._heartbeats[controller]
+            pending = [batch.write_at for batch in self._heartbeats.values()]
+
+        for controller, batch in due:
+            try:
+                batch.result = controller.heartbeat_jobs(batch.jobs)
+            except Exception as e:
+                # workers waiting for the batch fail the same way, there is no result for them
+                batch.error = e
+            finally:
+                batch.done.set()
+
+        return max(0, min(pending) - now) if pending else None
+
+    def _loop(self):
+        retry_delay, retry_at = 0, 0
+        timeout = 0
+        while not self._stop.is_set():
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+            timeouts = [self._write_heartbeats()]
+            now = time.time()
+            if now >= retry_at:
+                try:
+                    timeouts.append(self._step())
+                except RetriableError as e:
+                    self.logger.warning('[%s] Failed to acquire jobs: %s', self._id, e)
+                    retry_delay = 1 if retry_delay == 0 else min(10, retry_delay * 2)
+                    retry_at = now + retry_delay
+                else:
+                    retry_delay = 0
+            if retry_at > now:
+                timeouts.append(retry_at - now)
+            timeout = min((t for t in timeouts if t is not None), default=None)
+
+        self._write_heartbeats(stopping=True)
+
+    def _step(self):
+        now = time.time()
+        if now < self._acquire_at and not self._job_available:
+            return self._acquire_at - now
+
+        self._job_available = False
+        if self._acquire_round():
+            # leftover resources may fit more work
+            return 0
+
+        if self._job_available:
+            return 0
+
+        if self._push_notifications:
+            self._acquire_at = now + self.IDLE_POLL_INTERVAL - random.random()
+        else:
+            self._acquire_at = now + math.e - random.random()
+        return self._acquire_at - now
+
+    def _acquire_round(self):
+        # returns the number of jobs handed to workers
+        with self._lock:
+            workers = [(worker, worker.dispatch_capacity() - len(self._inboxes[worker]))
+                       for worker in self._workers]
+        # [worker, capacity, resources]
+        entries = [[worker, capacity, worker.acquire_resources()]
+                   for worker, capacity in workers if capacity > 0]
+        if not entries:
+            return 0
+
+        acquired = 0
+        try:
+            for controller in self._queues.order():
+                wanting = [entry for entry in entries if entry[1] > 0]
+                if not wanting:
+                    break
+
+                # the controller fits every job into one of the workers like we do below
+                jobs = controller.acquire_jobs([entry[2] for entry in wanting], self._id,
+                                               [entry[1] for entry in wanting])
+                self._queues.acquired(controller, len(jobs))
+
+                for job in jobs:
+                    entry = next((entry for entry in wanting
+                                  if entry[1] > 0 and fits_resources(job.reqs, entry[2])), None)
+                    if entry is None:
+                        # shouldn't happen, the job goes back to its place in the queue
+                        self._unlock_job(controller, job)
+                        continue
+
+                    entry[1] -= 1
+                    entry[2] = substract_resources(entry[2], job.reqs)
+                    with self._lock:
+                        if entry[0] in self._inboxes:
+                            self._inboxes[entry[0]].append((job, controller))
+                            acquired += 1
+                            continue
+                    # the worker has been detached in the meantime
+                    entry[0].reclaim_resources(job.reqs)
+                    self._unlock_job(controller, job)
+        finally:
+            for worker, _, resources in entries:
+                worker.reclaim_resources(resources)
+                worker.notify_jobs_dispatched()
+
+        return acquired
+
+    def _unlock_job(self, controller, job):
+        try:
+            controller.unlock_job(job.id, job.version)
+        except ConcurrencyError:
+            pass
@@ -0,0 +1,569 @@
+import copy
+import heapq
+import itertools
+import random
+import threading
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from .api import (
+    Job, BulkCreateResult, IJobController, IWorkerController,
+    ConcurrencyError
+)
+from .metrics import instrumented
+from .policy import FirstFit
+
+
+__all__ = ['MemoryController']
+
+
+def _signature(reqs):
+    return tuple(sorted(reqs.items()))
+
+
+def _first_fit(reqs, bins):
+    # None bins have got as many jobs as they may take, like in Controller
+    for i, resources in enumerate(bins):
+        if resources is not None and all(k in resources and v <= resources[k] for k, v in reqs.items()):
+            return i
+    return None
+
+
+def _job_limits(bins, max_jobs):
+    # max_jobs limits the number of jobs in total, or of jobs fitted into each of the bins if it's a list
+    if isinstance(max_jobs, list):
+        return list(max_jobs), sum(max_jobs)
+    return [max_jobs] * len(bins), max_jobs
+
+
+class _Bucket:
+    # indexes of jobs of one group sharing the same requirements,
+    # entries are (key, seq, job_id, version) and become stale once the job's version changes
+    def __init__(self, group, reqs):
+        self.group = group
+        self.reqs = reqs
+        self.delayed = []  # idle jobs with run_at in the future ordered by run_at
+        self.idle = []     # idle jobs ordered by (-priority, meta.ready_at)
+        self.leases = []   # locked jobs ordered by lease expiration time
+
+    def fits(self, bins):
+        return _first_fit(self.reqs, bins) is not None
+
+
+class MemoryController(IJobController, IWorkerController):
+    HEARTBEAT_TIMEOUT = timedelta(minutes=10)
+
+    def __init__(self, *, reacquire_locked=True, metrics=None, policy=None):
+        self._reacquire_locked = reacquire_locked
+        self._metrics = metrics
+        self._policy = policy or FirstFit()
+        self._queues = {}  # name -> MemoryController, see queue()
+        self._root = self  # the default queue, which keeps named queues of all of them
+        self._lock = threading.Lock()
+        self._docs = {}     # job_id -> doc
+        self._archive = {}  # job_id -> doc of archived job
+        self._buckets = {}  # (group, requirements signature) -> _Bucket
+        self._groups = {}   # group -> {'weight', 'max_locked', 'locked'}
+        self._seq = itertools.count()
+        self._listeners = []
+        self._cancel_listeners = []
+
+    def _job_from_doc(self, doc):
+        doc = doc.copy()
+        doc.pop('meta')
+        doc['reqs'] = copy.deepcopy(doc['reqs'])
+        doc['depends_on'] = list(doc['depends_on'])
+        doc['args'] = copy.deepcopy(doc['args'])
+        doc['worker_exception'] = copy.deepcopy(doc['worker_exception'])
+        return Job(doc.pop('job_id'), **doc)
+
+    def _bucket(self, doc):
+        key = (doc['group'], _signature(doc['reqs']))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(doc['group'], doc['reqs'])
+        return bucket
+
+    def _group(self, group):
+        if group not in self._groups:
+            self._groups[group] = {'weight': 1, 'max_locked': None, 'locked': 0}
+        return self._groups[group]
+
+    def _is_full(self, group):
+        limits = self._group(group)
+        return limits['max_locked'] is not None and limits['locked'] >= limits['max_locked']
+
+    def _release_slot(self, doc):
+        if doc['meta'].get('slot'):
+            doc['meta']['slot'] = False
+            limits = self._group(doc['group'])
+            limits['locked'] = max(0, limits['locked'] - 1)
+
+    def _index(self, doc):
+        # must be called after every change of the document
+        if doc['status'] == Job.IDLE and doc['run_at'] and doc['run_at'] > datetime.utcnow():
+            key = doc['run_at']
+            heap = self._bucket(doc).delayed
+        elif doc['status'] == Job.IDLE:
+            key = (-doc['priority'], doc['meta']['ready_at'])
+            heap = self._bucket(doc).idle
+        elif doc['status'] == Job.LOCKED:
+            key = doc['lease_expires_at']
+            heap = self._bucket(doc).leases
+        else:
+            return
+        heapq.heappush(heap, (key, next(self._seq), doc['job_id'], doc['version']))
+
+    def _top(self, heap, status):
+        # drop stale entries from the top of the heap
+        while heap:
+            _, _, job_id, version = heap[0]
+            doc = self._docs.get(job_id)
+            if doc is not None and doc['version'] == version and doc['status'] == status:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _promote_delayed(self, bucket, now):
+        while True:
+            top = self._top(bucket.delayed, Job.IDLE)
+            if top is None or top[0] > now:
+                break
+            heapq.heappop(bucket.delayed)
+            self._index(self._docs[top[2]])
+
+    def _find_in(self, buckets, heap_name, status, now):
+        best, best_heap = None, None
+        for bucket in buckets:
+            heap = getattr(bucket, heap_name)
+            top = self._top(heap, status)
+            if top is None or status == Job.LOCKED and top[0] > now:
+                continue
+            if best is None or top < best:
+                best, best_heap = top, heap
+        if best is None:
+            return None
+        heapq.heappop(best_heap)
+        return self._docs[best[2]]
+
+    def _find_available(self, bins, now):
+        buckets = [bucket for bucket in self._buckets.values() if bucket.fits(bins)]
+        groups = {}  # group -> fitting buckets with idle jobs
+        for bucket in buckets:
+            self._promote_delayed(bucket, now)
+            if self._top(bucket.idle, Job.IDLE) is not None:
+                groups.setdefault(bucket.group, []).append(bucket)
+
+        # weighted lottery among groups which are not full, like Controller does,
+        # then the first tier of the policy among buckets of the group
+        doc, best = None, None
+        for group, group_buckets in groups.items():
+            weight = self._group(group)['weight']
+            if weight <= 0 or self._is_full(group):
+                continue
+            key = random.random() ** (1.0 / weight)
+            if best is None or key > best[0]:
+                best = (key, group_buckets)
+        if best is not None:
+            open_bins = [resources for resources in bins if resources is not None]
+            tier = self._policy.tiers([bucket.reqs for bucket in best[1]], open_bins)[0]
+            doc = self._find_in([best[1][i] for i in tier], 'idle', Job.IDLE, now)
+
+        if doc is None and self._reacquire_locked:
+            # expired jobs keep their group slots
+            doc = self._find_in(buckets, 'leases', Job.LOCKED, now)
+        return doc
+
+    def _update_doc(self, job_id, version, **kwargs):
+        doc = self._docs.get(job_id)
+        if doc is None or doc['version'] != version:
+            raise ConcurrencyError('invalid version: {}'.format(version))
+
+        if doc['status'] == Job.LOCKED and kwargs.get('status', Job.LOCKED) != Job.LOCKED:
+            self._release_slot(doc)
+        # meta.* fields are set like Controller does
+        meta = {k[len('meta.'):]: kwargs.pop(k) for k in list(kwargs) if k.startswith('meta.')}
+        doc.update(copy.deepcopy(kwargs))
+        doc['meta'].update(meta)
+        doc['version'] += 1
+        self._index(doc)
+        return doc
+
+    def _load_job(self, job_id):
+        # loader of partial jobs, they may have been archived in the meantime
+        return self.get_job(job_id, include_archived=True)
+
+    def _update_job(self, job_id, version, fields=(), **kwargs):
+        # returns a partial job like Controller does
+        with self._lock:
+            doc = self._update_doc(job_id, version, **kwargs)
+            state = {name: copy.deepcopy(doc[name]) for name in Job.STATE_FIELDS + tuple(fields)}
+            unblocked = self._resolve_dependents(doc)
+
+        for reqs, run_at in unblocked:
+            self._notify(reqs, run_at)
+        return Job.partial(job_id, self._load_job, **state)
+
+    def _register_dependencies(self, doc):
+        # must be called under the lock like the methods below,
+        # they return (reqs, run_at) of jobs which have become IDLE for notifications
+        resolved = []
+        for dependency in doc['depends_on']:
+            other = self._docs.get(dependency)
+            if other is not None and other['status'] not in (Job.COMPLETED, Job.CANCELLED):
+                other['meta']['dependents'].append(doc['job_id'])
+                continue
+            # missing dependencies are considered failed
+            other = other or self._archive.get(dependency)
+            failed = other is None or other['status'] == Job.CANCELLED or other['worker_exception'] is not None
+            resolved.append((doc['job_id'], dependency, failed))
+        return self._resolve_dependencies(resolved)
+
+    def _resolve_dependents(self, doc):
+        if doc['status'] not in (Job.COMPLETED, Job.CANCELLED) or not doc['meta']['dependents']:
+            return []
+        failed = doc['status'] == Job.CANCELLED or doc['worker_exception'] is not None
+        return self._resolve_dependencies([(dependent, doc['job_id'], failed)
+                                           for dependent in doc['meta']['dependents']])
+
+    def _resolve_dependencies(self, resolved):
+        # resolved is a list of (job_id, dependency, failed)
+        unblocked = []
+        resolved = list(resolved)
+        while resolved:
+            job_id, dependency, failed = resolved.pop()
+            doc = self._docs.get(job_id)
+            if doc is None or doc['status'] != Job.BLOCKED or dependency not in doc['meta']['waiting_for']:
+                continue
+
+            if failed and doc['meta']['on_failure'] == Job.ON_FAILURE_CANCEL:
+                self._update_doc(job_id, doc['version'], status=Job.CANCELLED, completed_at=datetime.utcnow())
+                # cancellation propagates down the graph
+                resolved.extend((dependent, job_id, True) for dependent in doc['meta']['dependents'])
+                continue
+
+            doc['meta']['waiting_for'].remove(dependency)
+            status = Job.BLOCKED if doc['meta']['waiting_for'] else Job.IDLE
+            self._update_doc(job_id, doc['version'], status=status, pending_deps=doc['pending_deps'] - 1)
+            if status == Job.IDLE:
+                unblocked.append((doc['reqs'], doc['run_at']))
+        return unblocked
+
+    def _notify(self, reqs, run_at):
+        for listener in list(self._listeners):
+            listener(reqs, run_at)
+
+    def _notify_cancelled(self, workers):
+        for worker_id in workers:
+            for listener in list(self._cancel_listeners):
+                listener(worker_id)
+
+    ########################
+    #    IJobController    #
+    ########################
+
+    def create_job_id(self):
+        return uuid4().hex
+
+    def queue(self, name):
+        if self._root is not self:
+            return self._root.queue(name)
+        if name is None:
+            return self
+        with self._lock:
+            controller = self._queues.get(name)
+            if controller is None:
+                controller = self._queues[name] = MemoryController(reacquire_locked=self._reacquire_locked,
+                                                                   metrics=self._metrics, policy=self._policy)
+                controller._root = self
+        return controller
+
+    def close(self):
+        pass
+
+    @instrumented
+    def get_job(self, job_id, *, include_archived=False, fields=None):
+        with self._lock:
+            doc = self._docs.get(job_id)
+            if doc is None and include_archived:
+                doc = self._archive.get(job_id)
+            if doc is None:
+                return None
+            if fields is not None:
+                return Job.partial(job_id, self._load_job, **{name: copy.deepcopy(doc[name]) for name in fields})
+            return self._job_from_doc(doc)
+
+    def iter_jobs(self, *, status=None, worker_id=None, created_before=None, fields=None, batch_size=1000):
+        statuses = set(status) if isinstance(status, (list, tuple, set)) else {status}
+
+        def matches(doc):
+            if status is not None and doc['status'] not in statuses:
+                return False
+            if worker_id is not None and doc['worker_id'] != worker_id:
+                return False
+            return created_before is None or doc['created_at'] < created_before
+
+        with self._lock:
+            job_ids = list(self._docs)
+
+        for offset in range(0, len(job_ids), batch_size):
+            with self._lock:
+                docs = [self._docs[job_id] for job_id in job_ids[offset:offset + batch_size]
+                        if job_id in self._docs and matches(self._docs[job_id])]
+                jobs = [self._job_from_doc(doc) if fields is None else
+                        Job.partial(doc['job_id'], **{name: copy.deepcopy(doc[name]) for name in fields})
+                        for doc in docs]
+            for job in jobs:
+                yield job
+
+    def _insert_doc(self, job_id, *, reqs=None, args=None, run_at=None, priority=0, lease=None,
+                    depends_on=None, on_dependency_failure=Job.ON_FAILURE_CANCEL, group=None):
+        # returns (reqs, run_at) of jobs to notify about, None if the job already exists
+        if on_dependency_failure not in (Job.ON_FAILURE_CANCEL, Job.ON_FAILURE_RUN):
+            raise ValueError('unknown on_dependency_failure: {}'.format(on_dependency_failure))
+        if job_id in self._docs:
+            return None  # ok, job already exists
+
+        depends_on = sorted(set(depends_on or []))
+        now = datetime.utcnow()
+        doc = {'job_id': job_id, 'reqs': copy.deepcopy(reqs or {}), 'args': copy.deepcopy(args or {}),
+               'run_at': run_at, 'priority': priority,
+               'lease': lease if lease is not None else self.HEARTBEAT_TIMEOUT.total_seconds(),
+               'version': 0, 'status': Job.BLOCKED if depends_on else Job.IDLE, 'created_at': now,
+               'locked_at': None, 'completed_at': None, 'lease_expires_at': None,
+               'depends_on': depends_on, 'pending_deps': len(depends_on), 'group': group,
+               'worker_id': None, 'worker_heartbeat': None, 'worker_exception': None,
+               # jobs are queued by meta.ready_at like in Controller, a requeued job goes to the back
+               'meta': {'dependents': [], 'waiting_for': set(depends_on), 'on_failure': on_dependency_failure,
+                        'ready_at': run_at or now}}
+        self._docs[job_id] = doc
+        self._index(doc)
+
+        if depends_on:
+            return self._register_dependencies(doc)
+        return [(doc['reqs'], run_at)]
+
+    @instrumented
+    def create_job(self, job_id, *, reqs=None, args=None, run_at=None, priority=0, lease=None,
+                   depends_on=None, on_dependency_failure=Job.ON_FAILURE_CANCEL, group=None):
+        with self._lock:
+            unblocked = self._insert_doc(job_id, reqs=reqs, args=args, run_at=run_at, priority=priority, lease=lease,
+                                         depends_on=depends_on, on_dependency_failure=on_dependency_failure,
+                                         group=group)
+
+        for reqs, run_at in unblocked or []:
+            self._notify(reqs, run_at)
+
+    @instrumented
+    def create_jobs(self, specs, *, batch_size=1000):
+        result = BulkCreateResult()
+        for spec in specs:
+            with self._lock:
+                unblocked = self._insert_doc(**spec)
+
+            if unblocked is None:
+                result.existing.append(spec['job_id'])
+            else:
+                result.created.append(spec['job_id'])
+                for reqs, run_at in unblocked:
+                    self._notify(reqs, run_at)
+
+        return result
+
+    @instrumented
+    def cancel_job(self, job_id, version):
+        job = self._update_job(job_id, version, status=Job.CANCELLED, completed_at=datetime.utcnow())
+        if job.worker_id is not None:
+            self._notify_cancelled([job.worker_id])
+        return job
+
+    @instrumented
+    def cancel_jobs(self, *, job_ids=None, status=None, worker_id=None, group=None, created_before=None):
+        statuses = set(status) if isinstance(status, (list, tuple, set)) else {status}
+        job_ids = None if job_ids is None else set(job_ids)
+
+        def matches(doc):
+            if doc['status'] in (Job.COMPLETED, Job.CANCELLED):
+                return False
+            if job_ids is not None and doc['job_id'] not in job_ids:
+                return False
+            if status is not None and doc['status'] not in statuses:
+                return False
+            if worker_id is not None and doc['worker_id'] != worker_id:
+                return False
+            if group is not None and doc['group'] != group:
+                return False
+            return created_before is None or doc['created_at'] < created_before
+
+        cancelled, unblocked, workers = 0, [], set()
+        with self._lock:
+            for doc in [doc for doc in self._docs.values() if matches(doc)]:
+                if doc['status'] == Job.CANCELLED:
+                    continue  # cancelled by one of its dependencies above
+                if doc['status'] == Job.LOCKED:
+                    workers.add(doc['worker_id'])
+                self._update_doc(doc['job_id'], doc['version'], status=Job.CANCELLED, completed_at=datetime.utcnow())
+                unblocked.extend(self._resolve_dependents(doc))
+                cancelled += 1
+
+        for reqs, run_at in unblocked:
+            self._notify(reqs, run_at)
+        self._notify_cancelled(workers)
+        return cancelled
+
+    @instrumented
+    def delete_job(self, job_id, version):
+        with self._lock:
+            doc = self._docs.get(job_id)
+            if doc is None or doc['version'] != version:
+                raise ConcurrencyError('job_id={}, version={} not found'.format(job_id, version))
+            del self._docs[job_id]
+            self._release_slot(doc)
+            # jobs waiting for a deleted job would be blocked forever
+            unblocked = self._resolve_dependencies([(dependent, job_id, True)
+                                                    for dependent in doc['meta']['dependents']])
+
+        for reqs, run_at in unblocked:
+            self._notify(reqs, run_at)
+
+    @instrumented
+    def set_group_limit(self, group, *, max_locked=None, weight=1):
+        with self._lock:
+            limits = self._group(group)
+            if limits['max_locked'] is None:
+                limits['locked'] = 0  # jobs locked without a limit don't hold slots
+            limits.update(max_locked=max_locked, weight=weight)
+
+    @instrumented
+    def reap_expired_leases(self):
+        reaped = []
+        with self._lock:
+            now = datetime.utcnow()
+            for bucket in self._buckets.values():
+                while True:
+                    top = self._top(bucket.leases, Job.LOCKED)
+                    if top is None or top[0] > now:
+                        break
+                    heapq.heappop(bucket.leases)
+                    doc = self._update_doc(top[2], top[3], status=Job.IDLE, locked_at=None,
+                                           worker_id=None, worker_heartbeat=None, lease_expires_at=None,
+                                           **{'meta.ready_at': now})
+                    reaped.append(doc['reqs'])
+
+        for reqs in reaped:
+            self._notify(reqs, None)
+
+        return len(reaped)
+
+    @instrumented
+    def archive_jobs(self, older_than, *, batch_size=1000):
+        cutoff = datetime.utcnow() - older_than
+        archived = 0
+
+        def expired(doc):
+            finished = doc['status'] in (Job.COMPLETED, Job.CANCELLED) and doc['completed_at'] is not None
+            return finished and doc['completed_at'] < cutoff
+
+        while True:
+            # batches bound the time the lock is held
+            with self._lock:
+                expired_ids = (job_id for job_id, doc in self._docs.items() if expired(doc))
+                batch = list(itertools.islice(expired_ids, batch_size))
+                for job_id in batch:
+                    self._archive[job_id] = self._docs.pop(job_id)
+
+            archived += len(batch)
+            if len(batch) < batch_size:
+                break
+
+        return archived
+
+    ###########################
+    #    IWorkerController    #
+    ###########################
+
+    @instrumented
+    def acquire_job(self, resources, worker_id):
+        jobs = self._acquire_jobs([resources], worker_id, 1)
+        return jobs[0] if jobs else None
+
+    @instrumented
+    def acquire_jobs(self, resources, worker_id, max_jobs):
+        return self._acquire_jobs(resources if isinstance(resources, list) else [resources], worker_id, max_jobs)
+
+    def _acquire_jobs(self, bins, worker_id, max_jobs):
+        limits, max_jobs = _job_limits(bins, max_jobs)
+        jobs = []
+        left = [resources.copy() if limit > 0 else None for resources, limit in zip(bins, limits)]
+        with self._lock:
+            now = datetime.utcnow()
+            while len(jobs) < max_jobs:
+                doc = self._find_available(left, now)
+                if doc is None:
+                    break
+
+                if doc['status'] == Job.IDLE and self._group(doc['group'])['max_locked'] is not None:
+                    doc['meta']['slot'] = True
+                    self._group(doc['group'])['locked'] += 1
+                doc = self._update_doc(doc['job_id'], doc['version'], status=Job.LOCKED, locked_at=now,
+                                       worker_id=worker_id, worker_heartbeat=now,
+                                       lease_expires_at=now + timedelta(seconds=doc['lease']))
+                jobs.append(self._job_from_doc(doc))
+                i = _first_fit(doc['reqs'], left)
+                for k, v in doc['reqs'].items():
+                    left[i][k] -= v
+                limits[i] -= 1
+                if limits[i] <= 0:
+                    left[i] = None
+
+        return jobs
+
+    @instrumented
+    def heartbeat_job(self, job_id, version, lease=None):
+        now = datetime.utcnow()
+        kwargs = {'lease': lease} if lease is not None else {}
+        expires_at = now + (timedelta(seconds=lease) if lease is not None else self.HEARTBEAT_TIMEOUT)
+        return self._update_job(job_id, version, fields=('lease_expires_at',), worker_heartbeat=now,
+                                lease_expires_at=expires_at, **kwargs)
+
+    @instrumented
+    def finalize_job(self, job_id, version, worker_exception=None):
+        return self._update_job(job_id, version, status=Job.COMPLETED, worker_exception=worker_exception,
+                                completed_at=datetime.utcnow())
+
+    @instrumented
+    def finalize_and_acquire(self, job_id, version, worker_exception=None, *, resources, worker_id, max_jobs=1):
+        job = self._update_job(job_id, version, status=Job.COMPLETED, worker_exception=worker_exception,
+                               completed_at=datetime.utcnow())
+        return job, self._acquire_jobs([resources], worker_id, max_jobs)
+
+    @instrumented
+    def requeue_job(self, job_id, version, run_at=None):
+        job = self._update_job(job_id, version, fields=('reqs',), status=Job.IDLE, run_at=run_at,
+                               locked_at=None, completed_at=None, lease_expires_at=None,
+                               worker_id=None, worker_heartbeat=None, worker_exception=None,
+                               **{'meta.ready_at': run_at or datetime.utcnow()})
+        self._notify(job.reqs, run_at)
+        return job
+
+    @instrumented
+    def unlock_job(self, job_id, version):
+        job = self._update_job(job_id, version, fields=('reqs', 'run_at'), status=Job.IDLE, locked_at=None,
+                               lease_expires_at=None, worker_id=None, worker_heartbeat=None)
+        self._notify(job.reqs, job.run_at)
+        return job
+
+    def add_job_listener(self, listener):
+        self._listeners.append(listener)
+        return True
+
+    def remove_job_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def add_cancel_listener(self, listener):
+        self._cancel_listeners.append(listener)
+        return True
+
+    def remove_cancel_listener(self, listener):
+        self._cancel_listeners.remove(listener)
@@ -0,0 +1,241 @@
+import functools
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+__all__ = ['IMetrics', 'Registry', 'PrometheusMetrics', 'start_http_server']
+
+
+class IMetrics:
+    # hooks are called synchronously from the controller and worker threads, so they should be cheap
+
+    def controller_call(self, operation, seconds, error=None):
+        # error is the name of the exception class if the call has failed
+        pass
+
+    def worker_event(self, worker_id, event):
+        # one of acquired, heartbeat, requeued, finalized, outdated, cancelled, revoked
+        pass
+
+    def worker_loop(self, worker_id, phase, seconds):
+        # time spent by the worker loop in one of backoff, step, idle
+        pass
+
+    def worker_state(self, worker_id, *, jobs, available_resources, total_resources, retry_delay):
+        pass
+
+
+def instrumented(method):
+    # reports latency and errors of a controller method to `self._metrics`, if any
+    operation = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self._metrics
+        if metrics is None:
+            return method(self, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception as e:
+            metrics.controller_call(operation, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        metrics.controller_call(operation, time.perf_counter() - started)
+        return result
+
+    return wrapper
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in labels)
+    return '{' + ','.join('{}="{}"'.format(k, v) for (k, _), v in zip(labels, escaped)) + '}'
+
+
+class _Metric:
+    type_ = None
+
+    def __init__(self, name, help_, labelnames, lock):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        self._lock = lock
+        self._values = {}  # label values -> value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def _samples(self, key, value):
+        yield self.name, list(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type_)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            for name, labels, sample in self._samples(key, value):
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(sample)))
+        return lines
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type_ = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+    DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_, labelnames, lock, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_, labelnames, lock)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (not cumulative), sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def get(self, **labels):
+        state = super(Histogram, self).get(**labels)
+        return None if state is None else {'sum': state[1], 'count': state[2]}
+
+    def _samples(self, key, state):
+        labels = list(zip(self.labelnames, key))
+        cumulative = 0
+        for bound, count in zip(self.buckets, list(state[0])):
+            cumulative += count
+            yield self.name + '_bucket', labels + [('le', _format_value(bound))], cumulative
+        yield self.name + '_sum', labels, state[1]
+        yield self.name + '_count', labels, state[2]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_, labelnames=()):
+        return self._register(Counter(name, help_, labelnames, self._lock))
+
+    def gauge(self, name, help_, labelnames=()):
+        return self._register(Gauge(name, help_, labelnames, self._lock))
+
+    def histogram(self, name, help_, labelnames=(), **kwargs):
+        return self._register(Histogram(name, help_, labelnames, self._lock, **kwargs))
+
+    def render(self):
+        # text exposition format understood by Prometheus
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusMetrics(IMetrics):
+    def __init__(self, registry=None, *, prefix='terry'):
+        self.registry = registry or Registry()
+
+        def name(suffix):
+            return '{}_{}'.format(prefix, suffix)
+
+        self.controller_seconds = self.registry.histogram(
+            name('controller_call_seconds'), 'Latency of controller calls.', ['operation'])
+        self.controller_errors = self.registry.counter(
+            name('controller_errors_total'), 'Failed controller calls.', ['operation', 'error'])
+        self.worker_events = self.registry.counter(
+            name('worker_events_total'), 'Job state transitions seen by workers.', ['worker', 'event'])
+        self.worker_loop_seconds = self.registry.counter(
+            name('worker_loop_seconds_total'), 'Time spent by worker loops per phase.', ['worker', 'phase'])
+        self.worker_jobs = self.registry.gauge(
+            name('worker_jobs'), 'Jobs currently held by the worker.', ['worker'])
+        self.worker_resources = self.registry.gauge(
+            name('worker_resources'), 'Worker resources by state.', ['worker', 'resource', 'state'])
+        self.worker_retry_delay = self.registry.gauge(
+            name('worker_retry_delay_seconds'), 'Current backoff delay after retriable errors.', ['worker'])
+
+    def controller_call(self, operation, seconds, error=None):
+        self.controller_seconds.observe(seconds, operation=operation)
+        if error is not None:
+            self.controller_errors.inc(operation=operation, error=error)
+
+    def worker_event(self, worker_id, event):
+        self.worker_events.inc(worker=worker_id, event=event)
+
+    def worker_loop(self, worker_id, phase, seconds):
+        self.worker_loop_seconds.inc(seconds, worker=worker_id, phase=phase)
+
+    def worker_state(self, worker_id, *, jobs, available_resources, total_resources, retry_delay):
+        self.worker_jobs.set(jobs, worker=worker_id)
+        for resource, total in total_resources.items():
+            available = available_resources.get(resource, 0)
+            self.worker_resources.set(total, worker=worker_id, resource=resource, state='total')
+            self.worker_resources.set(total - available, worker=worker_id, resource=resource, state='used')
+        self.worker_retry_delay.set(retry_delay, worker=worker_id)
+
+    def render(self):
+        return self.registry.render()
+
+
+def start_http_server(registry, port, addr=''):
+    # serves registry.render() on every GET in a daemon thread, call shutdown() on the result to stop it
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
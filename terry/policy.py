@@ -0,0 +1,50 @@
+__all__ = ['SelectionPolicy', 'FirstFit', 'BestFit', 'LargestFirst']
+
+
+class SelectionPolicy:
+    # decides which of the jobs fitting into worker resources are acquired first. Controllers know
+    # requirements of their jobs by classes (see Controller._fitting_req_classes), a policy groups them
+    # into tiers which are probed one after another, jobs of one tier are taken by priority and age
+
+    def tiers(self, reqs, bins):
+        # reqs is a list of requirements fitting into one of the resources in bins (see acquire_jobs),
+        # returns lists of their indexes
+        return [list(range(len(reqs)))]
+
+
+class FirstFit(SelectionPolicy):
+    # jobs are taken by priority and age only, whatever their requirements are
+    pass
+
+
+class _ScoredPolicy(SelectionPolicy):
+    def score(self, reqs, resources):
+        # jobs with higher scores go first, by default all of them are in one tier
+        return 0
+
+    def tiers(self, reqs, bins):
+        # requirements are ranked against the largest of the resources
+        resources = {}
+        for r in bins:
+            for k, v in r.items():
+                resources[k] = max(resources.get(k, v), v)
+        scores = [round(self.score(r, resources), 6) for r in reqs]
+        return [[i for i, score in enumerate(scores) if score == tier]
+                for tier in sorted(set(scores), reverse=True)]
+
+
+def _shares(reqs, resources):
+    return [v / resources[k] for k, v in reqs.items() if v > 0]
+
+
+class BestFit(_ScoredPolicy):
+    # jobs which take the largest share of their dominant resource go first, so big jobs
+    # land where they fit tightly instead of stranding the rest of a large worker
+    def score(self, reqs, resources):
+        return max(_shares(reqs, resources), default=0)
+
+
+class LargestFirst(_ScoredPolicy):
+    # jobs which take the largest share of the resources all together go first
+    def score(self, reqs, resources):
+        return sum(_shares(reqs, resources))
@@ -0,0 +1,264 @@
+import multiprocessing
+import queue
+import threading
+import traceback
+
+from .worker import InterruptJob, _RequeueRequested
+
+
+__all__ = ['WorkerProcessPool']
+
+
+class _ChildJobChannel:
+    # JobChannel counterpart living in the worker process, the parent pushes job state to it
+    def __init__(self, job, cancelled, revoked, to_parent):
+        self._to_parent = to_parent
+        self._cancel_event = threading.Event()
+        self.update(job, cancelled, revoked)
+
+    def update(self, job, cancelled, revoked):
+        self._job = job
+        self._cancelled = cancelled
+        self._revoked = revoked
+        if cancelled or revoked:
+            self._cancel_event.set()
+
+    @property
+    def job(self):
+        return self._job
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def revoked(self):
+        return self._revoked
+
+    @property
+    def cancelled_or_revoked(self):
+        return self.cancelled or self.revoked
+
+    def interrupt_if_requested(self):
+        if self.cancelled or self.revoked:
+            raise InterruptJob
+
+    def wait_cancelled(self, timeout=None):
+        return self._cancel_event.wait(timeout)
+
+    def requeue_job(self, run_at=None):
+        self._to_parent.send(('requeue', run_at))
+        raise _RequeueRequested
+
+    def requeue_job_on_error(self):
+        self._to_parent.send(('requeue_on_error',))
+
+
+def _child_main(from_parent, to_parent):
+    runs = queue.Queue()
+    current = {}
+
+    def read_messages():
+        while True:
+            try:
+                msg = from_parent.recv()
+            except EOFError:
+                msg = ('stop',)
+
+            if msg[0] == 'run':
+                runs.put(msg)
+            elif msg[0] == 'state' and 'channel' in current:
+                current['channel'].update(*msg[1:])
+            elif msg[0] == 'stop':
+                runs.put(None)
+                break
+
+    reader = threading.Thread(target=read_messages)
+    reader.daemon = True
+    reader.start()
+
+    while True:
+        msg = runs.get()
+        if msg is None:
+            break
+
+        _, func, job, cancelled, revoked = msg
+        channel = current['channel'] = _ChildJobChannel(job, cancelled, revoked, to_parent)
+        result = {'interrupted': False, 'worker_exception': None}
+        try:
+            func(channel)
+        except InterruptJob:
+            result['interrupted'] = True
+        except _RequeueRequested:
+            pass
+        except Exception as e:
+            result['worker_exception'] = {'reason': str(e), 'traceback': traceback.format_exc()}
+        del current['channel']
+
+        to_parent.send(('done', result))
+
+
+class ProcessJobExecution:
+    def __init__(self, func, channel, on_done=None):
+        self._func = func
+        self._channel = channel
+        self._on_done = on_done
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._process = None
+        self.interrupt_requested = False
+        self.interrupted = False
+        self.worker_exception = None
+
+    @property
+    def has_failed(self):
+        return self.worker_exception is not None
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def interrupt(self):
+        # returns True if the running job has been interrupted
+        with self._lock:
+            if self.interrupt_requested:
+                return False
+            self.interrupt_requested = True
+            if self._process is None:
+                return False
+            # unlike threads, processes can be stopped even inside C extensions
+            self._process.terminate()
+            return True
+
+    def _finish(self):
+        self._done.set()
+        if self._on_done is not None:
+            self._on_done()
+
+
+class WorkerProcess(threading.Thread):
+    # thread in the parent process which runs jobs in its own child process
+    def __init__(self, executions, mp_context, state_poll_interval):
+        super(WorkerProcess, self).__init__()
+        self.daemon = True
+        self._executions = executions
+        self._mp_context = mp_context
+        self._state_poll_interval = state_poll_interval
+        self._process = None
+        self._to_child = None
+        self._from_child = None
+
+    def _spawn(self):
+        from_parent, self._to_child = self._mp_context.Pipe(duplex=False)
+        self._from_child, to_parent = self._mp_context.Pipe(duplex=False)
+        self._process = self._mp_context.Process(target=_child_main, args=(from_parent, to_parent))
+        self._process.daemon = True
+        self._process.start()
+        # we need only our ends of the pipes to get EOFError when the child dies
+        from_parent.close()
+        to_parent.close()
+
+    def _kill(self):
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+        self._to_child.close()
+        self._from_child.close()
+        self._process = None
+
+    def run(self):
+        while True:
+            execution = self._executions.get()
+            if execution is None:
+                break
+            if self._process is None:
+                self._spawn()
+            try:
+                self._run(execution)
+            finally:
+                with execution._lock:
+                    execution._process = None
+                    if execution.interrupt_requested and self._process is not None:
+                        # the child may have been terminated right after finishing the job
+                        self._kill()
+                execution._finish()
+
+        if self._process is not None:
+            try:
+                self._to_child.send(('stop',))
+            except OSError:
+                pass
+            self._process.join(1)
+            self._kill()
+
+    def _state(self, channel):
+        return channel.job, channel.cancelled, channel.revoked
+
+    def _run(self, execution):
+        with execution._lock:
+            if execution.interrupt_requested:
+                # interrupted before the job has been started
+                execution.interrupted = True
+                return
+            execution._process = self._process
+
+        channel = execution._channel
+        state = self._state(channel)
+        try:
+            self._to_child.send(('run', execution._func) + state)
+            while True:
+                if self._from_child.poll(self._state_poll_interval):
+                    msg = self._from_child.recv()
+                    if msg[0] == 'done':
+                        execution.interrupted = msg[1]['interrupted']
+                        execution.worker_exception = msg[1]['worker_exception']
+                        break
+                    elif msg[0] == 'requeue':
+                        try:
+                            channel.requeue_job(msg[1])
+                        except _RequeueRequested:
+                            pass
+                    elif msg[0] == 'requeue_on_error':
+                        channel.requeue_job_on_error()
+                elif not self._process.is_alive():
+                    raise EOFError
+                elif self._state(channel) != state:
+                    state = self._state(channel)
+                    self._to_child.send(('state',) + state)
+        except (EOFError, OSError):
+            # child has been terminated or has crashed
+            self._process.join(1)
+            if execution.interrupt_requested:
+                execution.interrupted = True
+            else:
+                reason = 'worker process has died with exit code {}'.format(self._process.exitcode)
+                execution.worker_exception = {'reason': reason, 'traceback': ''}
+            self._kill()
+        except Exception as e:
+            # e.g. the job function can't be pickled
+            execution.worker_exception = {'reason': str(e), 'traceback': traceback.format_exc()}
+
+
+class WorkerProcessPool:
+    def __init__(self, max_processes, *, mp_context=None, state_poll_interval=0.1):
+        self._max_processes = max_processes
+        self._mp_context = mp_context or multiprocessing.get_context()
+        self._state_poll_interval = state_poll_interval
+        self._executions = queue.Queue()
+        self._processes = []
+
+    def submit(self, func, channel, on_done=None):
+        execution = ProcessJobExecution(func, channel, on_done)
+        self._executions.put(execution)
+        if len(self._processes) < self._max_processes:
+            process = WorkerProcess(self._executions, self._mp_context, self._state_poll_interval)
+            process.start()
+            self._processes.append(process)
+        return execution
+
+    def shutdown(self):
+        for _ in self._processes:
+            self._executions.put(None)
+        self._processes = []
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import threading
+
+from .api import RetriableError
+
+
+__all__ = ['LeaseReaper']
+
+
+class LeaseReaper:
+    def __init__(self, controller, *, interval=60):
+        self._controller = controller
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+
+        # total number of reclaimed leases
+        self.reclaimed = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self.logger.info('Starting lease reaper...')
+        self._thread.start()
+
+    def request_stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def stop(self):
+        self.request_stop()
+        self.join()
+
+    def reap(self):
+        count = self._controller.reap_expired_leases()
+        self.reclaimed += count
+        if count:
+            self.logger.info('Reclaimed %d expired leases', count)
+        return count
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.reap()
+            except RetriableError as e:
+                self.logger.warning('Failed to reclaim expired leases: %s', e)
+            self._stop.wait(self._interval)
+
+
+if __name__ == '__main__':
+    from .controller import Controller
+
+    parser = argparse.ArgumentParser(description='Puts jobs with expired leases back to the queue')
+    parser.add_argument('db_uri')
+    parser.add_argument('--col-name', default='jobs')
+    parser.add_argument('--interval', type=float, default=60)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s\t%(levelname)s:\t%(message)s', level=logging.INFO)
+
+    reaper = LeaseReaper(Controller(args.db_uri, args.col_name), interval=args.interval)
+    reaper.start()
+    try:
+        while reaper.is_running:
+            reaper.join(1)
+    except KeyboardInterrupt:
+        reaper.stop()
@@ -1,12 +1,15 @@
 import ctypes
 import logging
 import math
+import queue
 import random
 import sys
 import threading
 import time
 import traceback
 
+from datetime import datetime
+
 from .api import Job, ConcurrencyError, RetriableError
 
 
@@ -25,17 +28,37 @@ class _RequeueRequested(Exception):
 
 
 class JobContext:
-    def __init__(self, worker_id, job):
+    def __init__(self, worker_id, job, controller=None):
         self.worker_id = worker_id
         self.job = job
+        # controller of the queue the job has been acquired from
+        self.controller = controller
         self.outdated = False
         self.requeue_requested = False
         self.requeue_run_at = None
         self.requeue_on_error = False
+        self.execution = None
+        # when the lease has to be extended and when to check (by a cheap read) that the job is still ours
+        self.heartbeat_at = None
+        self.check_at = None
+        # set once the job is known to be cancelled or revoked, see JobChannel.wait_cancelled
+        self.cancel_event = threading.Event()
+
+    def schedule_heartbeat(self, now):
+        # heartbeats are spaced relative to the lease, so long jobs write rarely
+        # while cancelled or revoked jobs are still noticed within seconds by the checks
+        if self.job.lease is None:  # created by an older version
+            self.heartbeat_at = now + math.pi - random.random()
+        else:
+            self.heartbeat_at = now + self.job.lease / 3 * (1 - random.random() / 4)
+        self.check_at = min(self.heartbeat_at, now + math.pi - random.random())
 
     def update(self, job):
-        self.job = job
+        # state transitions return partial jobs, so fields we already have are kept
+        self.job = self.job.merged(job)
         self.outdated = False
+        if self.cancelled or self.revoked:
+            self.cancel_event.set()
 
     @property
     def cancelled(self):
@@ -74,6 +97,10 @@ class JobChannel:
         if self.cancelled or self.revoked:
             raise InterruptJob
 
+    def wait_cancelled(self, timeout=None):
+        # blocks until the job is cancelled or revoked, returns False if the timeout has expired before
+        return self.__ctx.cancel_event.wait(timeout)
+
     def requeue_job(self, run_at=None):
         self.__ctx.requeue_job(run_at)
         raise _RequeueRequested
@@ -82,9 +109,21 @@ class JobChannel:
         self.__ctx.requeue_on_error = True
 
 
-class WorkerThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
-        super(WorkerThread, self).__init__(*args, **kwargs)
+def format_worker_exception(exc_info):
+    reason = str(exc_info[1])
+    tback = ''.join(traceback.format_exception(*exc_info))
+    return {'reason': reason, 'traceback': tback}
+
+
+class JobExecution:
+    def __init__(self, func, channel, on_done=None, *, interrupt_via_exception=False):
+        self._func = func
+        self._channel = channel
+        self._on_done = on_done
+        self._interrupt_via_exception = interrupt_via_exception
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread_ident = None
         self.interrupt_requested = False
         self.interrupted = False
         self.exc_info = None
@@ -93,15 +132,128 @@ class WorkerThread(threading.Thread):
     def has_failed(self):
         return self.exc_info is not None
 
+    @property
+    def worker_exception(self):
+        return format_worker_exception(self.exc_info) if self.has_failed else None
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def interrupt(self):
+        # returns True if the running job has been interrupted
+        with self._lock:
+            if self.interrupt_requested:
+                return False
+            self.interrupt_requested = True
+            if self._thread_ident is None or not self._interrupt_via_exception:
+                return False
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self._thread_ident),
+                                                       ctypes.py_object(InterruptJob))
+            return True
+
     def run(self):
         try:
-            super(WorkerThread, self).run()
-        except InterruptJob:
-            self.interrupted = True
-        except _RequeueRequested:
-            pass
-        except Exception:
-            self.exc_info = sys.exc_info()
+            with self._lock:
+                if self.interrupt_requested:
+                    # interrupted before the job has been started
+                    self.interrupted = True
+                    return
+                self._thread_ident = threading.get_ident()
+            try:
+                self._func(self._channel)
+            except InterruptJob:
+                self.interrupted = True
+            except _RequeueRequested:
+                pass
+            except Exception:
+                self.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    if self.interrupt_requested:
+                        # job may have finished before the exception was delivered, drop it
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self._thread_ident), None)
+                    self._thread_ident = None
+        finally:
+            self._done.set()
+            if self._on_done is not None:
+                self._on_done()
+
+
+class WorkerThread(threading.Thread):
+    def __init__(self, executions):
+        super(WorkerThread, self).__init__()
+        self.daemon = True  # to make force stop possible
+        self._executions = executions
+
+    def run(self):
+        while True:
+            execution = self._executions.get()
+            if execution is None:
+                break
+            try:
+                execution.run()
+            except InterruptJob:
+                pass  # interrupt has been delivered after the job had finished
+
+
+class WorkerThreadPool:
+    def __init__(self, max_threads, *, interrupt_via_exception=False):
+        self._max_threads = max_threads
+        self._interrupt_via_exception = interrupt_via_exception
+        self._executions = queue.Queue()
+        self._threads = []
+
+    def submit(self, func, channel, on_done=None):
+        execution = JobExecution(func, channel, on_done, interrupt_via_exception=self._interrupt_via_exception)
+        self._executions.put(execution)
+        if len(self._threads) < self._max_threads:
+            thread = WorkerThread(self._executions)
+            thread.start()
+            self._threads.append(thread)
+        return execution
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._executions.put(None)
+        self._threads = []
+
+
+class QueueScheduler:
+    # stride scheduling over the queues a worker is subscribed to: every acquired job advances the pass
+    # of its queue by 1/weight and queues are polled in the order of their passes, so busy queues get
+    # jobs in proportion to their weights and ties go to the queue listed first
+    def __init__(self, controller, queues=None):
+        # queues is a list of names or (name, weight) pairs, None is the controller's own queue only
+        self._queues = []
+        if queues is None:
+            self._queues.append({'controller': controller, 'weight': 1, 'rank': 0, 'pass': 0.0})
+        for rank, spec in enumerate(queues or []):
+            name, weight = spec if isinstance(spec, tuple) else (spec, 1)
+            if weight <= 0:
+                raise ValueError('weight of queue {!r} must be positive'.format(name))
+            self._queues.append({'controller': controller.queue(name), 'weight': weight,
+                                 'rank': rank, 'pass': 0.0})
+        self._virtual_time = 0.0
+
+    @property
+    def controllers(self):
+        return [q['controller'] for q in self._queues]
+
+    def order(self):
+        # queues which had no jobs don't build up credit, otherwise they would get a burst later
+        for q in self._queues:
+            q['pass'] = max(q['pass'], self._virtual_time)
+        queues = sorted(self._queues, key=lambda q: (q['pass'], q['rank']))
+        return [q['controller'] for q in queues]
+
+    def acquired(self, controller, count):
+        for q in self._queues:
+            if q['controller'] is controller and count:
+                self._virtual_time = q['pass']
+                q['pass'] += count / q['weight']
 
 
 def substract_resources(r1, r2):
@@ -115,6 +267,10 @@ def substract_resources(r1, r2):
     return result
 
 
+def fits_resources(reqs, resources):
+    return all(k in resources and v <= resources[k] for k, v in reqs.items())
+
+
 class ResourceManager:
     def get_current_resources(self):
         pass
@@ -148,19 +304,41 @@ class BasicResourceManager(ResourceManager):
 
 
 class Worker:
-    def __init__(self, id_, resources, worker_func, controller, *, interrupt_via_exception=False):
+    # fallback polling interval for controllers which push job notifications, it bounds the delay of jobs
+    # created or requeued by controllers without signals
+    IDLE_POLL_INTERVAL = 5
+
+    def __init__(self, id_, resources, worker_func, controller, *, max_jobs=1, prefetch=0,
+                 interrupt_via_exception=False, executor=None, metrics=None, queues=None, dispatcher=None):
         self._id = id_
         self._resources = resources
         self._worker_func = worker_func
-        self._controller = controller
-        self._interrupt_via_exception = interrupt_via_exception
-
-        # current job and worker thread
-        self._job_ctx = None
-        self._worker_thread = None
+        # queues the worker acquires jobs from, see QueueScheduler
+        self._queues = QueueScheduler(controller, queues)
+        # optional Dispatcher which acquires jobs and batches heartbeats for all workers of the process,
+        # it's used instead of the queues then
+        self._dispatcher = dispatcher
+        self._max_jobs = max_jobs
+        self._prefetch = prefetch
+        # optional IMetrics, resources the worker has started with are reported as total
+        self._metrics = metrics
+        self._total_resources = {}
+
+        # current jobs (job_id -> JobContext) and threads (or processes, see WorkerProcessPool) executing them,
+        # up to `prefetch` jobs are locked in advance and wait for a free thread with their resources reserved
+        self._jobs = {}
+        self._executor = executor or WorkerThreadPool(max_jobs, interrupt_via_exception=interrupt_via_exception)
 
         self._stop = threading.Event()
         self._force_stop = threading.Event()
+        self._wakeup = threading.Event()
+
+        # when to try to acquire new jobs and whether the controller has pushed a job since the last attempt
+        self._acquire_at = 0
+        self._job_available = False
+        self._push_notifications = False
+        # whether the controller has told us that some of our jobs may have been cancelled
+        self._jobs_cancelled = False
 
         # TODO: handle exception in _main_loop
         self._main_loop_thread = threading.Thread(target=self._loop)
@@ -177,16 +355,25 @@ class Worker:
 
     @property
     def is_busy(self):
-        return self._job_ctx is not None
+        return bool(self._jobs)
 
     def start(self):
         self.logger.info('[%s] Available resources %r', self._id, self._resources.get_current_resources())
         self.logger.info('[%s] Starting worker...', self._id)
+        self._total_resources = self._resources.get_current_resources()
+        if self._dispatcher is not None:
+            self._dispatcher.attach(self)
+        else:
+            self._push_notifications = all([controller.add_job_listener(self._on_job_available)
+                                            for controller in self._queues.controllers])
+            for controller in self._queues.controllers:
+                controller.add_cancel_listener(self._on_jobs_cancelled)
         self._main_loop_thread.start()
 
     def request_stop(self):
         self.logger.info('[%s] Got request to stop...', self._id)
         self._stop.set()
+        self._wakeup.set()
 
     def join(self, timeout=None):
         if timeout is None:
@@ -200,33 +387,89 @@ class Worker:
         self.request_stop()
         self.join()
 
+    def _on_job_available(self, reqs, run_at):
+        # called from the controller's thread
+        if len(self._jobs) >= self._max_jobs + self._prefetch:
+            return
+        if not fits_resources(reqs, self._resources.get_current_resources()):
+            return
+
+        delay = 0 if run_at is None else (run_at - datetime.utcnow()).total_seconds()
+        if delay > 0:
+            self._acquire_at = min(self._acquire_at, time.time() + delay)
+        else:
+            self._job_available = True
+            self._wakeup.set()
+
+    def _on_jobs_cancelled(self, worker_id):
+        # called from the controller's (or dispatcher's) thread, our jobs are checked by the next step
+        lock_id = self._id if self._dispatcher is None else self._dispatcher.id
+        if worker_id == lock_id:
+            self._jobs_cancelled = True
+            self._wakeup.set()
+
+    def _record_event(self, event):
+        if self._metrics is not None:
+            self._metrics.worker_event(self._id, event)
+
+    def _record_loop(self, phase, started):
+        if self._metrics is not None:
+            self._metrics.worker_loop(self._id, phase, time.time() - started)
+
+    def _record_state(self, retry_delay):
+        if self._metrics is not None:
+            self._metrics.worker_state(self._id, jobs=len(self._jobs),
+                                       available_resources=self._resources.get_current_resources(),
+                                       total_resources=self._total_resources, retry_delay=retry_delay)
+
     def _reclaim_resources(self, resources):
         self._resources.reclaim(resources)
         self.logger.debug('[%s] Reclaimed resources: %r', self._id, resources)
 
-    def _reset_current_job(self):
-        assert self._job_ctx is not None
-        assert self._worker_thread is not None
-        assert not self._worker_thread.is_alive()
+    def _reset_job(self, ctx):
+        assert ctx.execution is None or not ctx.execution.is_alive()
+
+        self._reclaim_resources(ctx.job.reqs)
+        del self._jobs[ctx.job.id]
+        # freed resources may fit jobs we have skipped before
+        self._acquire_at = 0
+        if self._dispatcher is not None:
+            self._dispatcher.notify()
+
+    # hooks of Dispatcher, called from its thread
+
+    def dispatch_capacity(self):
+        # how many jobs the dispatcher may acquire for us
+        if self._stop.is_set():
+            return 0
+        return max(0, self._max_jobs + self._prefetch - len(self._jobs))
 
-        self._reclaim_resources(self._job_ctx.job.reqs)
-        self._job_ctx = None
-        self._worker_thread = None
+    def acquire_resources(self):
+        # resources the dispatcher acquires jobs with, they are reserved until reclaim_resources
+        return self._resources.acquire()
 
-    def _should_requeue_current_job(self):
-        assert self._job_ctx is not None
-        assert self._worker_thread is not None
-        assert not self._worker_thread.is_alive()
+    def reclaim_resources(self, resources):
+        self._reclaim_resources(resources)
 
-        return self._job_ctx.requeue_requested or \
-            self._worker_thread.has_failed and self._job_ctx.requeue_on_error
+    def notify_jobs_dispatched(self):
+        # jobs may be waiting in the dispatcher, see Dispatcher.take
+        self._wakeup.set()
+
+    def notify_jobs_cancelled(self):
+        # some jobs locked under the dispatcher's id have been cancelled
+        self._on_jobs_cancelled(self._dispatcher.id)
+
+    def _should_requeue_job(self, ctx):
+        assert not ctx.execution.is_alive()
+
+        return ctx.requeue_requested or ctx.execution.has_failed and ctx.requeue_on_error
 
     def _loop(self):
         #
         retry_delay = 0
         #
         while True:
-            if self._stop.is_set() and self._job_ctx is None:
+            if self._stop.is_set() and not self._jobs:
                 break
 
             if self._force_stop.is_set():
@@ -234,129 +477,289 @@ class Worker:
 
             if retry_delay:
                 # aka exponential backoff for retriable errors
+                started = time.time()
                 time.sleep(retry_delay)
+                self._record_loop('backoff', started)
 
+            self._wakeup.clear()
+            started = time.time()
             try:
-                if self._job_ctx is None:
-                    self._try_acquire_job()
-
-                elif self._job_ctx.outdated:
-                    self._try_update_current_job()
-
-                elif self._job_ctx.cancelled or self._job_ctx.revoked:
-                    self._wait_for_worker_thread_and_cleanup()
-
-                elif self._worker_thread.is_alive():
-                    self._try_heartbeat_current_job()
-
-                elif self._should_requeue_current_job():
-                    self._try_requeue_current_job()
-
-                else:  # worker has finished processing the job
-                    self._try_finalize_current_job()
-
+                timeout = self._step()
             except RetriableError:
                 retry_delay = 1 if retry_delay == 0 else min(10, retry_delay * 2)
+                self._record_loop('step', started)
             else:
                 retry_delay = 0
+                self._record_loop('step', started)
+                if timeout:
+                    # sleep until some job needs attention or an execution finishes
+                    started = time.time()
+                    self._wakeup.wait(timeout)
+                    self._record_loop('idle', started)
 
-    def _try_acquire_job(self):
+            self._record_state(retry_delay)
+
+        if self._dispatcher is not None:
+            self._dispatcher.detach(self)
+        else:
+            for controller in self._queues.controllers:
+                controller.remove_job_listener(self._on_job_available)
+                controller.remove_cancel_listener(self._on_jobs_cancelled)
+        self._executor.shutdown()
+
+    def _step(self):
+        # returns how long the loop may sleep before the next step
+        if self._jobs_cancelled:
+            # instead of waiting for the next heartbeat, a cheap read tells which of the jobs have been cancelled
+            self._jobs_cancelled = False
+            for ctx in self._jobs.values():
+                ctx.check_at = 0
+
+        timeouts = [self._process_job(ctx) for ctx in list(self._jobs.values())]
+
+        if not self._stop.is_set():
+            self._start_prefetched_jobs()
+            timeouts.append(self._try_acquire_jobs())
+
+        return min((t for t in timeouts if t is not None), default=None)
+
+    def _process_job(self, ctx):
+        if ctx.outdated:
+            self._try_update_job(ctx)
+            return 0
+
+        elif ctx.cancelled or ctx.revoked:
+            return self._wait_for_execution_and_cleanup(ctx)
+
+        elif ctx.execution is None and self._stop.is_set():
+            # hand back prefetched job which has not been started
+            self._try_requeue_job(ctx)
+            return 0
+
+        elif ctx.execution is None or ctx.execution.is_alive():
+            return self._try_heartbeat_job(ctx)
+
+        elif self._should_requeue_job(ctx):
+            self._try_requeue_job(ctx)
+            return 0
+
+        else:  # worker has finished processing the job
+            self._try_finalize_job(ctx)
+            return 0
+
+    def _try_acquire_jobs(self):
+        if self._dispatcher is not None:
+            # the dispatcher wakes us up when it has acquired something
+            for job, controller in self._dispatcher.take(self):
+                self._add_job(JobContext(self._dispatcher.id, job, controller))
+            self._start_prefetched_jobs()
+            return self.IDLE_POLL_INTERVAL
+
+        now = time.time()
+        if now < self._acquire_at and not self._job_available:
+            return self._acquire_at - now
+
+        capacity = self._max_jobs + self._prefetch
+        if len(self._jobs) >= capacity:
+            return None
+
+        self._job_available = False
+        if self._try_acquire_job_batch(capacity - len(self._jobs)):
+            # leftover resources may fit more work
+            return 0
+
+        if self._job_available:
+            # controller has notified us while we were acquiring, try again
+            return 0
+
+        self._schedule_acquire(now)
+        return self._acquire_at - now
+
+    def _schedule_acquire(self, now):
+        # there are no fitting jobs, poll again later
+        if self._push_notifications:
+            self._acquire_at = now + self.IDLE_POLL_INTERVAL - random.random()
+        else:
+            self._acquire_at = now + math.e - random.random()
+
+    def _try_acquire_job_batch(self, max_jobs):
         # lock resources from manager
         resources = self._resources.acquire()
         self.logger.debug('[%s] Acquired resources: %r', self._id, resources)
-        try:
-            job = self._controller.acquire_job(resources, self._id)
-        except ConcurrencyError:
-            job = None
-        except RetriableError:
-            self._reclaim_resources(resources)
-            raise
-
-        if job:
-            self._job_ctx = JobContext(self.id, job)
-            self.logger.info('[%s] Acquired job %s', self._id, self._job_ctx.job.id)
-            self._worker_thread = WorkerThread(target=self._worker_func, args=(JobChannel(self._job_ctx),))
-            self._worker_thread.daemon = True  # to make force stop possible
-            self._worker_thread.start()
-            # reclaim leftovers
-            self._reclaim_resources(substract_resources(resources, job.reqs))
-        else:
-            self._reclaim_resources(resources)
-            time.sleep(math.e - random.random())
+        acquired = 0
+        for controller in self._queues.order():
+            if acquired == max_jobs:
+                break
+            try:
+                if max_jobs - acquired == 1:
+                    job = controller.acquire_job(resources, self._id)
+                    jobs = [job] if job else []
+                else:
+                    jobs = controller.acquire_jobs(resources, self._id, max_jobs - acquired)
+            except ConcurrencyError:
+                jobs = []
+            except RetriableError:
+                self._reclaim_resources(resources)
+                raise
+
+            self._queues.acquired(controller, len(jobs))
+            for job in jobs:
+                self._add_job(JobContext(self.id, job, controller))
+                resources = substract_resources(resources, job.reqs)
+            acquired += len(jobs)
+
+        # reclaim leftovers
+        self._reclaim_resources(resources)
+        self._start_prefetched_jobs()
+        return acquired
+
+    def _add_job(self, ctx):
+        ctx.schedule_heartbeat(time.time())
+        self._jobs[ctx.job.id] = ctx
+        self._record_event('acquired')
+        self.logger.info('[%s] Acquired job %s', self._id, ctx.job.id)
+
+    def _start_prefetched_jobs(self):
+        running = sum(1 for ctx in self._jobs.values() if ctx.execution is not None)
+        for ctx in list(self._jobs.values()):
+            if running >= self._max_jobs:
+                break
+            if ctx.execution is None:
+                ctx.execution = self._executor.submit(self._worker_func, JobChannel(ctx),
+                                                      on_done=self._wakeup.set)
+                running += 1
 
-    def _try_update_current_job(self):
-        job = self._controller.get_job(self._job_ctx.job.id)
+    def _try_update_job(self, ctx):
+        job = ctx.controller.refresh_job(ctx.job.id)
 
-        self._job_ctx.update(job)
+        ctx.update(job)
 
-        if self._job_ctx.cancelled:
-            self.logger.info('[%s] It seems job %s was cancelled', self._id, self._job_ctx.job.id)
+        if ctx.cancelled:
+            self._record_event('cancelled')
+            self.logger.info('[%s] It seems job %s was cancelled', self._id, ctx.job.id)
 
-        if self._job_ctx.revoked:
-            self.logger.info('[%s] It seems job %s was taken from us', self._id, self._job_ctx.job.id)
+        if ctx.revoked:
+            self._record_event('revoked')
+            self.logger.info('[%s] It seems job %s was taken from us', self._id, ctx.job.id)
 
-    def _wait_for_worker_thread_and_cleanup(self):
-        if self._worker_thread.is_alive():
-            if self._interrupt_via_exception and not self._worker_thread.interrupt_requested:
-                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self._worker_thread.ident),
-                                                           ctypes.py_object(InterruptJob))
-                self._worker_thread.interrupt_requested = True
-                self.logger.info('[%s] Worker thread with job %s was interrupted via exception',
-                                 self._id, self._job_ctx.job.id)
+    def _wait_for_execution_and_cleanup(self, ctx):
+        if ctx.execution is not None and ctx.execution.is_alive():
+            if ctx.execution.interrupt():
+                self.logger.info('[%s] Execution of job %s was interrupted', self._id, ctx.job.id)
 
-            self._worker_thread.join(math.pi - random.random())
+            return math.pi - random.random()
         else:
-            self.logger.info('[%s] Processing of job %s was terminated', self._id, self._job_ctx.job.id)
-            self._reset_current_job()
+            self.logger.info('[%s] Processing of job %s was terminated', self._id, ctx.job.id)
+            self._reset_job(ctx)
+            return 0
+
+    def _try_heartbeat_job(self, ctx):
+        now = time.time()
+        if now < ctx.check_at:
+            return ctx.check_at - now
+
+        if now < ctx.heartbeat_at:
+            return self._try_check_job(ctx, now)
 
-    def _try_heartbeat_current_job(self):
         try:
-            job = self._controller.heartbeat_job(self._job_ctx.job.id, self._job_ctx.job.version)
+            if self._dispatcher is not None:
+                job = self._dispatcher.heartbeat_job(ctx.controller, ctx.job.id, ctx.job.version, lease=ctx.job.lease)
+            else:
+                job = ctx.controller.heartbeat_job(ctx.job.id, ctx.job.version, lease=ctx.job.lease)
         except ConcurrencyError:
             job = None
 
         if job:
-            self._job_ctx.update(job)
-            self._worker_thread.join(math.pi - random.random())
+            ctx.update(job)
+            ctx.schedule_heartbeat(now)
+            self._record_event('heartbeat')
+            return ctx.check_at - now
         else:
-            self._job_ctx.outdated = True
+            ctx.outdated = True
+            self._record_event('outdated')
             self.logger.info('[%s] Failed to heartbeat job %s due to version mismatch',
-                             self._id, self._job_ctx.job.id)
-
-    def _try_requeue_current_job(self):
-        assert not self._worker_thread.is_alive()
-        # requeue current job with new run_at time
+                             self._id, ctx.job.id)
+            return 0
+
+    def _try_check_job(self, ctx, now):
+        job = ctx.controller.refresh_job(ctx.job.id, fields=Job.STATE_FIELDS)
+        if job is None or job.version != ctx.job.version:
+            # the job has been changed by someone else, it's refetched by the next step
+            ctx.outdated = True
+            self._record_event('outdated')
+            return 0
+
+        ctx.check_at = min(ctx.heartbeat_at, now + math.pi - random.random())
+        return ctx.check_at - now
+
+    def _try_requeue_job(self, ctx):
+        assert ctx.execution is None or not ctx.execution.is_alive()
+        # requeue job with new run_at time
         try:
-            self._controller.requeue_job(self._job_ctx.job.id, self._job_ctx.job.version,
-                                         run_at=self._job_ctx.requeue_run_at)
+            ctx.controller.requeue_job(ctx.job.id, ctx.job.version, run_at=ctx.requeue_run_at)
         except ConcurrencyError:
-            self._job_ctx.outdated = True
+            ctx.outdated = True
+            self._record_event('outdated')
             self.logger.info('[%s] Failed to mark job %s as completed due to version mismatch',
-                             self._id, self._job_ctx.job.id)
+                             self._id, ctx.job.id)
+        else:
+            self._record_event('requeued')
+            self.logger.info('[%s] Job %s has been requeued', self._id, ctx.job.id)
+            self._reset_job(ctx)
+
+    def _try_finalize_job(self, ctx):
+        assert not ctx.execution.is_alive()
+        if self._dispatcher is not None or self._stop.is_set():
+            try:
+                job = ctx.controller.finalize_job(ctx.job.id, ctx.job.version,
+                                                  worker_exception=ctx.execution.worker_exception)
+            except ConcurrencyError:
+                job = None
+            if job:
+                self._reset_job(ctx)
         else:
-            self.logger.info('[%s] Job %s has been requeued', self._id, self._job_ctx.job.id)
-            self._reset_current_job()
-
-    def _try_finalize_current_job(self):
-        assert not self._worker_thread.is_alive()
-        # worker thread has finished, we should mark job as COMPLETED
-        if self._worker_thread.has_failed:
-            reason = str(self._worker_thread.exc_info[1])
-            tback = ''.join(traceback.format_exception(*self._worker_thread.exc_info))
-            worker_exception = {'reason': reason, 'traceback': tback}
+            job = self._try_finalize_and_acquire(ctx)
+
+        if job:
+            self._record_event('finalized')
+            self.logger.info('[%s] Job %s has been processed', self._id, ctx.job.id)
         else:
-            worker_exception = None
+            ctx.outdated = True
+            self._record_event('outdated')
+            self.logger.info('[%s] Failed to mark job %s as completed due to version mismatch',
+                             self._id, ctx.job.id)
 
+    def _try_finalize_and_acquire(self, ctx):
+        # job execution has finished, we mark the job as COMPLETED and lock the next jobs from the same queue
+        # with one controller call, resources of the finished job are handed over to them
+        resources = self._resources.acquire()
+        available = resources.copy()
+        for k, v in ctx.job.reqs.items():
+            available[k] = available.get(k, 0) + v
+        max_jobs = self._max_jobs + self._prefetch - len(self._jobs) + 1
         try:
-            job = self._controller.finalize_job(self._job_ctx.job.id, self._job_ctx.job.version,
-                                                worker_exception=worker_exception)
+            job, jobs = ctx.controller.finalize_and_acquire(ctx.job.id, ctx.job.version,
+                                                            worker_exception=ctx.execution.worker_exception,
+                                                            resources=available, worker_id=self._id,
+                                                            max_jobs=max_jobs)
         except ConcurrencyError:
-            job = None
+            self._reclaim_resources(resources)
+            return None
+        except RetriableError:
+            self._reclaim_resources(resources)
+            raise
 
-        if job:
-            self.logger.info('[%s] Job %s has been processed', self._id, self._job_ctx.job.id)
-            self._reset_current_job()
+        del self._jobs[ctx.job.id]
+        self._queues.acquired(ctx.controller, len(jobs))
+        for acquired in jobs:
+            self._add_job(JobContext(self.id, acquired, ctx.controller))
+            available = substract_resources(available, acquired.reqs)
+        self._reclaim_resources(available)
+        self._start_prefetched_jobs()
+
+        if jobs or len(self._queues.controllers) > 1:
+            # leftover resources or other queues may have more work
+            self._acquire_at = 0
         else:
-            self._job_ctx.outdated = True
-            self.logger.info('[%s] Failed to mark job %s as completed due to version mismatch',
-                             self._id, self._job_ctx.job.id)
+            self._schedule_acquire(time.time())
+        return job
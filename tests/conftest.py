@@ -1,17 +1,38 @@
 import pytest
 
 from terry.controller import Controller
+from terry.memory import MemoryController
 from terry.worker import Worker, BasicResourceManager
 
 
 @pytest.fixture
-def controller():
+def db_uri():
     db_uri = 'mongodb://localhost/terry-tests'
 
     import pymongo
     client = pymongo.MongoClient(db_uri)
     client.drop_database(client.get_default_database().name)
-    yield Controller(db_uri)
+    return db_uri
+
+
+@pytest.fixture(params=['mongo', 'memory'])
+def controller(request):
+    if request.param == 'mongo':
+        controller = Controller(request.getfixturevalue('db_uri'))
+    else:
+        controller = MemoryController()
+    yield controller
+    controller.close()
+
+
+@pytest.fixture(params=['mongo', 'memory'])
+def notifying_controller(request):
+    if request.param == 'mongo':
+        controller = Controller(request.getfixturevalue('db_uri'), signals=True)
+    else:
+        controller = MemoryController()
+    yield controller
+    controller.close()
 
 
 @pytest.fixture
@@ -0,0 +1,193 @@
+import asyncio
+
+from datetime import timedelta
+
+import pytest
+
+from terry.aio import AsyncController, AsyncWorker
+from terry.api import Job
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def process_jobs(controller, resource_manager, work_func, until):
+    worker = AsyncWorker('test-worker', resource_manager, work_func, AsyncController(controller), max_jobs=4)
+    task = asyncio.ensure_future(worker.run())
+    try:
+        await until()
+    finally:
+        worker.request_stop()
+        await task
+
+
+@pytest.mark.timeout(10)
+def test_async_worker_runs_jobs_concurrently(controller, resource_manager):
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 0})
+
+    started = []
+
+    async def work_func(channel):
+        started.append(channel.job.id)
+        # completes only when all the jobs are running at the same time
+        while len(started) < len(job_ids):
+            await asyncio.sleep(0.01)
+
+    async def until():
+        while not all(controller.get_job(job_id).status == Job.COMPLETED for job_id in job_ids):
+            await asyncio.sleep(0.01)
+
+    run(process_jobs(controller, resource_manager, work_func, until))
+
+    for job_id in job_ids:
+        job = controller.get_job(job_id)
+        assert job.worker_exception is None
+        assert job.worker_id == 'test-worker'
+
+
+@pytest.mark.timeout(10)
+def test_async_worker_job_exception(controller, resource_manager):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    async def work_func(channel):
+        raise Exception('exception from job')
+
+    async def until():
+        while controller.get_job(job_id).status != Job.COMPLETED:
+            await asyncio.sleep(0.01)
+
+    run(process_jobs(controller, resource_manager, work_func, until))
+
+    job = controller.get_job(job_id)
+    assert job.worker_exception['reason'] == 'exception from job'
+
+
+@pytest.mark.timeout(10)
+def test_async_worker_job_cancel(controller, resource_manager):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    cancelled = asyncio.Event()
+
+    async def work_func(channel):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def until():
+        while controller.get_job(job_id).status != Job.LOCKED:
+            await asyncio.sleep(0.01)
+        job = controller.get_job(job_id)
+        controller.cancel_job(job_id, job.version)
+        await cancelled.wait()
+
+    run(process_jobs(controller, resource_manager, work_func, until))
+
+    assert controller.get_job(job_id).status == Job.CANCELLED
+
+
+@pytest.mark.timeout(10)
+def test_async_worker_wait_cancelled(controller, resource_manager):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    waited = []
+
+    async def work_func(channel):
+        waited.append(await channel.wait_cancelled(0.05))
+        # the event loop keeps running while the job waits, so the worker notices the cancellation
+        try:
+            await channel.wait_cancelled()
+        finally:
+            waited.append('interrupted')
+
+    async def until():
+        while not waited:
+            await asyncio.sleep(0.01)
+        job = controller.get_job(job_id)
+        controller.cancel_job(job_id, job.version)
+        while len(waited) < 2:
+            await asyncio.sleep(0.01)
+
+    run(process_jobs(controller, resource_manager, work_func, until))
+
+    assert waited == [False, 'interrupted']
+    assert controller.get_job(job_id).status == Job.CANCELLED
+
+
+@pytest.mark.timeout(10)
+def test_async_controller(controller):
+    async def scenario():
+        async_controller = AsyncController(controller)
+        job_id = async_controller.create_job_id()
+        await async_controller.create_job(job_id, reqs={'cpu': 1}, args={'x': 1})
+
+        job = await async_controller.acquire_job({'cpu': 1}, 'test-worker')
+        assert job.id == job_id and job.args == {'x': 1}
+
+        job = await async_controller.heartbeat_job(job.id, job.version)
+        job = await async_controller.finalize_job(job.id, job.version)
+        assert job.status == Job.COMPLETED
+
+        await async_controller.create_jobs({'job_id': async_controller.create_job_id()} for _ in range(4))
+        jobs = []
+        async for job in async_controller.iter_jobs(status=Job.IDLE, batch_size=2):
+            jobs.append(job)
+        assert len(jobs) == 4
+
+        assert await async_controller.archive_jobs(timedelta(0)) == 1
+        assert await async_controller.get_job(job_id) is None
+        await async_controller.close()
+
+    run(scenario())
+
+
+@pytest.mark.timeout(10)
+def test_async_worker_heartbeats_jobs_in_batches(controller, resource_manager, monkeypatch):
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 0}, lease=0.3)
+
+    batches = []
+    heartbeat_jobs = controller.heartbeat_jobs
+
+    def counting_heartbeat_jobs(jobs):
+        batches.append(len(jobs))
+        return heartbeat_jobs(jobs)
+
+    monkeypatch.setattr(controller, 'heartbeat_jobs', counting_heartbeat_jobs)
+
+    started = []
+
+    async def work_func(channel):
+        started.append(channel.job.id)
+        while len(started) < len(job_ids) or len(batches) < 3:
+            await asyncio.sleep(0.01)
+
+    # created outside of the loop which runs it
+    worker = AsyncWorker('test-worker', resource_manager, work_func, AsyncController(controller), max_jobs=4)
+
+    async def scenario():
+        task = asyncio.ensure_future(worker.run())
+        try:
+            while not all(controller.get_job(job_id).status == Job.COMPLETED for job_id in job_ids):
+                await asyncio.sleep(0.01)
+        finally:
+            worker.request_stop()
+            await task
+
+    run(scenario())
+
+    assert max(batches) > 1
+    for job_id in job_ids:
+        assert controller.get_job(job_id).worker_exception is None
@@ -1,4 +1,10 @@
-from terry.api import Job
+import pytest
+import pymongo
+
+from datetime import datetime, timedelta
+
+from terry.api import Job, ConcurrencyError, RetriableError
+from terry.controller import Controller, _req_class
 
 
 def test_create_job(controller):
@@ -52,9 +58,630 @@ def test_reacquire_job(controller):
     job = controller.acquire_job({'cpu': 1}, 'test-worker')
     assert job.id == job_id
 
-    from datetime import datetime, timedelta
-    fake_heartbeat = datetime.utcnow() - controller.HEARTBEAT_TIMEOUT - timedelta(minutes=1)
-    controller._update_job(job.id, job.version, worker_heartbeat=fake_heartbeat)
+    expired_at = datetime.utcnow() - timedelta(minutes=1)
+    controller._update_job(job.id, job.version, lease_expires_at=expired_at)
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    assert job.id == job_id
+
+
+def test_create_jobs(controller):
+    existing_id = controller.create_job_id()
+    controller.create_job(existing_id, args={'payload': 0})
+
+    job_ids = [controller.create_job_id() for _ in range(5)]
+    specs = [{'job_id': job_id, 'reqs': {'cpu': 1}, 'args': {'payload': i}}
+             for i, job_id in enumerate(job_ids)]
+    specs.insert(2, {'job_id': existing_id})
+
+    result = controller.create_jobs(specs, batch_size=2)
+
+    assert result.created == job_ids
+    assert result.existing == [existing_id]
+    assert result.failed == {}
+
+    assert controller.get_job(job_ids[3]).args == {'payload': 3}
+    assert controller.get_job(existing_id).args == {'payload': 0}
+
+
+def test_stale_version(controller):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    controller.heartbeat_job(job.id, job.version)
+
+    with pytest.raises(ConcurrencyError):
+        controller.finalize_job(job.id, job.version)
+
+
+def test_requeue_job_run_at(controller):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    controller.requeue_job(job.id, job.version, run_at=datetime.utcnow() + timedelta(minutes=1))
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    assert job is None
+
+
+def test_acquire_job_priority(controller):
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    controller.create_job(job_ids[0], reqs={'cpu': 1})
+    controller.create_job(job_ids[1], reqs={'cpu': 1}, priority=10)
+    controller.create_job(job_ids[2], reqs={'cpu': 1})
+
+    acquired = [controller.acquire_job({'cpu': 1}, 'test-worker').id for _ in range(3)]
+    assert acquired == [job_ids[1], job_ids[0], job_ids[2]]
+
+
+def test_requeued_job_goes_to_the_back(controller):
+    job_ids = [controller.create_job_id() for _ in range(2)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    assert job.id == job_ids[0]
+    controller.requeue_job(job.id, job.version)
+
+    acquired = [controller.acquire_job({'cpu': 1}, 'test-worker').id for _ in range(2)]
+    assert acquired == job_ids[1:] + job_ids[:1]
+
+
+def test_acquire_job_without_reacquire(controller):
+    controller._reacquire_locked = False
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+    expired_at = datetime.utcnow() - timedelta(minutes=1)
+    controller._update_job(job.id, job.version, lease_expires_at=expired_at)
+
+    assert controller.acquire_job({'cpu': 1}, 'test-worker') is None
+    assert controller.reap_expired_leases() == 1
+    assert controller.acquire_job({'cpu': 1}, 'test-worker').id == job_id
 
+
+def test_acquire_jobs(controller):
+    job_ids = [controller.create_job_id() for _ in range(4)]
+    for job_id, cpu in zip(job_ids, [2, 2, 1, 1]):
+        controller.create_job(job_id, reqs={'cpu': cpu})
+
+    jobs = controller.acquire_jobs({'cpu': 3}, 'test-worker', 5)
+    assert [job.id for job in jobs] == [job_ids[0], job_ids[2]]
+    assert all(job.status == Job.LOCKED and job.worker_id == 'test-worker' for job in jobs)
+
+    jobs = controller.acquire_jobs({'cpu': 1}, 'test-worker', 5)
+    assert [job.id for job in jobs] == [job_ids[3]]
+
+
+def test_archive_jobs(controller):
+    finished = [controller.create_job_id() for _ in range(3)]
+    for job_id in finished:
+        controller.create_job(job_id)
+    active_id = controller.create_job_id()
+    controller.create_job(active_id)
+
+    for job_id in finished[:2]:
+        job = controller.acquire_job({}, 'test-worker')
+        controller.finalize_job(job.id, job.version)
+    job = controller.get_job(finished[2])
+    job = controller.cancel_job(job.id, job.version)
+    assert job.completed_at is not None
+
+    assert controller.archive_jobs(timedelta(hours=1)) == 0
+    assert controller.archive_jobs(timedelta(0), batch_size=2) == 3
+
+    for job_id in finished:
+        assert controller.get_job(job_id) is None
+        assert controller.get_job(job_id, include_archived=True).status in (Job.COMPLETED, Job.CANCELLED)
+    assert controller.get_job(active_id).status == Job.IDLE
+    assert controller.get_job(finished[0], include_archived=True).worker_id == 'test-worker'
+
+
+def test_state_transitions_return_partial_jobs(controller):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1}, args={'payload': 'x' * 1000})
+    job = controller.acquire_job({'cpu': 1}, 'test-worker')
+
+    heartbeat = controller.heartbeat_job(job.id, job.version)
+    assert heartbeat.version == job.version + 1
+    assert heartbeat.status == Job.LOCKED
+    assert heartbeat.worker_id == 'test-worker'
+    assert 'args' in heartbeat.missing_fields
+
+    merged = job.merged(heartbeat)
+    assert merged.missing_fields == []
+    assert merged.version == heartbeat.version
+    assert merged.args == {'payload': 'x' * 1000}
+
+    # missing fields are loaded on first access
+    assert heartbeat.args == {'payload': 'x' * 1000}
+    assert heartbeat.missing_fields == []
+
+
+def test_iter_jobs(controller):
+    job_ids = [controller.create_job_id() for _ in range(5)]
+    for job_id in job_ids:
+        controller.create_job(job_id, args={'payload': job_id})
+    acquired = controller.acquire_jobs({}, 'test-worker', 2)
+
+    jobs = list(controller.iter_jobs(batch_size=2))
+    assert sorted(job.id for job in jobs) == sorted(job_ids)
+    assert {job.id: job.args['payload'] for job in jobs} == {job_id: job_id for job_id in job_ids}
+
+    locked = list(controller.iter_jobs(status=Job.LOCKED, worker_id='test-worker'))
+    assert sorted(job.id for job in locked) == sorted(job.id for job in acquired)
+    assert len(list(controller.iter_jobs(status=[Job.IDLE, Job.LOCKED]))) == 5
+    assert list(controller.iter_jobs(created_before=datetime.utcnow() - timedelta(hours=1))) == []
+
+    compact = list(controller.iter_jobs(status=Job.IDLE, fields=['status']))
+    assert len(compact) == 3
+    assert all(job.status == Job.IDLE for job in compact)
+    with pytest.raises(AttributeError):
+        compact[0].args
+
+
+def test_job_lease(controller):
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1}, lease=30)
+    default_id = controller.create_job_id()
+    controller.create_job(default_id, reqs={'cpu': 1})
+
+    jobs = {job.id: job for job in controller.acquire_jobs({'cpu': 2}, 'test-worker', 2)}
+    job = jobs[job_id]
+    assert job.lease == 30
+    assert job.lease_expires_at == job.worker_heartbeat + timedelta(seconds=30)
+    assert controller.get_job(job_id).lease_expires_at == job.lease_expires_at
+    default = jobs[default_id]
+    assert default.lease == controller.HEARTBEAT_TIMEOUT.total_seconds()
+    assert default.lease_expires_at == default.worker_heartbeat + controller.HEARTBEAT_TIMEOUT
+
+    job = controller.heartbeat_job(job.id, job.version, lease=5)
+    assert controller.get_job(job_id).lease == 5
+    assert job.lease_expires_at - timedelta(seconds=5) <= datetime.utcnow()
+
+    # the lease expires long before HEARTBEAT_TIMEOUT
+    controller.heartbeat_job(job.id, job.version, lease=-1)
+    assert controller.reap_expired_leases() == 1
+    assert controller.get_job(job_id).status == Job.IDLE
+    assert controller.get_job(default_id).status == Job.LOCKED
+
+
+def finish(controller, job_id, worker_exception=None):
     job = controller.acquire_job({'cpu': 1}, 'test-worker')
     assert job.id == job_id
+    return controller.finalize_job(job.id, job.version, worker_exception=worker_exception)
+
+
+def test_job_dependencies(controller):
+    first, second, child = [controller.create_job_id() for _ in range(3)]
+    controller.create_job(first, reqs={'cpu': 1})
+    controller.create_job(second, reqs={'cpu': 1}, priority=-1)
+    controller.create_job(child, reqs={'cpu': 1}, priority=1, depends_on=[first, second])
+
+    job = controller.get_job(child)
+    assert job.status == Job.BLOCKED
+    assert job.pending_deps == 2
+
+    finish(controller, first)
+    assert controller.get_job(child).pending_deps == 1
+    finish(controller, second)
+
+    job = controller.get_job(child)
+    assert job.status == Job.IDLE
+    assert job.pending_deps == 0
+    finish(controller, child)
+
+    # dependencies which are already finished are resolved at creation
+    late = controller.create_job_id()
+    controller.create_job(late, depends_on=[first])
+    assert controller.get_job(late).status == Job.IDLE
+
+
+def test_job_dependency_failure(controller):
+    parent, cancelled, grandchild, tolerant = [controller.create_job_id() for _ in range(4)]
+    controller.create_job(parent, reqs={'cpu': 1})
+    controller.create_job(cancelled, depends_on=[parent])
+    controller.create_job(grandchild, depends_on=[cancelled], on_dependency_failure=Job.ON_FAILURE_RUN)
+    controller.create_job(tolerant, depends_on=[parent], on_dependency_failure=Job.ON_FAILURE_RUN)
+
+    finish(controller, parent, worker_exception={'reason': 'error', 'traceback': ''})
+
+    assert controller.get_job(cancelled).status == Job.CANCELLED
+    assert controller.get_job(cancelled).completed_at is not None
+    assert controller.get_job(grandchild).status == Job.IDLE
+    assert controller.get_job(tolerant).status == Job.IDLE
+
+    with pytest.raises(ValueError):
+        controller.create_job(controller.create_job_id(), depends_on=[parent], on_dependency_failure='retry')
+
+
+def test_delete_job_with_dependents(controller):
+    parent, child = controller.create_job_id(), controller.create_job_id()
+    controller.create_job(parent, reqs={'cpu': 1})
+    controller.create_job(child, depends_on=[parent])
+
+    controller.delete_job(parent, controller.get_job(parent).version)
+    assert controller.get_job(parent, include_archived=True) is None
+    assert controller.get_job(child).status == Job.CANCELLED
+
+    with pytest.raises(ConcurrencyError):
+        controller.delete_job(parent, 0)
+
+
+def test_group_limit(controller):
+    group = controller.create_job_id()
+    controller.set_group_limit(group, max_locked=2)
+    for _ in range(3):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1}, group=group)
+
+    jobs = controller.acquire_jobs({'cpu': 10}, 'worker', 10)
+    assert len(jobs) == 2
+    assert all(job.group == group for job in jobs)
+    assert controller.acquire_job({'cpu': 10}, 'worker') is None
+
+    # finished jobs give their slots back
+    controller.finalize_job(jobs[0].id, jobs[0].version)
+    job = controller.acquire_job({'cpu': 10}, 'worker')
+    assert job is not None and job.group == group
+
+    controller.set_group_limit(group, max_locked=None)
+    controller.requeue_job(job.id, job.version)
+    assert controller.acquire_job({'cpu': 10}, 'worker') is not None
+
+
+def test_cancel_jobs(controller):
+    group = controller.create_job_id()
+    controller.set_group_limit(group, max_locked=1)
+    locked, idle, other, parent, child = [controller.create_job_id() for _ in range(5)]
+    controller.create_job(locked, reqs={'cpu': 1}, group=group)
+    assert controller.acquire_job({'cpu': 1}, 'worker').id == locked
+    controller.create_job(idle, reqs={'cpu': 1}, group=group)
+    controller.create_job(other, reqs={'gpu': 1})
+    controller.create_job(parent, group=group)
+    controller.create_job(child, depends_on=[parent])
+
+    assert controller.cancel_jobs(group=group) == 3
+    assert controller.cancel_jobs(group=group) == 0
+
+    for job_id in [locked, idle, parent, child]:
+        assert controller.get_job(job_id).status == Job.CANCELLED
+    assert controller.get_job(other).status == Job.IDLE
+    # the slot of the locked job is given back
+    controller.create_job(controller.create_job_id(), reqs={'cpu': 2}, group=group)
+    assert controller.acquire_job({'cpu': 2}, 'worker').group == group
+
+    assert controller.cancel_jobs(job_ids=[other, idle]) == 1
+    assert controller.get_job(other).status == Job.CANCELLED
+
+
+def test_mongo_group_slots_survive_errors(db_uri, monkeypatch):
+    controller = Controller(db_uri)
+    group = controller.create_job_id()
+    controller.set_group_limit(group, max_locked=2)
+    for _ in range(2):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1}, group=group)
+
+    def fail(*args, **kwargs):
+        raise RetriableError('lock has failed')
+
+    # reserved slots are given back when locking fails
+    with monkeypatch.context() as m:
+        m.setattr(controller, '_lock_job_batch', fail)
+        with pytest.raises(RetriableError):
+            controller.acquire_jobs({'cpu': 2}, 'worker', 2)
+    assert controller._groups.find_one({'_id': group})['free'] == 2
+
+    # and lost ones are recounted by the reaper
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+    controller._groups.update_one({'_id': group}, {'$inc': {'free': -1}})
+    controller.reap_expired_leases()
+    assert controller._groups.find_one({'_id': group})['free'] == 1
+    controller.finalize_job(job.id, job.version)
+    assert len(controller.acquire_jobs({'cpu': 2}, 'worker', 2)) == 1
+    controller.close()
+
+
+def test_mongo_group_limit_holds_while_reaping(db_uri, monkeypatch):
+    controller, reaper = Controller(db_uri), Controller(db_uri)
+    group = controller.create_job_id()
+    controller.set_group_limit(group, max_locked=1)
+    for _ in range(2):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1}, group=group)
+
+    # the reaper recounts slots after the acquisition has reserved one, but before it has locked a job
+    lock_job_batch = controller._lock_job_batch
+
+    def reap_and_lock(*args, **kwargs):
+        reaper.reap_expired_leases()
+        return lock_job_batch(*args, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(controller, '_lock_job_batch', reap_and_lock)
+        jobs = controller.acquire_jobs({'cpu': 2}, 'worker', 2)
+    assert len(jobs) == 1
+
+    assert reaper.acquire_jobs({'cpu': 2}, 'worker', 2) == []
+    doc = controller._groups.find_one({'_id': group})
+    assert doc['free'] == 0 and doc['reservations'] == []
+
+    # reservations of acquisitions which have died are taken back by the reaper
+    controller.finalize_job(jobs[0].id, jobs[0].version)
+    lost = {'token': 'lost', 'slots': 1, 'at': datetime.utcnow() - Controller.RESERVATION_TIMEOUT}
+    controller._groups.update_one({'_id': group}, {'$inc': {'free': -1}, '$push': {'reservations': lost}})
+    reaper.reap_expired_leases()
+    doc = controller._groups.find_one({'_id': group})
+    assert doc['free'] == 1 and doc['reservations'] == []
+    controller.close()
+    reaper.close()
+
+
+def test_mongo_dependents_survive_errors(db_uri, monkeypatch):
+    controller = Controller(db_uri)
+    first, second = controller.create_job_id(), controller.create_job_id()
+    controller.create_job(first, reqs={'cpu': 1})
+    controller.create_job(second, reqs={'cpu': 1}, depends_on=[first])
+
+    def fail(*args, **kwargs):
+        raise RetriableError('resolution has failed')
+
+    # the job is finalized even though its dependents could not be resolved
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+    with monkeypatch.context() as m:
+        m.setattr(controller, '_resolve_dependency', fail)
+        assert controller.finalize_job(job.id, job.version).status == Job.COMPLETED
+    assert controller.get_job(second).status == Job.BLOCKED
+
+    # and the dependent is unblocked by the reaper
+    controller.reap_expired_leases()
+    assert controller.get_job(second).status == Job.IDLE
+    assert controller.acquire_job({'cpu': 1}, 'worker').id == second
+    controller.close()
+
+
+def test_mongo_dependents_survive_errors_between_writes(db_uri, monkeypatch):
+    controller = Controller(db_uri)
+    first, second = controller.create_job_id(), controller.create_job_id()
+    controller.create_job(first, reqs={'cpu': 1})
+    controller.create_job(second, reqs={'cpu': 1}, depends_on=[first])
+
+    def fail(*args, **kwargs):
+        raise RetriableError('resolution has failed')
+
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+    with monkeypatch.context() as m:
+        m.setattr(controller, '_resolve_dependency', fail)
+        controller.finalize_job(job.id, job.version)
+    # the client has failed after the first write of unblocking the dependent, but before the second one
+    controller._jobs.update_one({'job_id': second},
+                                {'$inc': {'version': 1, 'pending_deps': -1}, '$pull': {'meta.waiting_for': first}})
+    assert controller.get_job(second).status == Job.BLOCKED
+
+    controller.reap_expired_leases()
+    assert controller.get_job(second).status == Job.IDLE
+    # the dependency's stamp is cleared, so later runs don't look at it again
+    assert 'unresolved' not in controller._jobs.find_one({'job_id': first})['meta']
+    controller.close()
+
+
+def test_group_weighted_selection(controller):
+    large, small = controller.create_job_id(), controller.create_job_id()
+    controller.set_group_limit(small, weight=4)
+    controller.create_jobs({'job_id': controller.create_job_id(), 'group': large, 'priority': 10}
+                           for _ in range(20))
+    controller.create_job(controller.create_job_id(), group=small)
+
+    # the small group is served despite the backlog of higher priority jobs of the large group
+    jobs = [controller.acquire_job({}, 'worker') for _ in range(10)]
+    assert small in [job.group for job in jobs]
+
+
+def test_queues(controller):
+    bulk = controller.queue('bulk')
+    assert controller.queue('bulk') is bulk
+    assert controller.queue(None) is controller
+
+    job_id = controller.create_job_id()
+    bulk.create_job(job_id, reqs={'cpu': 1})
+
+    assert controller.get_job(job_id) is None
+    assert controller.acquire_job({'cpu': 1}, 'worker') is None
+    assert bulk.acquire_job({'cpu': 1}, 'worker').id == job_id
+
+    # named queues lead back to the default queue
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    assert bulk.queue(None).get_job(job_id) is not None
+    assert bulk.queue('bulk') is bulk
+
+
+def test_heartbeat_jobs(controller):
+    for _ in range(3):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+    jobs = controller.acquire_jobs({'cpu': 3}, 'worker', 3)
+
+    stale = controller.heartbeat_job(jobs[2].id, jobs[2].version)
+    result = controller.heartbeat_jobs([(job.id, job.version, 30) for job in jobs])
+
+    assert [job.version for job in result[:2]] == [jobs[0].version + 1, jobs[1].version + 1]
+    assert result[0].status == Job.LOCKED and result[0].lease_expires_at is not None
+    assert result[2] is None
+    assert controller.get_job(jobs[2].id).version == stale.version
+
+
+def test_acquire_jobs_per_resources_limits(controller):
+    for _ in range(4):
+        controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+
+    # the first resources could take all the jobs, but only one of them is fitted into it
+    jobs = controller.acquire_jobs([{'cpu': 4}, {'cpu': 1}, {'cpu': 4}], 'worker', [1, 1, 0])
+    assert len(jobs) == 2
+
+
+def test_unlock_job(controller):
+    job_ids = [controller.create_job_id() for _ in range(2)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+    job = controller.unlock_job(job.id, job.version)
+    assert job.status == Job.IDLE
+    # unlike a requeued job, it keeps its place in the queue
+    assert controller.acquire_job({'cpu': 1}, 'worker').id == job_ids[0]
+
+
+def test_finalize_and_acquire(controller):
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+
+    finalized, jobs = controller.finalize_and_acquire(job.id, job.version, resources={'cpu': 2},
+                                                      worker_id='worker', max_jobs=2)
+    assert finalized.status == Job.COMPLETED
+    assert controller.get_job(job.id).status == Job.COMPLETED
+    assert sorted(j.id for j in jobs) == sorted(set(job_ids) - {job.id})
+
+    # nothing is acquired when the job can't be finalized
+    controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+    with pytest.raises(ConcurrencyError):
+        controller.finalize_and_acquire(job.id, job.version, resources={'cpu': 1}, worker_id='worker')
+    assert controller.acquire_job({'cpu': 1}, 'worker') is not None
+
+
+def test_mongo_finalize_and_acquire_unlocks_on_errors(db_uri, monkeypatch):
+    controller = Controller(db_uri)
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+
+    lock_job_batch = controller._lock_job_batch
+
+    def fail(*args, **kwargs):
+        lock_job_batch(*args, **kwargs)
+        raise RetriableError('reply of the lock has been lost')
+
+    # the next jobs get locked, but the error comes before the worker learns about them
+    with monkeypatch.context() as m:
+        m.setattr(controller, '_lock_job_batch', fail)
+        finalized, jobs = controller.finalize_and_acquire(job.id, job.version, resources={'cpu': 2},
+                                                          worker_id='worker', max_jobs=2)
+    assert finalized.status == Job.COMPLETED and jobs == []
+
+    # so they are put back right away instead of waiting for their leases to expire
+    others = set(job_ids) - {job.id}
+    assert {controller.get_job(job_id).status for job_id in others} == {Job.IDLE}
+    assert {j.id for j in controller.acquire_jobs({'cpu': 2}, 'worker', 2)} == others
+    controller.close()
+
+
+def test_controller_connects_lazily():
+    # nothing listens on the port, neither the constructor nor close need the database
+    controller = Controller('mongodb://localhost:1/terry-tests?serverSelectionTimeoutMS=100', signals=True)
+    bulk = controller.queue('bulk')
+    bulk.close()
+    controller.close()
+    controller.close()
+
+
+def test_mongo_write_concerns(db_uri):
+    with pytest.raises(ValueError):
+        Controller(db_uri, write_concerns={'heartbeats': pymongo.WriteConcern(w=1)})
+
+    controller = Controller(db_uri, write_concerns={'heartbeat': pymongo.WriteConcern(w=1)},
+                            read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
+    controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+    job = controller.acquire_job({'cpu': 1}, 'worker')
+    job = controller.heartbeat_job(job.id, job.version)
+    controller.finalize_job(job.id, job.version)
+    assert controller.get_job(job.id).status == Job.COMPLETED
+    controller.close()
+
+
+def test_shared_client():
+    # neither connects nor creates indexes until the first operation
+    controller = Controller('mongodb://localhost/terry-tests')
+    other = Controller('mongodb://localhost/terry-tests', 'other')
+    assert other._client is controller._client
+    assert controller.queue('q')._client is controller._client
+
+    client = controller._client
+    controller.close()
+    assert other.queue('q')._client is client
+    other.close()
+    controller = Controller('mongodb://localhost/terry-tests')
+    assert controller._client is not client
+    controller.close()
+
+
+def test_mongo_retention(db_uri):
+    admin = Controller(db_uri)
+    admin.ensure_indexes()
+    admin.set_retention(timedelta(days=1))
+    admin.close()
+
+    # controllers leave the TTL alone
+    controller = Controller(db_uri)
+    controller.create_job(controller.create_job_id())
+    ttl = [index.get('expireAfterSeconds') for index in controller._jobs.index_information().values()
+           if index['key'] == [('completed_at', 1)]]
+    assert ttl == [24 * 3600]
+
+    controller.set_retention(None)
+    controller.ensure_indexes()
+    assert all('expireAfterSeconds' not in index for index in controller._jobs.index_information().values())
+    controller.close()
+
+
+def test_mongo_req_classes(db_uri):
+    controller = Controller(db_uri)
+    other = Controller(db_uri)
+    controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+    assert controller.acquire_job({'cpu': 4}, 'worker') is not None
+
+    # classes created by other controllers are loaded by the next refresh
+    other.create_job(other.create_job_id(), reqs={'cpu': 2})
+    other.create_job(other.create_job_id(), reqs={'cpu': 3})
+    controller._req_classes_expire_at = 0
+    assert controller.acquire_job({'cpu': 4}, 'worker').reqs == {'cpu': 2}
+
+    # classes unused for long are dropped once they have no unfinished jobs
+    job = controller.acquire_job({'cpu': 4}, 'worker')
+    controller.finalize_job(job.id, job.version)
+    controller._classes.update_many({}, {'$set': {'used_at': datetime.utcnow() - Controller.REQ_CLASS_EXPIRY}})
+    controller.reap_expired_leases()
+    assert sorted(doc['_id'] for doc in controller._classes.find()) == [_req_class({'cpu': 1}), _req_class({'cpu': 2})]
+
+    # a requeued job brings its class back
+    job = controller.requeue_job(job.id, job.version + 1)
+    controller._req_classes_expire_at = controller._req_classes_reload_at = 0
+    assert controller.acquire_job({'cpu': 4}, 'worker').id == job.id
+    other.close()
+    controller.close()
+
+
+def test_mongo_migrate(db_uri):
+    controller = Controller(db_uri)
+    # a job created by an older version
+    controller._jobs.insert_one({'job_id': 'old', 'reqs': {'cpu': 1}, 'args': {}, 'run_at': None, 'version': 0,
+                                 'status': Job.IDLE, 'created_at': datetime.utcnow()})
+    assert controller.acquire_job({'cpu': 1}, 'worker') is None
+
+    assert controller.migrate() == 1
+    assert controller.migrate() == 0
+    controller._req_classes_expire_at = 0
+    assert controller.acquire_job({'cpu': 1}, 'worker').id == 'old'
+
+    # a job locked by a worker of an older version which has crashed long ago
+    heartbeat = datetime.utcnow() - Controller.HEARTBEAT_TIMEOUT - timedelta(minutes=1)
+    controller._jobs.insert_one({'job_id': 'crashed', 'reqs': {}, 'args': {}, 'run_at': None, 'version': 1,
+                                 'status': Job.LOCKED, 'created_at': heartbeat, 'worker_id': 'old-worker',
+                                 'locked_at': heartbeat, 'worker_heartbeat': heartbeat})
+    assert controller.migrate() == 2
+    assert controller.reap_expired_leases() == 1
+    assert controller.get_job('crashed').status == Job.IDLE
+    controller.close()
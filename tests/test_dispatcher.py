@@ -0,0 +1,102 @@
+from threading import Barrier, Thread
+
+import pytest
+
+from terry.api import ConcurrencyError, Job
+from terry.dispatcher import Dispatcher
+from terry.worker import BasicResourceManager, Worker
+
+
+@pytest.mark.timeout(10)
+def test_dispatcher_feeds_workers(controller):
+    all_started = Barrier(3)
+
+    def work_func(channel):
+        all_started.wait()
+
+    dispatcher = Dispatcher('test-dispatcher', controller)
+    dispatcher.start()
+    workers = [Worker('test-worker-{}'.format(i), BasicResourceManager({'cpu': 1}), work_func, controller,
+                      dispatcher=dispatcher) for i in range(2)]
+    for worker in workers:
+        worker.start()
+
+    job_ids = [controller.create_job_id() for _ in range(2)]
+    controller.create_jobs({'job_id': job_id, 'reqs': {'cpu': 1}} for job_id in job_ids)
+
+    all_started.wait()  # every worker has got one of the jobs
+    for worker in workers:
+        worker.stop()
+    dispatcher.stop()
+
+    for job_id in job_ids:
+        job = controller.get_job(job_id)
+        assert job.status == Job.COMPLETED
+        assert job.worker_id == 'test-dispatcher'
+    for worker in workers:
+        assert worker._resources.get_current_resources() == {'cpu': 1}
+
+
+@pytest.mark.timeout(10)
+def test_dispatcher_batches_heartbeats(controller, monkeypatch):
+    dispatcher = Dispatcher('test-dispatcher', controller)
+    dispatcher.HEARTBEAT_WINDOW = 0.5
+    controller.create_jobs({'job_id': controller.create_job_id(), 'reqs': {'cpu': 1}} for _ in range(2))
+    jobs = controller.acquire_jobs({'cpu': 2}, 'test-dispatcher', 2)
+
+    batches = []
+    heartbeat_jobs = controller.heartbeat_jobs
+
+    def counting_heartbeat_jobs(jobs):
+        batches.append(len(jobs))
+        return heartbeat_jobs(jobs)
+
+    monkeypatch.setattr(controller, 'heartbeat_jobs', counting_heartbeat_jobs)
+    dispatcher.start()
+    try:
+        results = []
+        threads = [Thread(target=lambda job=job: results.append(
+            dispatcher.heartbeat_job(controller, job.id, job.version, lease=30))) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert batches == [2]
+        assert sorted(job.version for job in results) == [2, 2]
+
+        job = results[0]
+        with pytest.raises(ConcurrencyError):
+            dispatcher.heartbeat_job(controller, job.id, job.version - 1)
+    finally:
+        dispatcher.stop()
+
+
+@pytest.mark.timeout(10)
+def test_dispatcher_heartbeat_errors_reach_every_caller(controller, monkeypatch):
+    dispatcher = Dispatcher('test-dispatcher', controller)
+    dispatcher.HEARTBEAT_WINDOW = 0.5
+    controller.create_jobs({'job_id': controller.create_job_id(), 'reqs': {'cpu': 1}} for _ in range(2))
+    jobs = controller.acquire_jobs({'cpu': 2}, 'test-dispatcher', 2)
+
+    def fail(jobs):
+        raise ValueError('heartbeat has failed')
+
+    monkeypatch.setattr(controller, 'heartbeat_jobs', fail)
+    dispatcher.start()
+
+    errors = []
+
+    def heartbeat(job):
+        try:
+            dispatcher.heartbeat_job(controller, job.id, job.version)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=heartbeat, args=(job,)) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dispatcher.stop()
+
+    assert [type(e) for e in errors] == [ValueError, ValueError]
@@ -0,0 +1,84 @@
+from threading import Event
+from urllib.request import urlopen
+
+import pytest
+
+from terry.api import ConcurrencyError, Job
+from terry.metrics import PrometheusMetrics, Registry, start_http_server
+from terry.worker import Worker
+
+
+def test_registry_render():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests.', ['method'])
+    histogram = registry.histogram('latency_seconds', 'Latency.', buckets=[0.1, 1])
+
+    counter.inc(method='get')
+    counter.inc(2, method='get')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{method="get"} 3.0' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2.0' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 2.0' in lines
+    assert 'latency_seconds_count 2.0' in lines
+
+    with pytest.raises(ValueError):
+        counter.inc(path='/')
+
+
+def test_controller_metrics(controller):
+    metrics = PrometheusMetrics()
+    controller._metrics = metrics
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id)
+    job = controller.acquire_job({}, 'test-worker')
+    with pytest.raises(ConcurrencyError):
+        controller.heartbeat_job(job_id, job.version + 1)
+
+    assert metrics.controller_seconds.get(operation='create_job')['count'] == 1
+    assert metrics.controller_seconds.get(operation='acquire_job')['count'] == 1
+    assert metrics.controller_seconds.get(operation='acquire_jobs') is None
+    assert metrics.controller_errors.get(operation='heartbeat_job', error='ConcurrencyError') == 1
+
+
+@pytest.mark.timeout(10)
+def test_worker_metrics(controller, resource_manager):
+    metrics = PrometheusMetrics()
+    job_started = Event()
+
+    def work_func(channel):
+        job_started.set()
+
+    worker = Worker('test-worker', resource_manager, work_func, controller, metrics=metrics)
+    worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+
+    job_started.wait()
+    worker.stop()
+
+    assert controller.get_job(job_id).status == Job.COMPLETED
+    assert metrics.worker_events.get(worker='test-worker', event='acquired') == 1
+    assert metrics.worker_events.get(worker='test-worker', event='finalized') == 1
+    assert metrics.worker_resources.get(worker='test-worker', resource='cpu', state='total') == 2
+    assert metrics.worker_resources.get(worker='test-worker', resource='cpu', state='used') == 0
+    assert metrics.worker_retry_delay.get(worker='test-worker') == 0
+
+
+def test_http_endpoint():
+    metrics = PrometheusMetrics()
+    metrics.worker_event('test-worker', 'acquired')
+
+    server = start_http_server(metrics, 0, addr='127.0.0.1')
+    try:
+        body = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read().decode()
+    finally:
+        server.shutdown()
+
+    assert 'terry_worker_events_total{worker="test-worker",event="acquired"} 1.0' in body
@@ -0,0 +1,44 @@
+import pytest
+
+from terry.controller import Controller
+from terry.memory import MemoryController
+from terry.policy import BestFit, FirstFit, LargestFirst
+
+
+@pytest.fixture(params=['mongo', 'memory'])
+def best_fit_controller(request):
+    if request.param == 'mongo':
+        controller = Controller(request.getfixturevalue('db_uri'), policy=BestFit())
+    else:
+        controller = MemoryController(policy=BestFit())
+    yield controller
+    controller.close()
+
+
+def test_policy_tiers():
+    reqs = [{'cpu': 1, 'ram': 60}, {'cpu': 8, 'ram': 4}, {'cpu': 8, 'ram': 48}, {}]
+    resources = [{'cpu': 16, 'ram': 64}]
+
+    assert FirstFit().tiers(reqs, resources) == [[0, 1, 2, 3]]
+    assert BestFit().tiers(reqs, resources) == [[0], [2], [1], [3]]
+    assert LargestFirst().tiers(reqs, resources) == [[2], [0], [1], [3]]
+
+
+def test_best_fit_acquire(best_fit_controller):
+    controller = best_fit_controller
+    small, large = controller.create_job_id(), controller.create_job_id()
+    controller.create_job(small, reqs={'cpu': 1}, priority=10)
+    controller.create_job(large, reqs={'cpu': 8})
+
+    # the tightest fit goes first, priority only orders jobs of one tier
+    assert controller.acquire_job({'cpu': 8}, 'worker').id == large
+    assert controller.acquire_job({'cpu': 8}, 'worker').id == small
+
+
+def test_best_fit_acquire_jobs(best_fit_controller):
+    controller = best_fit_controller
+    for reqs in [{'cpu': 1}, {'cpu': 1}, {'cpu': 4}]:
+        controller.create_job(controller.create_job_id(), reqs=reqs)
+
+    jobs = controller.acquire_jobs({'cpu': 5}, 'worker', 10)
+    assert sorted(job.reqs['cpu'] for job in jobs) == [1, 4]
@@ -0,0 +1,103 @@
+import os
+import time
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from terry.api import Job
+from terry.process import WorkerProcessPool
+from terry.worker import BasicResourceManager, Worker
+
+
+PARENT_PID = os.getpid()
+
+
+def run_in_child(channel):
+    if os.getpid() == PARENT_PID:
+        raise Exception('job is running in the parent process')
+
+
+def fail(channel):
+    raise Exception('exception from job')
+
+
+def run_forever(channel):
+    while True:
+        time.sleep(0.01)
+
+
+def requeue_later(channel):
+    channel.requeue_job(datetime.utcnow() + timedelta(hours=1))
+
+
+@pytest.fixture
+def process_worker(controller):
+    worker = Worker('test-worker', BasicResourceManager({'cpu': 2}), None, controller,
+                    executor=WorkerProcessPool(2))
+    yield worker
+    worker.stop()
+
+
+def wait_for_status(controller, job_id, status):
+    while controller.get_job(job_id).status != status:
+        time.sleep(0.05)
+
+
+@pytest.mark.timeout(10)
+def test_process_job_success(controller, process_worker):
+    process_worker._worker_func = run_in_child
+    process_worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    wait_for_status(controller, job_id, Job.COMPLETED)
+
+    assert controller.get_job(job_id).worker_exception is None
+
+
+@pytest.mark.timeout(10)
+def test_process_job_exception(controller, process_worker):
+    process_worker._worker_func = fail
+    process_worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    wait_for_status(controller, job_id, Job.COMPLETED)
+
+    job = controller.get_job(job_id)
+    assert job.worker_exception['reason'] == 'exception from job'
+    assert 'in fail' in job.worker_exception['traceback']
+
+
+@pytest.mark.timeout(10)
+def test_process_job_requeue(controller, process_worker):
+    process_worker._worker_func = requeue_later
+    process_worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    while controller.get_job(job_id).run_at is None:
+        time.sleep(0.05)
+
+    job = controller.get_job(job_id)
+    assert job.status == Job.IDLE
+    assert job.run_at > datetime.utcnow()
+
+
+@pytest.mark.timeout(10)
+def test_process_job_cancel(controller, process_worker):
+    process_worker._worker_func = run_forever
+    process_worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    wait_for_status(controller, job_id, Job.LOCKED)
+
+    job = controller.get_job(job_id)
+    controller.cancel_job(job.id, job.version)
+
+    # the worker notices cancellation on the next heartbeat and terminates the process
+    while process_worker.is_busy:
+        time.sleep(0.05)
+    assert controller.get_job(job_id).status == Job.CANCELLED
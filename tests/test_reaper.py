@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+from terry.api import Job
+from terry.reaper import LeaseReaper
+
+
+def expire_lease(controller, job):
+    expired_at = datetime.utcnow() - timedelta(minutes=1)
+    return controller._update_job(job.id, job.version, lease_expires_at=expired_at)
+
+
+def test_reap_expired_leases(controller):
+    job_ids = [controller.create_job_id() for _ in range(2)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    expired = controller.acquire_job({'cpu': 1}, 'test-worker')
+    expire_lease(controller, expired)
+    alive = controller.acquire_job({'cpu': 1}, 'test-worker')
+
+    reaper = LeaseReaper(controller)
+    assert reaper.reap() == 1
+    assert reaper.reclaimed == 1
+
+    assert controller.get_job(expired.id).status == Job.IDLE
+    assert controller.get_job(expired.id).worker_id is None
+    assert controller.get_job(alive.id).status == Job.LOCKED
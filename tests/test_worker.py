@@ -2,11 +2,13 @@ import os
 import signal
 import time
 
-from threading import Event, Thread
+from threading import Barrier, Event, Thread
 
 import pytest
 
 from terry.api import Job
+from terry.memory import MemoryController
+from terry.worker import BasicResourceManager, QueueScheduler, Worker
 
 
 @pytest.mark.timeout(10)
@@ -122,3 +124,223 @@ def test_worker_requeue_job_on_error(controller, worker):
     job = controller.get_job(job_id)
     assert job.status == Job.COMPLETED
     assert job.worker_exception is None
+
+
+@pytest.mark.timeout(10)
+def test_worker_runs_multiple_jobs(controller):
+    both_started = Barrier(3)
+
+    def work_func(channel):
+        both_started.wait()
+
+    worker = Worker('test-worker', BasicResourceManager({'cpu': 2}), work_func, controller, max_jobs=2)
+    worker.start()
+
+    job_ids = [controller.create_job_id() for _ in range(2)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    both_started.wait()  # both jobs are running at the same time
+    worker.stop()
+
+    for job_id in job_ids:
+        assert controller.get_job(job_id).status == Job.COMPLETED
+    assert worker._resources.get_current_resources() == {'cpu': 2}
+
+
+@pytest.mark.timeout(10)
+def test_worker_wakes_up_on_new_job(notifying_controller, resource_manager):
+    controller = notifying_controller
+    job_started = Event()
+
+    def work_func(channel):
+        job_started.set()
+
+    worker = Worker('test-worker', resource_manager, work_func, controller)
+    worker.start()
+    time.sleep(1)  # let the worker find out there are no jobs
+
+    controller.create_job(controller.create_job_id(), reqs={'cpu': 1})
+
+    # without notifications the worker would poll again only after a few seconds
+    assert job_started.wait(1)
+    worker.stop()
+
+
+@pytest.mark.timeout(10)
+def test_worker_notified_of_cancel(notifying_controller, resource_manager):
+    controller = notifying_controller
+    job_started = Event()
+    waited = []
+
+    def work_func(channel):
+        job_started.set()
+        waited.append(channel.wait_cancelled(5))
+
+    worker = Worker('test-worker', resource_manager, work_func, controller)
+    worker.start()
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1})
+    assert job_started.wait(5)
+
+    started = time.time()
+    assert controller.cancel_jobs(worker_id='test-worker') == 1
+    # without notifications the job would be checked only after a few seconds
+    while worker.is_busy:
+        time.sleep(0.05)
+    assert time.time() - started < 1.5
+    assert waited == [True]
+    assert controller.get_job(job_id).status == Job.CANCELLED
+    worker.stop()
+
+
+@pytest.mark.timeout(10)
+def test_worker_prefetch(controller):
+    job_started = Event()
+    job_may_complete = Event()
+
+    def work_func(channel):
+        job_started.set()
+        job_may_complete.wait()
+
+    job_ids = [controller.create_job_id() for _ in range(3)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    worker = Worker('test-worker', BasicResourceManager({'cpu': 4}), work_func, controller, max_jobs=1, prefetch=2)
+    worker.start()
+    job_started.wait()
+
+    statuses = [controller.get_job(job_id).status for job_id in job_ids]
+    assert statuses == [Job.LOCKED] * 3
+
+    worker.request_stop()
+    job_may_complete.set()
+    worker.join()
+
+    # prefetched jobs which were not started are handed back
+    statuses = sorted(controller.get_job(job_id).status for job_id in job_ids)
+    assert statuses == [Job.COMPLETED, Job.IDLE, Job.IDLE]
+    assert worker._resources.get_current_resources() == {'cpu': 4}
+
+
+@pytest.mark.timeout(10)
+def test_worker_heartbeats_short_lease(controller, worker):
+    job_started = Event()
+    job_may_complete = Event()
+
+    def work_func(channel):
+        job_started.set()
+        job_may_complete.wait()
+
+    worker._worker_func = work_func
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1}, lease=0.6)
+
+    job_started.wait()
+    for _ in range(10):
+        time.sleep(0.1)
+        # heartbeats at a third of the lease keep it from expiring
+        assert controller.reap_expired_leases() == 0
+
+    job_may_complete.set()
+    worker.stop()
+
+    assert controller.get_job(job_id).status == Job.COMPLETED
+
+
+@pytest.mark.timeout(10)
+def test_worker_checks_jobs_on_primary(resource_manager):
+    class LaggingController(MemoryController):
+        # get_job reads from a secondary which hasn't seen the job locked yet
+        def get_job(self, job_id, **kwargs):
+            return Job.partial(job_id, version=0, status=Job.IDLE, worker_id=None)
+
+        def refresh_job(self, job_id, *, fields=None):
+            return MemoryController.get_job(self, job_id, fields=fields)
+
+    controller = LaggingController()
+    worker = Worker('test-worker', resource_manager, lambda channel: time.sleep(3.5), controller)
+    worker.start()
+
+    job_id = controller.create_job_id()
+    controller.create_job(job_id, reqs={'cpu': 1}, lease=30)
+    time.sleep(0.5)  # the job is checked within a few seconds after being acquired
+    worker.stop()
+
+    assert MemoryController.get_job(controller, job_id).status == Job.COMPLETED
+
+
+def test_queue_scheduler_weights(controller):
+    scheduler = QueueScheduler(controller, [('hot', 3), 'bulk'])
+    hot, bulk = scheduler.controllers
+
+    picks = []
+    for _ in range(8):
+        first = scheduler.order()[0]
+        scheduler.acquired(first, 1)
+        picks.append(first)
+    assert picks.count(hot) == 6 and picks.count(bulk) == 2
+
+    # an empty queue doesn't get a burst of jobs once it has some again
+    for _ in range(10):
+        scheduler.acquired(hot, 1)
+    assert scheduler.order()[0] is bulk
+    scheduler.acquired(bulk, 1)
+    assert scheduler.order()[0] is hot
+
+
+@pytest.mark.timeout(10)
+def test_worker_queues(controller):
+    done = []
+
+    def work_func(channel):
+        done.append(channel.job.id)
+
+    hot, bulk = controller.queue('hot'), controller.queue('bulk')
+    hot_id, bulk_id = controller.create_job_id(), controller.create_job_id()
+    bulk.create_job(bulk_id, reqs={'cpu': 1})
+    hot.create_job(hot_id, reqs={'cpu': 1})
+
+    worker = Worker('test-worker', BasicResourceManager({'cpu': 1}), work_func, controller,
+                    queues=['hot', 'bulk'])
+    worker.start()
+    while len(done) < 2:
+        time.sleep(0.1)
+    worker.stop()
+
+    # the queue listed first wins ties
+    assert done == [hot_id, bulk_id]
+    assert hot.get_job(hot_id).status == Job.COMPLETED
+    assert bulk.get_job(bulk_id).status == Job.COMPLETED
+
+
+@pytest.mark.timeout(10)
+def test_worker_finalizes_and_acquires_in_one_call(controller, monkeypatch):
+    calls = []
+
+    def counted(name):
+        method = getattr(controller, name)
+
+        def wrapper(*args, **kwargs):
+            calls.append(name)
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in ['acquire_job', 'acquire_jobs', 'finalize_and_acquire']:
+        monkeypatch.setattr(controller, name, counted(name))
+
+    job_ids = [controller.create_job_id() for _ in range(5)]
+    for job_id in job_ids:
+        controller.create_job(job_id, reqs={'cpu': 1})
+
+    worker = Worker('test-worker', BasicResourceManager({'cpu': 1}), lambda channel: None, controller)
+    worker.start()
+    while any(controller.get_job(job_id).status != Job.COMPLETED for job_id in job_ids):
+        time.sleep(0.1)
+    worker.stop()
+
+    # every job but the first one has been acquired by finalization of the previous one
+    assert calls.count('finalize_and_acquire') == 5
+    assert calls.count('acquire_job') + calls.count('acquire_jobs') == 1